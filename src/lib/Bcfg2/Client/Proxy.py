@@ -1,10 +1,14 @@
 import re
 import sys
 import time
+import errno
 import socket
 import logging
 import Bcfg2.Options
-from Bcfg2.Compat import httplib, xmlrpclib, urlparse, quote_plus
+from Bcfg2.Compat import httplib, xmlrpclib, urlparse, quote_plus, \
+    unicode  # pylint: disable=W0622
+from Bcfg2.Utils import CONTENT_ENCODINGS, get_compressor, \
+    get_decompressor, select_content_encoding
 
 # The ssl module is provided by either Python 2.6 or a separate ssl
 # package that works on older versions of Python (see
@@ -182,6 +186,15 @@ class SSLHTTPConnection(httplib.HTTPConnection):
         self.protocol = protocol
         self.timeout = timeout
 
+        #: The SSL context used for every connection made by this
+        #: object, or None if it has not been created yet or this
+        #: version of Python has no :class:`ssl.SSLContext`
+        self.ssl_context = None
+
+        #: The TLS session from the last connection, which is resumed
+        #: when reconnecting on versions of Python that support it
+        self.ssl_session = None
+
     def connect(self):
         """Initiates a connection using the ssl module."""
         # check for IPv6
@@ -216,10 +229,28 @@ class SSLHTTPConnection(httplib.HTTPConnection):
             self.key = None
 
         rawsock.settimeout(self.timeout)
-        self.sock = ssl.SSLSocket(rawsock, cert_reqs=other_side_required,
-                                  ca_certs=self.ca, suppress_ragged_eofs=True,
-                                  keyfile=self.key, certfile=self.cert,
-                                  ssl_version=ssl_protocol_ver)
+        # requests are small and each waits for a response, so don't
+        # delay sending them while waiting for acknowledgements
+        rawsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(ssl, "SSLContext"):
+            if self.ssl_context is None:
+                self.ssl_context = ssl.SSLContext(ssl_protocol_ver)
+                self.ssl_context.verify_mode = other_side_required
+                if self.ca:
+                    self.ssl_context.load_verify_locations(self.ca)
+                if self.cert:
+                    self.ssl_context.load_cert_chain(self.cert, self.key)
+            kwargs = dict()
+            if self.ssl_session is not None:
+                kwargs['session'] = self.ssl_session
+            self.sock = self.ssl_context.wrap_socket(
+                rawsock, suppress_ragged_eofs=True, **kwargs)
+        else:
+            self.sock = ssl.SSLSocket(rawsock, cert_reqs=other_side_required,
+                                      ca_certs=self.ca,
+                                      suppress_ragged_eofs=True,
+                                      keyfile=self.key, certfile=self.cert,
+                                      ssl_version=ssl_protocol_ver)
         self.sock.connect((self.host, self.port))
         peer_cert = self.sock.getpeercert()
         if peer_cert and self.scns:
@@ -229,8 +260,26 @@ class SSLHTTPConnection(httplib.HTTPConnection):
                 raise CertificateError(scn)
         self.sock.closeSocket = True
 
+    def close(self):
+        """ Close the connection, keeping the TLS session so that it
+        can be resumed when reconnecting.  The session is only saved
+        now, since TLS 1.3 servers send session tickets after the
+        handshake. """
+        session = getattr(self.sock, "session", None)
+        if session is not None:
+            self.ssl_session = session
+        httplib.HTTPConnection.close(self)
+
 
 class XMLRPCTransport(xmlrpclib.Transport):
+    #: Requests larger than this many bytes are compressed if the
+    #: server has said that it accepts a content coding we support
+    encode_threshold = 1400
+
+    #: The content codings to accept in responses and use for
+    #: requests, most preferred first
+    content_encodings = CONTENT_ENCODINGS
+
     def __init__(self, key=None, cert=None, ca=None,
                  scns=None, use_datetime=0, timeout=90,
                  protocol='xmlrpc/tlsv1'):
@@ -243,7 +292,29 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.timeout = timeout
         self.protocol = protocol
 
+        #: The content coding used to compress requests.  This is
+        #: None until a response from the server advertises the
+        #: codings it accepts, since older servers cannot read
+        #: compressed requests.
+        self.request_encoding = None
+
+        #: A tuple of (host, connection) for the connection that is
+        #: kept open between requests
+        self._connection = (None, None)
+
     def make_connection(self, host):
+        """ Get a connection to the given host, reusing the one from
+        the last request if possible.  The connection reconnects by
+        itself if it has been closed, reusing its SSL context and
+        resuming its TLS session. """
+        if self._connection[0] == host:
+            return self._connection[1]
+        self.close()
+        self._connection = (host, self.new_connection(host))
+        return self._connection[1]
+
+    def new_connection(self, host):
+        """ Create a new connection to the given host """
         host, self._extra_headers = self.get_host_info(host)[0:2]
         return SSLHTTPConnection(host,
                                  key=self.key,
@@ -253,42 +324,144 @@ class XMLRPCTransport(xmlrpclib.Transport):
                                  timeout=self.timeout,
                                  protocol=self.protocol)
 
+    def close(self):
+        """ Close the connection kept open between requests.  It is
+        reopened by the next request. """
+        if self._connection[1] is not None:
+            self._connection[1].close()
+
+    @staticmethod
+    def _connection_closed(err):
+        """ Determine if an error from sending a request or reading
+        its response means that the server had closed the connection
+        before it got the request, so that it is safe to send the
+        request again.  A connection reset means that the server
+        closed the connection with our request still unread; a
+        response with a malformed status line means that the server
+        did read it. """
+        if isinstance(err, httplib.BadStatusLine):
+            # only retry if the server sent nothing at all.  py3 raises
+            # RemoteDisconnected for that; py2 raises BadStatusLine
+            # with an empty line (or, since 2.7.16, with this message)
+            remote_disconnected = getattr(httplib, "RemoteDisconnected",
+                                          None)
+            if remote_disconnected is not None:
+                return isinstance(err, remote_disconnected)
+            return (err.line in ("", "''") or
+                    err.line.startswith("No status line received"))
+        return (isinstance(err, socket.error) and
+                not isinstance(err, socket.timeout) and
+                getattr(err, "errno", None) in (errno.ECONNRESET,
+                                                errno.EPIPE))
+
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
-        try:
-            conn = self.send_request(host, handler, request_body, False)
-            response = conn.getresponse()
-            errcode = response.status
-            errmsg = response.reason
-            headers = response.msg
-        except (socket.error, SSL_ERROR, httplib.BadStatusLine):
-            err = sys.exc_info()[1]
-            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
-                                                     408,
-                                                     str(err),
-                                                     self._extra_headers))
+        # the server may have closed a connection that was kept open
+        # from an earlier request without us noticing, so if that
+        # fails before we get any response, try once more with a new
+        # connection.  other errors, such as timeouts, may happen
+        # after the server has acted on the request, so they are not
+        # retried.
+        reused = (self._connection[0] == host and
+                  getattr(self._connection[1], "sock", None) is not None)
+        while True:
+            try:
+                conn = self.send_request(host, handler, request_body, False)
+                response = conn.getresponse()
+                errcode = response.status
+                errmsg = response.reason
+                headers = response.msg
+                break
+            except (socket.error, SSL_ERROR, httplib.HTTPException):
+                err = sys.exc_info()[1]
+                self.close()
+                if reused and self._connection_closed(err):
+                    reused = False
+                    continue
+                raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                         408,
+                                                         str(err),
+                                                         self._extra_headers))
 
         if errcode != 200:
+            self.close()
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      errcode,
                                                      errmsg,
                                                      headers))
 
+        accept = response.getheader("Accept-Encoding")
+        if accept is not None:
+            self.request_encoding = select_content_encoding(
+                accept, self.content_encodings)
+
         self.verbose = verbose
         return self.parse_response(response)
 
+    def parse_response(self, response):
+        """ Parse the XML-RPC response, decompressing it as it is
+        read if the server compressed it. """
+        encoding = response.getheader("Content-Encoding", "identity")
+        encoding = encoding.strip().lower()
+        decompressor = None
+        if encoding != "identity":
+            try:
+                decompressor = get_decompressor(encoding)
+            except ValueError:
+                raise ProxyError(sys.exc_info()[1])
+
+        parser, unmarshaller = self.getparser()
+        while True:
+            data = response.read(64 * 1024)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            parser.feed(data)
+        if decompressor is not None:
+            parser.feed(decompressor.flush())
+        parser.close()
+        return unmarshaller.close()
+
     if sys.hexversion < 0x03000000:
         # pylint: disable=E1101
         def send_request(self, host, handler, request_body, debug):
             """ send_request() changed significantly in py3k."""
             conn = self.make_connection(host)
-            xmlrpclib.Transport.send_request(self, conn, handler, request_body)
+            conn.putrequest("POST", handler, skip_accept_encoding=True)
+            conn.putheader("Accept-Encoding",
+                           ", ".join(self.content_encodings) or "identity")
             self.send_host(conn, host)
             self.send_user_agent(conn)
+            conn.putheader("Content-Type", "text/xml")
             self.send_content(conn, request_body)
             return conn
         # pylint: enable=E1101
 
+    def send_content(self, connection, request_body):
+        """ Send the request body, compressed if it is large and the
+        server accepts compressed requests.  This overrides the py3k
+        implementation too, which would otherwise gzip every request
+        larger than :attr:`encode_threshold`, whether or not the
+        server can read it. """
+        if isinstance(request_body, unicode):
+            request_body = request_body.encode('utf-8')
+        if (self.request_encoding is not None and
+                len(request_body) > self.encode_threshold):
+            compressor = get_compressor(self.request_encoding)
+            request_body = (compressor.compress(request_body) +
+                            compressor.flush())
+            connection.putheader("Content-Encoding", self.request_encoding)
+        connection.putheader("Content-Length", str(len(request_body)))
+        if sys.hexversion >= 0x02070000:
+            # send the body along with the headers, rather than in a
+            # separate packet that may be delayed until the server
+            # acknowledges the headers
+            connection.endheaders(request_body)
+        else:
+            connection.endheaders()
+            connection.send(request_body)
+
 
 class ComponentProxy(xmlrpclib.ServerProxy):
     """Constructs proxies to components. """
@@ -342,3 +515,9 @@ class ComponentProxy(xmlrpclib.ServerProxy):
             protocol=Bcfg2.Options.setup.protocol)
         xmlrpclib.ServerProxy.__init__(self, url,
                                        allow_none=True, transport=ssl_trans)
+        self._transport = ssl_trans
+
+    def close(self):
+        """ Close the connection to the server.  A new connection is
+        opened automatically for the next call. """
+        self._transport.close()
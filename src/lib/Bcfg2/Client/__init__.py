@@ -1,12 +1,14 @@
 """This contains all Bcfg2 Client modules"""
 
 import os
+import re
 import sys
 import stat
 import time
 import fcntl
 import socket
 import fnmatch
+import hashlib
 import logging
 import argparse
 import tempfile
@@ -117,8 +119,9 @@ class Client(object):
                 '-f', '--file', type=argparse.FileType('rb'),
                 help='Configure from a file rather than querying the server'),
             Bcfg2.Options.PathOption(
-                '-c', '--cache', type=argparse.FileType('wb'),
-                help='Store the configuration in a file')),
+                '-c', '--cache',
+                help='Store the configuration in a file, and only download '
+                'it again if it has changed')),
         Bcfg2.Options.BooleanOption(
             '--exit-on-probe-failure', default=True,
             cf=('client', 'exit_on_probe_failure'),
@@ -150,6 +153,15 @@ class Client(object):
             "-i", "--only-important",
             help='Only configure the important entries')]
 
+    #: The reply to ``GetConfig`` when the configuration cached with
+    #: ``-c`` is still current.  This must match
+    #: :attr:`Bcfg2.Server.Core.Core.unmodified_config`.
+    unmodified_config = b'<Configuration unmodified="true"/>'
+
+    #: Regular expression to find the ``revision`` attribute of a
+    #: cached configuration
+    revision_re = re.compile(br'<Configuration\s[^>]*revision="([^"]*)"')
+
     def __init__(self):
         self.config = None
         self._proxy = None
@@ -280,6 +292,23 @@ class Client(object):
 
         self.times['probe_upload'] = time.time()
 
+    def read_config_cache(self):
+        """ Read the configuration cached with ``-c`` by the last run.
+
+        :returns: tuple of (the cached configuration, its SHA-256 hex
+                  digest, its ``revision`` attribute), or None if
+                  there is no usable cached configuration
+        """
+        try:
+            rawconfig = open(Bcfg2.Options.setup.cache, 'rb').read()
+        except IOError:
+            return None
+        match = self.revision_re.search(rawconfig)
+        if match is None:
+            return None
+        return (rawconfig, hashlib.sha256(rawconfig).hexdigest(),
+                match.group(1).decode('utf-8'))
+
     def get_config(self):
         """ load the configuration, either from the cached
         configuration file (-f), or from the server """
@@ -325,8 +354,32 @@ class Client(object):
                     err = sys.exc_info()[1]
                     self.fatal_error("Failed to get decision list: %s" % err)
 
+            # send the digest and revision of the cached
+            # configuration, so that the server can tell us if it
+            # hasn't changed instead of sending it again
+            cached = None
+            if Bcfg2.Options.setup.cache:
+                cached = self.read_config_cache()
+            rawconfig = None
+            if cached is not None:
+                try:
+                    rawconfig = self.proxy.GetConfig(cached[1], cached[2])
+                except (xmlrpclib.Fault, Proxy.ProxyError):
+                    err = sys.exc_info()[1]
+                    # older servers don't take the extra arguments,
+                    # and fail with a TypeError.  anything else is a
+                    # real failure.
+                    if "GetConfig() takes" not in str(err):
+                        self.fatal_error("Failed to download configuration "
+                                         "from Bcfg2: %s" % err)
+                    self.logger.info("Server rejected the cached "
+                                     "configuration digest, downloading "
+                                     "the full configuration: %s" % err)
+                    cached = None
             try:
-                rawconfig = self.proxy.GetConfig().encode('utf-8')
+                if rawconfig is None:
+                    rawconfig = self.proxy.GetConfig()
+                rawconfig = rawconfig.encode('utf-8')
             except Proxy.ProxyError:
                 err = sys.exc_info()[1]
                 self.fatal_error("Failed to download configuration from "
@@ -334,10 +387,22 @@ class Client(object):
 
             self.times['config_download'] = time.time()
 
+            # the connection to the server is kept open between calls,
+            # but it would only sit idle while the configuration is
+            # applied, so close it rather than leave the server to time
+            # it out
+            self.proxy.close()
+
+            if cached is not None and rawconfig == self.unmodified_config:
+                self.logger.info("Configuration is unmodified, using cached "
+                                 "configuration from %s" %
+                                 Bcfg2.Options.setup.cache)
+                return cached[0]
+
         if Bcfg2.Options.setup.cache:
             try:
-                Bcfg2.Options.setup.cache.write(rawconfig)
-                os.chmod(Bcfg2.Options.setup.cache.name, 384)  # 0600
+                open(Bcfg2.Options.setup.cache, 'wb').write(rawconfig)
+                os.chmod(Bcfg2.Options.setup.cache, 384)  # 0600
             except IOError:
                 self.logger.warning("Failed to write config cache file %s" %
                                     (Bcfg2.Options.setup.cache))
@@ -24,12 +24,12 @@ try:
     from urlparse import urljoin, urlparse
     from urllib2 import HTTPBasicAuthHandler, \
         HTTPPasswordMgrWithDefaultRealm, build_opener, install_opener, \
-        urlopen, HTTPError, URLError
+        urlopen, Request, HTTPError, URLError
 except ImportError:
     from urllib.parse import urljoin, urlparse, quote_plus
     from urllib.request import HTTPBasicAuthHandler, \
         HTTPPasswordMgrWithDefaultRealm, build_opener, install_opener, \
-        urlopen, urlretrieve
+        urlopen, urlretrieve, Request
     from urllib.error import HTTPError, URLError
 
 try:
@@ -179,6 +179,7 @@ class WildcardSectionGroup(_OptionContainer, Option):
         Option.__init__(self, dest=kwargs.get('dest',
                                               self._prefix + "sections"))
         self.option_templates = items
+        self._section_options = dict()
 
     def list_options(self):
         return [self] + _OptionContainer.list_options(self)
@@ -188,17 +189,21 @@ class WildcardSectionGroup(_OptionContainer, Option):
         for section in cfp.sections():
             if fnmatch.fnmatch(section, self._section_glob):
                 sections.append(section)
-                newopts = []
-                for opt_tmpl in self.option_templates:
-                    option = copy.deepcopy(opt_tmpl)
-                    option.cf = (section, option.cf[1])
-                    option.dest = "%s%s_%s" % (self._prefix,
-                                               self._dest_re.sub('_', section),
-                                               option.dest)
-                    newopts.append(option)
-                self.extend(newopts)
+                if section not in self._section_options:
+                    # only create options for each section once, even
+                    # if the config is read by several parsers
+                    newopts = []
+                    for opt_tmpl in self.option_templates:
+                        option = copy.deepcopy(opt_tmpl)
+                        option.cf = (section, option.cf[1])
+                        option.dest = "%s%s_%s" % (
+                            self._prefix, self._dest_re.sub('_', section),
+                            option.dest)
+                        newopts.append(option)
+                    self.extend(newopts)
+                    self._section_options[section] = newopts
                 for parser in self.parsers:
-                    parser.add_options(newopts)
+                    parser.add_options(self._section_options[section])
         return sections
 
     def add_to_parser(self, parser):
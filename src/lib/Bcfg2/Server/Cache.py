@@ -1,6 +1,9 @@
 """ ``Bcfg2.Server.Cache`` is an implementation of a simple
 memory-backed cache. Right now this doesn't provide many features, but
-more (time-based expiration, etc.)  can be added as necessary.
+more (time-based expiration, etc.)  can be added as necessary.  The
+backend keeps an inverted index of tags, so looking up or expiring a
+set of tags only touches the items that share those tags, not the
+entire cache.
 
 The normal workflow is to get a Cache object, which is simply a dict
 interface to the unified cache that automatically uses a certain tag
@@ -62,8 +65,29 @@ cache.  In this case, the latter call is equivalent to:
     groupcache = Bcfg2.Server.Cache.Cache("Probes", "probegroups")
     groupcache.expire()
 
+By default, items live in the cache until they are explicitly
+expired.  An eviction policy can be set for all items tagged with a
+given namespace tag (e.g., ``Metadata`` or ``Packages``) with
+:func:`Bcfg2.Server.Cache.set_policy`, or from ``[caching:<namespace>]``
+sections in ``bcfg2.conf``.  A policy can limit the number of items
+(evicting the least recently used items first), the age of items, and
+the approximate total size of items in the namespace.  Cache objects
+whose first tag is a namespace tag record their hits and misses, and
+evictions are recorded for every namespace with a policy, in
+:mod:`Bcfg2.Server.Statistics`.
+
+Caches of data that is entirely derived from other data (e.g.,
+rendered templates) should be declared with
+:func:`Bcfg2.Server.Cache.add_derived`, so that expiring them is not
+mistaken for a change in the data they were derived from.
 """
 
+import sys
+import time
+import heapq
+import threading
+from itertools import islice
+import Bcfg2.Server.Statistics
 from Bcfg2.Compat import MutableMapping
 
 
@@ -71,12 +95,27 @@ class _Cache(MutableMapping):
     """ The object returned by :func:`Bcfg2.Server.Cache.Cache` that
     presents a dict-like interface to the portion of the unified cache
     that uses the specified tags. """
-    def __init__(self, registry, tags):
+    def __init__(self, registry, tags, namespace=None):
         self._registry = registry
         self._tags = tags
+        self._namespace = namespace
 
     def __getitem__(self, key):
-        return self._registry[self._tags | set([key])]
+        try:
+            rv = self._registry[self._tags | set([key])]
+        except KeyError:
+            self._record_lookup(0)
+            raise
+        self._record_lookup(1)
+        return rv
+
+    def _record_lookup(self, hit):
+        """ Record a cache hit (1) or miss (0) in
+        :mod:`Bcfg2.Server.Statistics`.  The average of the statistic
+        is thus the hit rate of the cache namespace. """
+        if self._namespace is not None:
+            Bcfg2.Server.Statistics.stats.add_value(
+                "Cache:%s:hit" % self._namespace, hit)
 
     def __setitem__(self, key, value):
         self._registry[self._tags | set([key])] = value
@@ -113,9 +152,384 @@ class _Cache(MutableMapping):
         return str(dict(self))
 
 
+#: The maximum number of objects that :func:`_sizeof` counts when it
+#: walks an object graph
+SIZEOF_LIMIT = 10000
+
+
+def _sizeof(obj, limit=SIZEOF_LIMIT):
+    """ Get the approximate size in bytes of an object, including the
+    containers, instance dicts, and slots it refers to.  Each object
+    is only counted once, and the walk stops after ``limit`` objects,
+    so the size of a very large object graph is underestimated rather
+    than being expensive to compute. """
+    rv = 0
+    seen = set()
+    stack = [obj]
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        try:
+            rv += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        remaining = limit - len(seen) - len(stack)
+        if isinstance(obj, dict):
+            items = getattr(obj, "iteritems", obj.items)()
+            for key, val in islice(items, max(remaining // 2, 0)):
+                stack.append(key)
+                stack.append(val)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(islice(obj, max(remaining, 0)))
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for slot in getattr(obj.__class__, "__slots__", ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return rv
+
+
+class _CachePolicy(object):
+    """ An eviction policy for all items in the unified cache that are
+    tagged with a given namespace tag.  The policy keeps track of the
+    insertion time, last access, and (if ``max_size`` is set) the
+    approximate size of each item it governs, and determines which
+    items should be evicted.  It does not modify the cache itself;
+    that is done by :class:`Bcfg2.Server.Cache._CacheRegistry`. """
+
+    def __init__(self, namespace, max_entries=None, max_age=None,
+                 max_size=None):
+        """
+        :param namespace: The tag that items governed by this policy
+                          are tagged with
+        :type namespace: string
+        :param max_entries: The maximum number of items in the
+                            namespace.  The least recently used items
+                            are evicted first.
+        :type max_entries: int
+        :param max_age: The maximum number of seconds an item stays
+                        in the cache after it was stored.
+        :type max_age: int or float
+        :param max_size: The approximate maximum number of bytes used
+                         by items in the namespace.  The least
+                         recently used items are evicted first.
+        :type max_size: int
+        """
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_size = max_size
+
+        #: The approximate size in bytes of all items in the namespace
+        self.size = 0
+
+        # key => [insertion time, access tick, size]
+        self._items = dict()
+
+        # heap of (access tick, key) used to find the least recently
+        # used item.  items are lazily removed from the heap; an entry
+        # is stale if its access tick is not the current access tick
+        # of the key.
+        self._lru = []
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        """ Stop governing all items """
+        self._items.clear()
+        self._lru = []
+        self.size = 0
+
+    def _push(self, key):
+        """ Record an access of the given key in the LRU heap """
+        self._tick += 1
+        self._items[key][1] = self._tick
+        heapq.heappush(self._lru, (self._tick, key))
+        if len(self._lru) > 2 * len(self._items) + 64:
+            # too many stale entries, rebuild the heap
+            self._lru = [(item[1], k) for k, item in self._items.items()]
+            heapq.heapify(self._lru)
+
+    def add(self, key, value, size=None):
+        """ Start governing a new or replaced item.  If ``max_size``
+        is set and the size of the item is not given, it is
+        calculated with :func:`_sizeof`. """
+        self.remove(key)
+        if not self.max_size:
+            size = 0
+        elif size is None:
+            size = _sizeof(value)
+        self._items[key] = [time.time(), 0, size]
+        self.size += size
+        self._push(key)
+
+    def remove(self, key):
+        """ Stop governing an item """
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+
+    def touch(self, key):
+        """ Record that an item was accessed """
+        if key in self._items:
+            self._push(key)
+
+    def age(self, key):
+        """ Get the age of an item, in seconds """
+        return time.time() - self._items[key][0]
+
+    def is_stale(self, key):
+        """ Determine if an item has outlived ``max_age`` """
+        return (self.max_age is not None and key in self._items and
+                self.age(key) > self.max_age)
+
+    def overflow(self):
+        """ Get a list of ``(key, age)`` tuples for the least recently
+        used items that must be evicted in order to satisfy
+        ``max_entries`` and ``max_size``.  The items are no longer
+        governed by the policy after they are returned. """
+        rv = []
+        while self._lru and self._over_limit():
+            tick, key = heapq.heappop(self._lru)
+            if key in self._items and self._items[key][1] == tick:
+                rv.append((key, self.age(key)))
+                self.remove(key)
+        return rv
+
+    def _over_limit(self):
+        """ True if the namespace holds too many or too large items """
+        return ((self.max_entries is not None and
+                 len(self._items) > self.max_entries) or
+                (self.max_size is not None and self.size > self.max_size))
+
+    def __repr__(self):
+        return "%s(%s, max_entries=%s, max_age=%s, max_size=%s)" % (
+            self.__class__.__name__, self.namespace, self.max_entries,
+            self.max_age, self.max_size)
+
+
 class _CacheRegistry(dict):
     """ The grand unified cache backend which contains all cache
-    items. """
+    items.
+
+    In addition to the items themselves, the registry maintains an
+    inverted index of tag => set of keys carrying that tag.  The
+    index is updated whenever an item is added or removed, so that
+    :func:`iterate` and :func:`iter_all` only have to look at the
+    keys that share a tag with the query, rather than scanning the
+    whole cache.
+
+    The registry also enforces any
+    :class:`Bcfg2.Server.Cache._CachePolicy` objects set with
+    :func:`set_policy`. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+
+        #: Inverted index of ``tag => set of keys`` for every tag
+        #: used in the cache.
+        self._tag_index = dict()
+
+        #: Dict of ``namespace tag => eviction policy``
+        self._policies = dict()
+
+        #: Lock held while the registry and its index are modified,
+        #: so the two never get out of sync
+        self._lock = threading.RLock()
+        self.update(*args, **kwargs)
+
+    def _index(self, key):
+        """ Add a new key to the tag index """
+        for tag in key:
+            self._tag_index.setdefault(tag, set()).add(key)
+
+    def _unindex(self, key):
+        """ Remove a key from the tag index and from all policies """
+        for tag in key:
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+            if tag in self._policies:
+                self._policies[tag].remove(key)
+
+    def _get_policies(self, key):
+        """ Get a list of all policies that govern the given key """
+        if not self._policies:
+            return []
+        return [self._policies[tag] for tag in key if tag in self._policies]
+
+    def _evict(self, policy, key, age):
+        """ Evict a single item that is governed by the given policy,
+        recording the age of the item in
+        :mod:`Bcfg2.Server.Statistics` """
+        self._discard(key)
+        Bcfg2.Server.Statistics.stats.add_value(
+            "Cache:%s:eviction" % policy.namespace, age)
+
+    def _discard(self, key):
+        """ Remove an item from the registry if it is present """
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+            self._unindex(key)
+
+    def set_policy(self, namespace, max_entries=None, max_age=None,
+                   max_size=None):
+        """ Set the eviction policy for items tagged with the given
+        namespace tag.  If no limits are given, any existing policy
+        for the namespace is removed.  See
+        :class:`Bcfg2.Server.Cache._CachePolicy` for details on the
+        arguments. """
+        self._lock.acquire()
+        try:
+            if max_entries is None and max_age is None and max_size is None:
+                self._policies.pop(namespace, None)
+                return
+            policy = _CachePolicy(namespace, max_entries=max_entries,
+                                  max_age=max_age, max_size=max_size)
+            self._policies[namespace] = policy
+            for key in self._tag_index.get(namespace, set()):
+                policy.add(key, dict.__getitem__(self, key))
+            self._enforce(policy)
+        finally:
+            self._lock.release()
+
+    def get_policy(self, namespace):
+        """ Get the eviction policy for the given namespace tag, or
+        None if there is no policy """
+        return self._policies.get(namespace)
+
+    def _enforce(self, policy):
+        """ Evict items until the given policy is satisfied """
+        for key, age in policy.overflow():
+            self._evict(policy, key, age)
+
+    def __setitem__(self, key, value):
+        # the size of the value is calculated before the lock is
+        # taken, since it can be comparatively expensive
+        size = None
+        for policy in self._get_policies(key):
+            if policy.max_size:
+                size = _sizeof(value)
+                break
+        self._lock.acquire()
+        try:
+            if not dict.__contains__(self, key):
+                self._index(key)
+            dict.__setitem__(self, key, value)
+            for policy in self._get_policies(key):
+                policy.add(key, value, size=size)
+                self._enforce(policy)
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            rv = dict.__getitem__(self, key)
+            for policy in self._get_policies(key):
+                if policy.is_stale(key):
+                    self._evict(policy, key, policy.age(key))
+                    raise KeyError(key)
+                policy.touch(key)
+            return rv
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            if not dict.__contains__(self, key):
+                return False
+            for policy in self._get_policies(key):
+                if policy.is_stale(key):
+                    self._evict(policy, key, policy.age(key))
+                    return False
+            return True
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            dict.__delitem__(self, key)
+            self._unindex(key)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, *args):
+        self._lock.acquire()
+        try:
+            if dict.__contains__(self, key):
+                self._unindex(key)
+            return dict.pop(self, key, *args)
+        finally:
+            self._lock.release()
+
+    def popitem(self):
+        self._lock.acquire()
+        try:
+            key, value = dict.popitem(self)
+            self._unindex(key)
+            return (key, value)
+        finally:
+            self._lock.release()
+
+    def setdefault(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self:
+                self[key] = default
+            return self[key]
+        finally:
+            self._lock.release()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            dict.clear(self)
+            self._tag_index.clear()
+            for policy in self._policies.values():
+                policy.clear()
+        finally:
+            self._lock.release()
+
+    def _candidates(self, tags):
+        """ Get a list of keys that might match the given (frozenset
+        of) tags, using the smallest set of keys in the tag index
+        that is associated with any of the tags.  Every key that
+        matches all of the tags is guaranteed to be in the list, but
+        not every key in the list necessarily matches all of the
+        tags. """
+        self._lock.acquire()
+        try:
+            if not tags:
+                return list(self.keys())
+            smallest = None
+            for tag in tags:
+                keys = self._tag_index.get(tag)
+                if not keys:
+                    return []
+                if smallest is None or len(keys) < len(smallest):
+                    smallest = keys
+            return list(smallest)
+        finally:
+            self._lock.release()
 
     def iterate(self, *tags):
         """ Iterate over all items that match the given tags *and*
@@ -123,8 +537,10 @@ class _CacheRegistry(dict):
         for :class:`Bcfg2.Server.Cache._Cache` objects that have been
         instantiated via :func:`Bcfg2.Server.Cache.Cache`. """
         tags = frozenset(tags)
-        for key in self.keys():
-            if key.issuperset(tags) and len(key.difference(tags)) == 1:
+        length = len(tags) + 1
+        for key in self._candidates(tags):
+            if (len(key) == length and key.issuperset(tags) and
+                    key in self):
                 yield key
 
     def iter_all(self, *tags):
@@ -133,19 +549,48 @@ class _CacheRegistry(dict):
         have). This is used to expire all cache data that matches a
         set of tags. """
         tags = frozenset(tags)
-        for key in list(self.keys()):
+        for key in self._candidates(tags):
             if key.issuperset(tags):
                 yield key
 
 
 _cache = _CacheRegistry()  # pylint: disable=C0103
 _hooks = []  # pylint: disable=C0103
+_derived = set()  # pylint: disable=C0103
 
 
 def Cache(*tags):  # pylint: disable=C0103
     """ A dict interface to the cache data tagged with the given
-    tags. """
-    return _Cache(_cache, frozenset(tags))
+    tags.  The first tag is used as the namespace under which cache
+    hits and misses are recorded. """
+    if tags:
+        namespace = tags[0]
+    else:
+        namespace = None
+    return _Cache(_cache, frozenset(tags), namespace=namespace)
+
+
+def set_policy(namespace, max_entries=None, max_age=None, max_size=None):
+    """ Set the eviction policy for all cache items tagged with the
+    given namespace tag.  If no limits are given, the policy for the
+    namespace is removed and its items live until they are expired.
+
+    :param namespace: The namespace tag, e.g., ``Metadata``
+    :type namespace: string
+    :param max_entries: The maximum number of items in the namespace.
+                        The least recently used items are evicted
+                        first.
+    :type max_entries: int
+    :param max_age: The maximum number of seconds an item stays in
+                    the cache after it was stored.
+    :type max_age: int or float
+    :param max_size: The approximate maximum number of bytes used by
+                     items in the namespace.  The least recently used
+                     items are evicted first.
+    :type max_size: int
+    """
+    _cache.set_policy(namespace, max_entries=max_entries, max_age=max_age,
+                      max_size=max_size)
 
 
 def expire(*tags, **kwargs):
@@ -178,3 +623,38 @@ def add_expire_hook(func):
     state of the ``exact`` flag (True or False); and the third will be
     the number of items that were expired from the cache. """
     _hooks.append(func)
+
+
+def remove_expire_hook(func):
+    """ Remove a hook added with :func:`add_expire_hook`.  Nothing
+    happens if the hook was never added. """
+    if func in _hooks:
+        _hooks.remove(func)
+
+
+def add_derived(*tags):
+    """ Declare that cache items tagged with all of the given tags
+    only hold data that is derived from other data, e.g., rendered
+    templates or bound entries.  Expiring such items does not mean
+    that anything they were derived from has changed, so expire hooks
+    that react to changes in the underlying data can ignore them by
+    checking :func:`is_derived`. """
+    _derived.add(frozenset(tags))
+
+
+def is_derived(tags):
+    """ Determine if the given tag set, as passed to an expire hook,
+    only covers items declared derived with :func:`add_derived`. """
+    tags = frozenset(tags)
+    for derived in _derived:
+        if derived.issubset(tags):
+            return True
+    return False
+
+
+def after_fork():
+    """ Reset the cache lock in a newly forked child process.  Another
+    thread in the parent may have held the lock at the time of the
+    fork, and that thread does not exist in the child to release it.
+    """
+    _cache._lock = threading.RLock()  # pylint: disable=W0212
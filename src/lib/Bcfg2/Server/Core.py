@@ -3,7 +3,9 @@ implementations inherit from. """
 
 import os
 import pwd
+import copy
 import atexit
+import hashlib
 import logging
 import select
 import sys
@@ -16,13 +18,16 @@ import Bcfg2.Server
 import Bcfg2.Logger
 import Bcfg2.Options
 import Bcfg2.DBSettings
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Statistics
 import Bcfg2.Server.FileMonitor
 from itertools import chain
 from Bcfg2.Server.Cache import Cache
-from Bcfg2.Compat import xmlrpclib, wraps  # pylint: disable=W0622
+from Bcfg2.Compat import xmlrpclib, wraps, md5, long, Queue, \
+    unicode  # pylint: disable=W0622
 from Bcfg2.Server.Plugin.exceptions import *  # pylint: disable=W0401,W0614
 from Bcfg2.Server.Plugin.interfaces import *  # pylint: disable=W0401,W0614
+from Bcfg2.Server.Plugin.helpers import FileBacked
 from Bcfg2.Server.Statistics import track_statistics
 
 try:
@@ -75,6 +80,66 @@ def sort_xml(node, key=None):
     node[:] = sorted_children
 
 
+def _fingerprint_data(value, seen=None):
+    """ Get a representation of the given value that is stable across
+    calls and suitable for hashing with :func:`metadata_fingerprint`.
+    Dicts, lists, tuples and sets are recursed into and sorted as
+    appropriate; XML elements are serialized; and file-backed objects
+    (e.g., Properties files) are represented by their path and file
+    contents.
+
+    :raises: TypeError - if the value contains an object whose
+             contents cannot be fingerprinted
+    """
+    if seen is None:
+        seen = set()
+    if value is None or isinstance(value, (bool, int, float, long,
+                                           str, unicode)):
+        return value
+    if id(value) in seen:
+        return "<recursion>"
+    seen.add(id(value))
+    try:
+        if isinstance(value, dict):
+            return sorted([(repr(_fingerprint_data(k, seen)),
+                            _fingerprint_data(v, seen))
+                           for k, v in value.items()])
+        elif isinstance(value, (list, tuple)):
+            return [_fingerprint_data(v, seen) for v in value]
+        elif isinstance(value, (set, frozenset)):
+            return sorted(repr(_fingerprint_data(v, seen)) for v in value)
+        elif isinstance(value, lxml.etree._Element):
+            return lxml.etree.tostring(value)
+        elif isinstance(value, FileBacked):
+            return ("%s.%s" % (value.__class__.__module__,
+                               value.__class__.__name__),
+                    value.name, value.data)
+        else:
+            raise TypeError("Cannot fingerprint %s.%s object" %
+                            (value.__class__.__module__,
+                             value.__class__.__name__))
+    finally:
+        seen.discard(id(value))
+
+
+def metadata_fingerprint(metadata):
+    """ Get a fingerprint of a client metadata object that changes
+    whenever the data in the metadata object changes -- groups,
+    bundles, profile, connector data (e.g., probe data), and so on.
+    The :attr:`Bcfg2.Server.Plugins.Metadata.ClientMetadata.query`
+    object is not included.
+
+    :param metadata: The client metadata to fingerprint
+    :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+    :returns: string - a hex digest
+    :raises: TypeError - if the metadata contains connector data that
+             cannot be fingerprinted
+    """
+    data = dict((key, value) for key, value in vars(metadata).items()
+                if key not in ['query', 'version_info'])
+    return md5(repr(_fingerprint_data(data)).encode('UTF-8')).hexdigest()
+
+
 def close_db_connection(func):
     """ Decorator that closes the Django database connection at the end of
     the function.  This should decorate any exposed function that
@@ -83,15 +148,7 @@ def close_db_connection(func):
     def inner(self, *args, **kwargs):
         """ The decorated function """
         rv = func(self, *args, **kwargs)
-        if self._database_available:  # pylint: disable=W0212
-            self.logger.debug("%s: Closing database connection" %
-                              threading.current_thread().getName())
-
-            if django.VERSION[0] == 1 and django.VERSION[1] >= 7:
-                for connection in django.db.connections.all():
-                    connection.close()
-            else:
-                django.db.close_connection()  # pylint: disable=E1101
+        self._close_db_connections()  # pylint: disable=W0212
         return rv
 
     return inner
@@ -151,12 +208,46 @@ class Core(object):
         Bcfg2.Options.Option(
             cf=('caching', 'client_metadata'), dest='client_metadata_cache',
             default='off',
-            choices=['off', 'on', 'initial', 'cautious', 'aggressive'])]
+            choices=['off', 'on', 'initial', 'cautious', 'aggressive']),
+        Bcfg2.Options.BooleanOption(
+            cf=('caching', 'configuration'), dest='config_cache',
+            default=False,
+            help="Cache rendered client configurations until the client "
+            "metadata or the repository changes"),
+        Bcfg2.Options.BooleanOption(
+            cf=('caching', 'binding'), dest='binding_cache',
+            default=False,
+            help="Bind host-independent entries once and share them "
+            "between clients with the same groups"),
+        Bcfg2.Options.Option(
+            cf=('server', 'bind_threads'), dest='bind_threads', type=int,
+            default=1,
+            help="Number of threads used to bind the entries in a single "
+            "client configuration"),
+        Bcfg2.Options.WildcardSectionGroup(
+            Bcfg2.Options.Option(
+                cf=('caching:*', 'max_entries'), type=int,
+                help="Maximum number of cached items in the namespace"),
+            Bcfg2.Options.Option(
+                cf=('caching:*', 'max_age'),
+                type=Bcfg2.Options.Types.timeout,
+                help="Maximum age in seconds of cached items in the "
+                "namespace"),
+            Bcfg2.Options.Option(
+                cf=('caching:*', 'max_size'), type=Bcfg2.Options.Types.size,
+                help="Approximate maximum size of all cached items in the "
+                "namespace"),
+            prefix="", dest="cache_namespaces")]
 
     #: The name of this server core. This can be overridden by core
     #: implementations to provide a more specific name.
     name = "Core"
 
+    #: The reply to ``GetConfig`` when the client already has the
+    #: current configuration.  See
+    #: :func:`RenderConfigurationIfModified`.
+    unmodified_config = '<Configuration unmodified="true"/>'
+
     def __init__(self):  # pylint: disable=R0912,R0915
         """
         .. automethod:: _run
@@ -265,6 +356,49 @@ class Core(object):
         #: A :class:`Bcfg2.Server.Cache.Cache` object for caching client
         #: metadata
         self.metadata_cache = Cache("Metadata")
+        self._set_cache_policies()
+
+        #: A counter that is incremented whenever cached data that is
+        #: not specific to a single client is expired.  Along with the
+        #: FAM :attr:`Bcfg2.Server.FileMonitor.FileMonitor.generation`,
+        #: this is used to determine if cached rendered configurations
+        #: are still valid.
+        self.cache_generation = 0
+        Bcfg2.Server.Cache.add_expire_hook(self._expire_hook)
+        Bcfg2.Server.Cache.add_derived("Configuration")
+        Bcfg2.Server.Cache.add_derived("Binding")
+
+        #: The :func:`_cache_generation_key` that entries in the
+        #: shared binding cache were bound under
+        self._binding_generation = None
+
+        #: The queue of entries waiting to be bound by the
+        #: ``bind_threads`` worker threads
+        self._bind_queue = Queue()
+
+        #: The worker threads that bind entries when ``bind_threads``
+        #: is greater than 1.  They are started the first time they
+        #: are needed.
+        self._bind_workers = []
+
+        #: The sorted list of loaded generator plugins, or None if it
+        #: needs to be recalculated
+        self._generators = None
+
+        #: An index of (entry tag, entry name) -> list of generators
+        #: that list the entry in their ``Entries`` dicts.  It is
+        #: filled in as entries are bound, and dropped when the FAM
+        #: generation changes or plugins are loaded.
+        self._generator_index = dict()
+
+        #: A set of (generator name, entry tag, entry name) tuples for
+        #: which :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`
+        #: returned False.  This is dropped along with
+        #: :attr:`_generator_index`.
+        self._handles_entry_misses = set()
+
+        #: The FAM generation :attr:`_generator_index` was built for
+        self._generator_index_generation = None
 
         #: Whether or not it's possible to use the Django database
         #: backend for plugins that have that capability
@@ -285,6 +419,43 @@ class Core(object):
     def __str__(self):
         return self.__class__.__name__
 
+    def _set_cache_policies(self):
+        """ Set eviction policies for the unified
+        :mod:`Bcfg2.Server.Cache` from the ``[caching:<namespace>]``
+        sections of the config file. """
+        for section in Bcfg2.Options.setup.cache_namespaces:
+            namespace = section.split(":", 1)[1]
+            # WildcardSectionGroup mangles the section name into the
+            # option destinations the same way
+            prefix = "%s_" % \
+                Bcfg2.Options.WildcardSectionGroup._dest_re.sub('_', section)
+            policy = dict()
+            for attr in ["max_entries", "max_age", "max_size"]:
+                policy[attr] = getattr(Bcfg2.Options.setup, prefix + attr,
+                                       None)
+            self.logger.debug("Setting cache policy for %s: %s" %
+                              (namespace, policy))
+            Bcfg2.Server.Cache.set_policy(namespace, **policy)
+
+    def _expire_hook(self, tags, exact, count):  # pylint: disable=W0613
+        """ Hook called when data is expired from the unified cache.
+        If the expired data was not specific to a single client or
+        derived from other data (see
+        :func:`Bcfg2.Server.Cache.add_derived`), increment
+        :attr:`cache_generation` so that all cached rendered
+        configurations are invalidated.  This is done even if nothing
+        was expired from the cache, since plugins also expire tags to
+        announce that data they keep elsewhere has changed. """
+        if Bcfg2.Server.Cache.is_derived(tags):
+            return
+        if self.metadata is not None:
+            clients = getattr(self.metadata, "clients", [])
+            if [t for t in tags if t in clients]:
+                # per-client data is covered by the metadata
+                # fingerprint
+                return
+        self.cache_generation += 1
+
     def plugins_by_type(self, base_cls):
         """ Return a list of loaded plugins that match the passed type.
 
@@ -409,6 +580,7 @@ class Core(object):
         # ensure that an ACL plugin is loaded
         if not self.plugins_by_type(Bcfg2.Server.Plugin.ClientACLs):
             self.init_plugin(DefaultACL)
+        self._generators = None
 
     def init_plugin(self, plugin):
         """ Import and instantiate a single plugin.  The plugin is
@@ -423,6 +595,7 @@ class Core(object):
         cplugs = [conflict for conflict in plugin.conflicts
                   if conflict in self.plugins]
         self.plugin_blacklist[plugin.name] = cplugs
+        self._generators = None
         try:
             self.plugins[plugin.name] = plugin(self)
         except PluginInitError:
@@ -446,6 +619,7 @@ class Core(object):
         if not self.terminate.isSet():
             self.terminate.set()
         self._running = False
+        self._stop_bind_workers()
         self.fam.shutdown()
         self.logger.info("%s: FAM shut down" % self.name)
         for plugin in list(self.plugins.values()):
@@ -586,6 +760,17 @@ class Core(object):
         :type config: lxml.etree._Element
         """
         self.logger.debug("Binding structures for %s" % metadata.hostname)
+        if Bcfg2.Options.setup.bind_threads > 1:
+            # bind the entries from all structures in one batch, so
+            # that the worker threads are kept busy even if the
+            # client has many small bundles
+            entries = []
+            for astruct in structures:
+                entries.extend(self._get_unbound_entries(astruct))
+            self._bind_entries(entries, metadata)
+            for astruct in structures:
+                config.append(astruct)
+            return
         for astruct in structures:
             try:
                 self.BindStructure(astruct, metadata)
@@ -605,22 +790,131 @@ class Core(object):
         self.logger.debug("Binding structure %s for %s" %
                           (structure.get("name", "unknown"),
                            metadata.hostname))
+        self._bind_entries(self._get_unbound_entries(structure), metadata)
+
+    def _get_unbound_entries(self, structure):
+        """ Get the entries in a structure that still need to be
+        bound.  Entries that were already bound by the structure
+        plugin (i.e., ``Bound*`` entries) are renamed to the plain
+        entry tag and skipped.
+
+        :param structure: The structure to get entries from
+        :type structures: lxml.etree._Element
+        :returns: list of lxml.etree._Element objects
+        """
+        rv = []
         for entry in structure.getchildren():
             if entry.tag.startswith("Bound"):
                 entry.tag = entry.tag[5:]
-                continue
+            else:
+                rv.append(entry)
+        return rv
+
+    def _bind_entries(self, entries, metadata):
+        """ Bind a list of entries.  If ``bind_threads`` is greater
+        than 1, the entries are bound concurrently by a pool of worker
+        threads.  Each worker binds a copy of an entry, and the copies
+        then replace the original entries in order, so the result is
+        the same as binding the entries one at a time.
+
+        :param entries: The entries to bind.  Modified in-place.
+        :type entries: list of lxml.etree._Element objects
+        :param metadata: Client metadata to bind the entries for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        if Bcfg2.Options.setup.bind_threads <= 1 or len(entries) < 2:
+            for entry in entries:
+                self._bind_entry(entry, metadata)
+            return
+
+        self._start_bind_workers()
+        bound = [None] * len(entries)
+        remaining = [len(entries)]
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def bind(idx):
+            """ Bind a copy of a single entry in a worker thread """
             try:
-                self.Bind(entry, metadata)
-            except:
-                exc = sys.exc_info()[1]
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % exc)
-                if isinstance(exc, PluginExecutionError):
-                    msg = "Failed to bind entry"
-                else:
-                    msg = "Unexpected failure binding entry"
-                self.logger.error("%s %s:%s: %s" %
-                                  (msg, entry.tag, entry.get('name'), exc))
+                entry = copy.deepcopy(entries[idx])
+                self._bind_entry(entry, metadata)
+                bound[idx] = entry
+            finally:
+                lock.acquire()
+                try:
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        finished.set()
+                finally:
+                    lock.release()
+
+        for idx in range(len(entries)):
+            self._bind_queue.put((bind, idx))
+        finished.wait()
+        for entry, new in zip(entries, bound):
+            if new is not None:
+                entry.getparent().replace(entry, new)
+
+    def _bind_entry(self, entry, metadata):
+        """ Bind a single entry, flagging it with a ``failure``
+        attribute if binding fails.
+
+        :param entry: The entry to bind.  Modified in-place.
+        :type entry: lxml.etree._Element
+        :param metadata: Client metadata to bind the entry for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        try:
+            self.Bind(entry, metadata)
+        except:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % exc)
+            if isinstance(exc, PluginExecutionError):
+                msg = "Failed to bind entry"
+            else:
+                msg = "Unexpected failure binding entry"
+            self.logger.error("%s %s:%s: %s" %
+                              (msg, entry.tag, entry.get('name'), exc))
+
+    def _start_bind_workers(self):
+        """ Start the ``bind_threads`` worker threads, if they are not
+        already running. """
+        self._bind_workers = [t for t in self._bind_workers if t.is_alive()]
+        if self._bind_workers:
+            return
+        # a forked child can inherit the queue, but not the threads
+        self._bind_queue = Queue()
+        for num in range(Bcfg2.Options.setup.bind_threads):
+            worker = threading.Thread(name="BindThread-%s" % num,
+                                      target=self._bind_worker)
+            worker.daemon = True
+            worker.start()
+            self._bind_workers.append(worker)
+
+    def _stop_bind_workers(self):
+        """ Stop the ``bind_threads`` worker threads. """
+        for _ in self._bind_workers:
+            self._bind_queue.put(None)
+        for worker in self._bind_workers:
+            worker.join()
+        self._bind_workers = []
+
+    def _bind_worker(self):
+        """ The thread that binds entries from :attr:`_bind_queue`.
+        The workers are long-lived, rather than started for each
+        client, so that elements created while binding are not owned
+        by threads that have exited. """
+        while True:
+            task = self._bind_queue.get()
+            if task is None:
+                break
+            func, idx = task
+            try:
+                func(idx)
+            except:  # pylint: disable=W0702
+                self.logger.error("Unexpected failure in bind thread: %s" %
+                                  sys.exc_info()[1], exc_info=1)
 
     def Bind(self, entry, metadata):
         """ Bind a single entry using the appropriate generator.
@@ -650,21 +944,26 @@ class Core(object):
                 self.logger.error("Falling back to %s:%s" %
                                   (entry.tag, entry.get('name')))
 
-        generators = self.plugins_by_type(Generator)
-        glist = [gen for gen in generators
-                 if entry.get('name') in gen.Entries.get(entry.tag, {})]
+        generators = self._update_generator_index()
+        key = (entry.tag, entry.get('name'))
+        glist = self._generator_index.get(key)
+        if glist is None:
+            glist = [gen for gen in generators
+                     if key[1] in gen.Entries.get(key[0], {})]
+            self._generator_index[key] = glist
         if len(glist) == 1:
-            return glist[0].Entries[entry.tag][entry.get('name')](entry,
-                                                                  metadata)
+            bind = glist[0].Entries[entry.tag][entry.get('name')]
+            return self.bind_shared(glist[0], bind, entry, metadata)
         elif len(glist) > 1:
-            generators = ", ".join([gen.name for gen in glist])
             self.logger.error("%s %s served by multiple generators: %s" %
-                              (entry.tag, entry.get('name'), generators))
+                              (entry.tag, entry.get('name'),
+                               ", ".join([gen.name for gen in glist])))
         g2list = [gen for gen in generators
-                  if gen.HandlesEntry(entry, metadata)]
+                  if self._handles_entry(gen, entry, metadata)]
         try:
             if len(g2list) == 1:
-                return g2list[0].HandleEntry(entry, metadata)
+                return self.bind_shared(g2list[0], g2list[0].HandleEntry,
+                                        entry, metadata)
             entry.set('failure', 'no matching generator')
             raise PluginExecutionError("No matching generator: %s:%s" %
                                        (entry.tag, entry.get('name')))
@@ -674,24 +973,128 @@ class Core(object):
                                                      entry.tag),
                                                     time.time() - start)
 
-    def BuildConfiguration(self, client):
+    def _update_generator_index(self):
+        """ Get the list of loaded generator plugins, and drop the
+        generator dispatch index and the cache of negative
+        :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`
+        results if they are out of date.  Plugins only change their
+        ``Entries`` dicts when they are loaded or when they handle a
+        FAM event, so the index is valid as long as the set of plugins
+        and the FAM generation stay the same.
+
+        :returns: list of
+                  :class:`Bcfg2.Server.Plugin.interfaces.Generator`
+                  objects
+        """
+        generators = self._generators
+        if (generators is None or
+                self._generator_index_generation != self.fam.generation):
+            generators = self.plugins_by_type(Generator)
+            self._generator_index = dict()
+            self._handles_entry_misses = set()
+            self._generator_index_generation = self.fam.generation
+            self._generators = generators
+        return generators
+
+    def _handles_entry(self, generator, entry, metadata):
+        """ Call
+        :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`,
+        caching negative results for generators whose decision depends
+        only on the tag and name of the entry (see
+        :attr:`Bcfg2.Server.Plugin.interfaces.Generator.handles_entry_by_name`).
+
+        :param generator: The generator to ask
+        :type generator: Bcfg2.Server.Plugin.interfaces.Generator
+        :param entry: The entry to bind
+        :type entry: lxml.etree._Element
+        :param metadata: Client metadata to bind the entry for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: bool
+        """
+        if not generator.handles_entry_by_name:
+            return generator.HandlesEntry(entry, metadata)
+        key = (generator.name, entry.tag, entry.get('name'))
+        if key in self._handles_entry_misses:
+            return False
+        if generator.HandlesEntry(entry, metadata):
+            return True
+        self._handles_entry_misses.add(key)
+        return False
+
+    def bind_shared(self, generator, bind, entry, metadata):
+        """ Bind a single entry with the given generator callable.  If
+        the ``[caching] binding`` option is enabled and the generator
+        declares the entry host-independent (see
+        :func:`Bcfg2.Server.Plugin.interfaces.Generator.is_host_independent`),
+        the bound entry is cached and shared with all other clients
+        that have the same groups, and ``bind`` is only called once
+        per group set until the repository changes.  Unbound entries
+        with child elements are always bound for each client.
+
+        :param generator: The generator plugin that binds the entry
+        :type generator: Bcfg2.Server.Plugin.interfaces.Generator
+        :param bind: The callable that binds the entry.  It will be
+                     called with ``entry`` and ``metadata``.
+        :type bind: callable
+        :param entry: The entry to bind.  Modified in-place.
+        :type entry: lxml.etree._Element
+        :param metadata: Client metadata to bind the entry for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        if (not Bcfg2.Options.setup.binding_cache or len(entry) or
+                not generator.is_host_independent(entry, metadata)):
+            return generator.timed_bind(bind, entry, metadata)
+
+        generation = self._cache_generation_key()
+        if generation != self._binding_generation:
+            # drop entries bound against an older repository
+            Bcfg2.Server.Cache.expire("Binding")
+            self._binding_generation = generation
+        cache = Cache("Binding")
+        # the unbound entry is identified by its tag and attributes:
+        # the name, and any others set by the structure (e.g.,
+        # realname for altsrc)
+        key = (generator.name, entry.tag,
+               tuple(sorted(entry.attrib.items())),
+               frozenset(metadata.groups))
+        bound = cache.get(key)
+        if bound is None:
+            rv = generator.timed_bind(bind, entry, metadata)
+            if 'failure' not in entry.attrib:
+                cache[key] = copy.deepcopy(entry)
+            return rv
+
+        entry.attrib.clear()
+        entry.attrib.update(bound.attrib)
+        entry.text = bound.text
+        entry[:] = [copy.deepcopy(child) for child in bound]
+        return entry
+
+    def BuildConfiguration(self, client, metadata=None):
         """ Build the complete configuration for a client.
 
         :param client: The hostname of the client to build the
                        configuration for
         :type client: string
+        :param metadata: The client metadata, if the caller has
+                         already built it.  If this is not given, it
+                         is built with :func:`build_metadata`.
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: :class:`lxml.etree._Element` - A complete Bcfg2
                   configuration document """
         self.logger.debug("Building configuration for %s" % client)
         start = time.time()
         config = lxml.etree.Element("Configuration", version='2.0',
                                     revision=str(self.revision))
-        try:
-            meta = self.build_metadata(client)
-        except MetadataConsistencyError:
-            self.logger.error("Metadata consistency error for client %s" %
-                              client)
-            return lxml.etree.Element("error", type='metadata error')
+        if metadata is not None:
+            meta = metadata
+        else:
+            try:
+                meta = self.build_metadata(client)
+            except MetadataConsistencyError:
+                self.logger.error("Metadata consistency error for client "
+                                  "%s" % client)
+                return lxml.etree.Element("error", type='metadata error')
 
         self.client_run_hook("start_client_run", meta)
 
@@ -728,6 +1131,113 @@ class Core(object):
                          (client, time.time() - start))
         return config
 
+    def _config_cache_key(self, metadata):
+        """ Get the key used to look up a cached rendered
+        configuration for a client.  This changes whenever the client
+        metadata, the VCS revision, or the repository change.
+
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: string
+        :raises: TypeError - if the metadata cannot be fingerprinted
+        """
+        return "%s:%s" % (metadata_fingerprint(metadata),
+                          self._cache_generation_key())
+
+    def _cache_generation_key(self):
+        """ Get a string that changes whenever the VCS revision or
+        anything in the repository changes.
+
+        :returns: string
+        """
+        return "%s:%s:%s" % (self.revision, self.fam.generation,
+                             self.cache_generation)
+
+    @track_statistics()
+    def RenderConfiguration(self, client):
+        """ Build the complete configuration for a client with
+        :func:`BuildConfiguration` and serialize it.  If the
+        ``[caching] configuration`` option is set, the serialized
+        configuration is cached, and returned without being rebuilt
+        until the client metadata or anything in the repository
+        changes.  Configurations with entries that failed to bind are
+        never cached.  Client run hooks are called either way.
+
+        :param client: The hostname of the client to build the
+                       configuration for
+        :type client: string
+        :returns: string - The serialized configuration document
+        """
+        key = None
+        meta = None
+        if Bcfg2.Options.setup.config_cache:
+            try:
+                meta = self.build_metadata(client)
+            except MetadataConsistencyError:
+                # BuildConfiguration() reports the error
+                pass
+            if meta is not None:
+                try:
+                    key = self._config_cache_key(meta)
+                except TypeError:
+                    self.logger.debug("Not caching configuration for %s: "
+                                      "%s" % (client, sys.exc_info()[1]))
+            if key is not None:
+                cache = Cache("Configuration", client)
+                cached = cache.get(key)
+                if cached is not None:
+                    start = time.time()
+                    self.client_run_hook("start_client_run", meta)
+                    self.client_run_hook("end_client_run", meta)
+                    self.logger.info("Using cached config for %s (%.03f "
+                                     "seconds)" % (client,
+                                                   time.time() - start))
+                    return cached
+
+        config = self.BuildConfiguration(client, metadata=meta)
+        rv = lxml.etree.tostring(config, xml_declaration=False).decode('UTF-8')
+        if (key is not None and config.tag == "Configuration" and
+                not config.xpath("//*[@failure]")):
+            # drop configs cached for this client with older keys
+            cache.expire()
+            cache[key] = rv
+        return rv
+
+    def RenderConfigurationIfModified(self, client, digest=None,
+                                      revision=None):
+        """ Render the configuration for a client with
+        :func:`RenderConfiguration`, unless the client already has
+        it.  If the client sent the SHA-256 digest and ``revision``
+        attribute of the configuration it got last time, and the
+        configuration rendered now has the same revision and digest,
+        :attr:`unmodified_config` is returned instead of the full
+        document.  Client run hooks are called either way.
+
+        :param client: The hostname of the client to build the
+                       configuration for
+        :type client: string
+        :param digest: The SHA-256 hex digest of the configuration
+                       the client already has
+        :type digest: string
+        :param revision: The ``revision`` attribute of the
+                         configuration the client already has
+        :type revision: string
+        :returns: string - The serialized configuration document, or
+                  :attr:`unmodified_config`
+        """
+        rv = self.RenderConfiguration(client)
+        if digest and revision == str(self.revision):
+            unmodified = \
+                hashlib.sha256(rv.encode('UTF-8')).hexdigest() == digest
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:GetConfig:unmodified" % self.__class__.__name__,
+                int(unmodified))
+            if unmodified:
+                self.logger.info("Configuration for %s is unmodified" %
+                                 client)
+                return self.unmodified_config
+        return rv
+
     def HandleEvent(self, event):
         """ Handle a change in the Bcfg2 config file.
 
@@ -744,6 +1254,7 @@ class Core(object):
             # startup, we don't need to parse them twice.
             return
         Bcfg2.Options.get_parser().reparse()
+        self._set_cache_policies()
         self.metadata_cache.expire()
 
     def block_for_fam_events(self, handle_events=False):
@@ -944,6 +1455,7 @@ class Core(object):
             imd.query.by_name = self.build_metadata
             if self.metadata_cache_mode in ['cautious', 'aggressive']:
                 self.metadata_cache[client_name] = imd
+                self.metadata.index_client(imd)
         else:
             self.logger.debug("Using cached metadata object for %s" %
                               client_name)
@@ -1212,21 +1724,27 @@ class Core(object):
 
     @exposed
     @close_db_connection
-    def GetConfig(self, address):
+    def GetConfig(self, address, digest=None, revision=None):
         """ Build config for a client by calling
-        :func:`BuildConfiguration`.
+        :func:`RenderConfigurationIfModified`.
 
         :param address: Client (address, port) pair
         :type address: tuple
-        :returns: lxml.etree._Element - The full configuration
-                  document for the client
+        :param digest: The SHA-256 hex digest of the configuration
+                       the client already has, if any
+        :type digest: string
+        :param revision: The ``revision`` attribute of the
+                         configuration the client already has, if any
+        :type revision: string
+        :returns: string - The full configuration document for the
+                  client, or :attr:`unmodified_config` if it is
+                  identical to the one the client already has
         :raises: :exc:`xmlrpclib.Fault`
         """
         client = self.resolve_client(address)[0]
         try:
-            config = self.BuildConfiguration(client)
-            return lxml.etree.tostring(config,
-                                       xml_declaration=False).decode('UTF-8')
+            return self.RenderConfigurationIfModified(client, digest,
+                                                      revision)
         except MetadataConsistencyError:
             self.critical_error("Metadata consistency failure for %s" % client)
 
@@ -1265,6 +1783,20 @@ class Core(object):
         otherwise. """
         return self._database_available
 
+    def _close_db_connections(self):
+        """ Close this thread's Django database connections, if the
+        database is available.  They are reopened the next time they
+        are needed. """
+        if self._database_available:
+            self.logger.debug("%s: Closing database connection" %
+                              threading.current_thread().getName())
+
+            if django.VERSION[0] == 1 and django.VERSION[1] >= 7:
+                for connection in django.db.connections.all():
+                    connection.close()
+            else:
+                django.db.close_connection()  # pylint: disable=E1101
+
     @exposed
     def get_statistics(self, _):
         """ Get current statistics about component execution from
@@ -5,15 +5,21 @@ more details. """
 import os
 import sys
 import copy
+import time
+import hashlib
 import logging
+import threading
 import lxml.etree
+from collections import deque
 import Bcfg2.Logger
 import Bcfg2.Options
+import Bcfg2.Server.Statistics
 from M2Crypto import Rand
 from M2Crypto.EVP import Cipher, EVPError
 from Bcfg2.Utils import safe_input
 from Bcfg2.Server import XMLParser
-from Bcfg2.Compat import md5, b64encode, b64decode, StringIO
+from Bcfg2.Server.Cache import Cache
+from Bcfg2.Compat import md5, b64encode, b64decode, StringIO, unicode
 
 #: Constant representing the encryption operation for
 #: :class:`M2Crypto.EVP.Cipher`, which uses a simple integer.  This
@@ -42,6 +48,17 @@ class _OptionContainer(object):
             cf=("encryption", "algorithm"), default="aes_256_cbc",
             type=lambda v: v.lower().replace("-", "_"),
             help="The encryption algorithm to use"),
+        Bcfg2.Options.PathOption(
+            cf=("encryption", "hints"), dest="encryption_hints",
+            default="/var/cache/bcfg2-server/passphrase_hints",
+            help="File to remember which passphrase decrypts which data"),
+        Bcfg2.Options.BooleanOption(
+            cf=("encryption", "cache"), dest="encryption_cache",
+            help="Keep decrypted data in memory"),
+        Bcfg2.Options.Option(
+            cf=("encryption", "cache_size"), dest="encryption_cache_size",
+            type=int, default=1000,
+            help="Number of decrypted strings to keep in memory"),
         Bcfg2.Options.Option(
             cf=("encryption", "*"), dest='passphrases', default=dict(),
             help="Encryption passphrases")]
@@ -51,6 +68,154 @@ Bcfg2.Options.get_parser().add_component(_OptionContainer)
 
 Rand.rand_seed(os.urandom(1024))
 
+LOGGER = logging.getLogger(__name__)
+
+
+def _digest(*parts):
+    """ Get the hex SHA-256 digest of the given strings, separated
+    by null bytes """
+    rv = hashlib.sha256()
+    for i, part in enumerate(parts):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        if i:
+            rv.update(b'\0')
+        rv.update(part)
+    return rv.hexdigest()
+
+
+class PassphraseHints(object):
+    """ A persistent map of the SHA-256 digests of encrypted data to
+    the name of the passphrase that decrypted it, so that
+    :func:`bruteforce_decrypt` can try that passphrase first the next
+    time it sees the same data, even after the server is restarted.
+    The map is kept in the file given by ``[encryption] hints``, with
+    one ``<digest> <passphrase name>`` pair per line.  New hints are
+    appended to the file, and later lines override earlier ones.  The
+    directory the file is in is created if necessary. """
+
+    def __init__(self):
+        #: The file the hints were loaded from
+        self.path = None
+
+        #: A dict of digest -> passphrase name
+        self.hints = dict()
+
+        #: The number of lines in :attr:`path`
+        self.lines = 0
+
+        #: The number of times a hint decrypted data on the first try
+        self.hits = 0
+
+        #: The number of times there was no hint for data, or the
+        #: hint was wrong
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """ Load hints from ``[encryption] hints`` if they have not
+        already been loaded from that file.  The file is rewritten if
+        more than half of its lines have been superseded. """
+        path = Bcfg2.Options.setup.encryption_hints
+        if path == self.path:
+            return
+        self.path = path
+        self.hints = dict()
+        self.lines = 0
+        if not path:
+            return
+        try:
+            for line in open(path):
+                try:
+                    digest, pname = line.split(None, 1)
+                except ValueError:
+                    continue
+                self.hints[digest] = pname.strip()
+                self.lines += 1
+        except IOError:
+            return
+        if self.lines > 2 * len(self.hints):
+            self._write()
+
+    def _makedirs(self):
+        """ Create the directory that :attr:`path` is in, if it does
+        not exist """
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, 448)  # 0700
+
+    def _write(self):
+        """ Write all hints to :attr:`path`, replacing its contents """
+        try:
+            self._makedirs()
+            tmpfile = "%s.%s" % (self.path, os.getpid())
+            hfile = open(tmpfile, 'w')
+            for digest, pname in self.hints.items():
+                hfile.write("%s %s\n" % (digest, pname))
+            hfile.close()
+            os.rename(tmpfile, self.path)
+            self.lines = len(self.hints)
+        except (IOError, OSError):
+            LOGGER.debug("Failed to write passphrase hints to %s: %s" %
+                         (self.path, sys.exc_info()[1]))
+
+    def get(self, digest):
+        """ Get the name of the passphrase that last decrypted data
+        with the given digest, or None if it is not known """
+        self.lock.acquire()
+        try:
+            self._load()
+            return self.hints.get(digest)
+        finally:
+            self.lock.release()
+
+    def record(self, hit):
+        """ Count a use of the hints in :attr:`hits` or
+        :attr:`misses` """
+        self.lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+    def set(self, digest, pname):
+        """ Remember that the named passphrase decrypts data with the
+        given digest """
+        self.lock.acquire()
+        try:
+            self._load()
+            if self.hints.get(digest) == pname:
+                return
+            self.hints[digest] = pname
+            if not self.path:
+                return
+            try:
+                self._makedirs()
+                open(self.path, 'a').write("%s %s\n" % (digest, pname))
+                self.lines += 1
+            except (IOError, OSError):
+                LOGGER.debug("Failed to write passphrase hints to %s: %s" %
+                             (self.path, sys.exc_info()[1]))
+        finally:
+            self.lock.release()
+
+
+#: The :class:`PassphraseHints` used by :func:`bruteforce_decrypt`
+passphrase_hints = PassphraseHints()  # pylint: disable=C0103
+
+#: Decrypted data, keyed by the digest of the algorithm, passphrase,
+#: and encrypted data.  This is only used if ``[encryption] cache`` is
+#: enabled.
+decrypted = Cache("Encryption", "decrypted")  # pylint: disable=C0103
+
+#: The keys in :data:`decrypted`, oldest first, so that the oldest
+#: can be dropped when there are more than ``[encryption] cache_size``
+_decrypted_keys = deque()  # pylint: disable=C0103
+_decrypted_lock = threading.Lock()  # pylint: disable=C0103
+
 
 def _cipher_filter(cipher, instr):
     """ M2Crypto reads and writes file-like objects, so this uses
@@ -126,7 +291,43 @@ def ssl_decrypt(data, passwd, algorithm=None):
     :param algorithm: The cipher algorithm to use
     :type algorithm: string
     :returns: string - The decrypted data
+
+    If ``[encryption] cache`` is enabled, the decrypted data is kept
+    in memory, and decrypting the same data with the same passphrase
+    and algorithm again returns it without calling OpenSSL.  Only the
+    ``[encryption] cache_size`` most recently decrypted strings are
+    kept, so data that was replaced when a file changed is eventually
+    dropped.
     """
+    if algorithm is None:
+        algorithm = Bcfg2.Options.setup.algorithm
+    if not Bcfg2.Options.setup.encryption_cache:
+        return _ssl_decrypt(data, passwd, algorithm)
+    key = _digest(algorithm, passwd, data)
+    try:
+        return decrypted[key]
+    except KeyError:
+        pass
+    rv = _ssl_decrypt(data, passwd, algorithm)
+    _decrypted_lock.acquire()
+    try:
+        if key not in decrypted:
+            decrypted[key] = rv
+            _decrypted_keys.append(key)
+        while len(_decrypted_keys) > \
+                Bcfg2.Options.setup.encryption_cache_size:
+            try:
+                del decrypted[_decrypted_keys.popleft()]
+            except KeyError:
+                pass
+    finally:
+        _decrypted_lock.release()
+    return rv
+
+
+def _ssl_decrypt(data, passwd, algorithm):
+    """ Decrypt openssl-encrypted data without the cache.  See
+    :func:`ssl_decrypt`. """
     # base64-decode the data
     data = b64decode(data)
     salt = data[8:16]
@@ -197,15 +398,48 @@ def bruteforce_decrypt(crypted, passphrases=None, algorithm=None):
     :type algorithm: string
     :returns: string - The decrypted data
     :raises: :class:`M2Crypto.EVP.EVPError`, if the data cannot be decrypted
+
+    When the passphrases from the config are used, the passphrase
+    that last decrypted the same data is tried first (see
+    :class:`PassphraseHints`), and whether or not that worked is
+    counted in :data:`passphrase_hints`.  The time taken is recorded in
+    :mod:`Bcfg2.Server.Statistics` as ``Encryption:bruteforce_decrypt``.
     """
-    if passphrases is None:
-        passphrases = Bcfg2.Options.setup.passphrases.values()
-    for passwd in passphrases:
-        try:
-            return ssl_decrypt(crypted, passwd, algorithm=algorithm)
-        except EVPError:
-            pass
-    raise EVPError("Failed to decrypt")
+    start = time.time()
+    try:
+        if passphrases is not None:
+            for passwd in passphrases:
+                try:
+                    return ssl_decrypt(crypted, passwd, algorithm=algorithm)
+                except EVPError:
+                    pass
+            raise EVPError("Failed to decrypt")
+
+        passphrases = Bcfg2.Options.setup.passphrases
+        digest = _digest(crypted)
+        hint = passphrase_hints.get(digest)
+        if hint in passphrases:
+            try:
+                rv = ssl_decrypt(crypted, passphrases[hint],
+                                 algorithm=algorithm)
+                passphrase_hints.record(True)
+                return rv
+            except EVPError:
+                pass
+        passphrase_hints.record(False)
+        for pname, passwd in passphrases.items():
+            if pname == hint:
+                continue
+            try:
+                rv = ssl_decrypt(crypted, passwd, algorithm=algorithm)
+            except EVPError:
+                continue
+            passphrase_hints.set(digest, pname)
+            return rv
+        raise EVPError("Failed to decrypt")
+    finally:
+        Bcfg2.Server.Statistics.stats.add_value(
+            "Encryption:bruteforce_decrypt", time.time() - start)
 
 
 def print_xml(element, keep_text=False):
@@ -156,6 +156,11 @@ class FileMonitor(Debuggable):
         #: Whether or not the FAM has been started.  See :func:`start`.
         self.started = False
 
+        #: A counter that is incremented every time an event has been
+        #: dispatched to the object that handles it.  If the counter
+        #: has not changed, then no monitored data has changed.
+        self.generation = 0
+
     def __str__(self):
         return "%s: %s" % (__name__, self.__class__.__name__)
 
@@ -237,13 +242,16 @@ class FileMonitor(Debuggable):
                        (event.code2str(), event.filename,
                         self.handles[event.requestID]))
         try:
-            self.handles[event.requestID].HandleEvent(event)
-        except KeyboardInterrupt:
-            raise
-        except:  # pylint: disable=W0702
-            err = sys.exc_info()[1]
-            self.logger.error("Error in handling of event %s for %s: %s" %
-                              (event.code2str(), event.filename, err))
+            try:
+                self.handles[event.requestID].HandleEvent(event)
+            except KeyboardInterrupt:
+                raise
+            except:  # pylint: disable=W0702
+                err = sys.exc_info()[1]
+                self.logger.error("Error in handling of event %s for %s: %s"
+                                  % (event.code2str(), event.filename, err))
+        finally:
+            self.generation += 1
 
     def handle_event_set(self, lock=None):
         """ Handle all pending events.
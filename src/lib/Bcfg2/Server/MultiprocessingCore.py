@@ -3,97 +3,282 @@
 :mod:`multiprocessing` library to offload work to multiple child
 processes.  As such, it requires Python 2.6+.
 
-The parent communicates with the children over
-:class:`multiprocessing.Queue` objects via a
+The parent communicates with each child over a persistent
+:func:`multiprocessing.Pipe` via a
 :class:`Bcfg2.Server.MultiprocessingCore.RPCQueue` object.
 
 A method being called via the RPCQueue must be exposed by the child by
 decorating it with :func:`Bcfg2.Server.Core.exposed`.
+
+If ``prefork`` is enabled, the children are forked from the parent
+after it has loaded all plugins, so that the parsed repository is
+shared with the children copy-on-write instead of being loaded again
+by each child.  Preforked children do not watch the repository for
+changes themselves; when the parent sees that the repository has
+changed, it forks a fresh set of children and retires the old ones
+once they have finished the requests they were given.
 """
 
+import sys
 import time
+import zlib
+import bisect
 import threading
-import lxml.etree
 import multiprocessing
 import Bcfg2.Options
 import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
-from itertools import cycle
-from Bcfg2.Compat import Queue, Empty, wraps
+import Bcfg2.Server.Statistics
+from Bcfg2.Compat import xmlrpclib, wraps, md5, \
+    unicode  # pylint: disable=W0622
 from Bcfg2.Server.Core import Core, exposed
 from Bcfg2.Server.BuiltinCore import BuiltinCore
-from multiprocessing.connection import Listener, Client
 
 
-class RPCQueue(Bcfg2.Server.Plugin.Debuggable):
-    """ An implementation of a :class:`multiprocessing.Queue` designed
-    for several additional use patterns:
+class RPCChannel(object):
+    """ One end of a persistent, bidirectional RPC channel between
+    the parent and a child.  Messages are ``(request ID, data)``
+    tuples; the request ID is used to match responses to requests,
+    so several requests can be outstanding on a channel at once.
+    Sending is thread-safe, but only one thread may receive.
+
+    Large string results (e.g., rendered configurations) are not
+    pickled.  They are sent as raw bytes after a short header, and
+    are optionally compressed with :mod:`zlib`.
+    """
 
-    * Random-access reads, based on a key that identifies the data;
-    * Publish-subscribe, where a datum is sent to all hosts.
+    #: Send string results this long or longer as raw bytes
+    #: (compressed, if compression is enabled) instead of pickling
+    #: them
+    raw_threshold = 64 * 1024
+
+    def __init__(self, conn, compress=False):
+        """
+        :param conn: One end of a :func:`multiprocessing.Pipe`
+        :type conn: multiprocessing.connection.Connection
+        :param compress: Compress large results
+        :type compress: bool
+        """
+        self.conn = conn
+        self.compress = compress
+        self._send_lock = threading.Lock()
 
-    The subscribers can deal with this as a normal Queue with no
-    special handling.
+    def send(self, req_id, data):
+        """ Send a message.  This is used both for requests and for
+        responses.
+
+        :param req_id: The ID of the request, or None if no response
+                       is expected
+        :param data: The data to send.  This must be picklable.
+        """
+        codec = None
+        if (isinstance(data, unicode) and req_id is not None and
+                len(data) >= self.raw_threshold):
+            data = data.encode('UTF-8')
+            if self.compress:
+                codec = "zlib"
+                data = zlib.compress(data, 1)
+            else:
+                codec = "raw"
+        self._send_lock.acquire()
+        try:
+            if codec is None:
+                self.conn.send((req_id, codec, data))
+            else:
+                self.conn.send((req_id, codec, None))
+                self.conn.send_bytes(data)
+        finally:
+            self._send_lock.release()
+
+    def recv(self):
+        """ Receive a message.
+
+        :returns: tuple of (request ID, data)
+        """
+        req_id, codec, data = self.conn.recv()
+        if codec is not None:
+            data = self.conn.recv_bytes()
+            if codec == "zlib":
+                data = zlib.decompress(data)
+            data = data.decode('UTF-8')
+        return (req_id, data)
+
+    def poll(self, timeout=0.0):
+        """ Return True if there is a message waiting to be received.
+
+        :param timeout: How long to wait for a message, in seconds
+        :type timeout: float
+        :returns: bool
+        """
+        return self.conn.poll(timeout)
+
+    def close(self):
+        """ Close the channel. """
+        self.conn.close()
+
+
+class RPCQueue(Bcfg2.Server.Plugin.Debuggable):
+    """ A set of :class:`RPCChannel` objects, one per subscriber
+    (i.e., child), designed for two use patterns:
+
+    * Request-response RPC calls to a single subscriber, several of
+      which may be outstanding on the same channel at once;
+    * Publish-subscribe, where a call is sent to all subscribers and
+      no response is expected.
     """
     poll_wait = 3.0
 
-    def __init__(self):
+    def __init__(self, compress=False, timeout=None):
+        """
+        :param compress: Compress large results sent by subscribers
+        :type compress: bool
+        :param timeout: How long to wait for the response to an RPC
+                        call, in seconds, or None to wait forever
+        :type timeout: float
+        """
         Bcfg2.Server.Plugin.Debuggable.__init__(self)
+        self.compress = compress
+        self.timeout = timeout
         self._terminate = threading.Event()
-        self._queues = dict()
-        self._listeners = []
+        self._channels = dict()
+        self._readers = []
+
+        #: A dict of request ID -> [threading.Event, result, channel]
+        #: for RPC calls that are waiting for a response
+        self._pending = dict()
+        self._next_id = 0
+        self._id_lock = threading.Lock()
 
     def add_subscriber(self, name):
         """ Add a subscriber to the queue.  This returns the
-        :class:`multiprocessing.Queue` object that the subscriber
-        should read from.  """
-        self._queues[name] = multiprocessing.Queue()
-        return self._queues[name]
+        :class:`RPCChannel` object that the subscriber should read
+        requests from and send responses to.  The caller should close
+        it once the subscriber has been started in a new process.
+
+        If a subscriber with the same name already exists, it is
+        replaced: new requests go to the new subscriber, and the old
+        one is asked to retire.  Responses to requests that are still
+        outstanding on the old subscriber are still delivered. """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        if name in self._channels:
+            self.logger.debug("Retiring old RPC channel to %s" % name)
+            self._channels[name].send(None, ("retire", [], dict()))
+        self._channels[name] = RPCChannel(parent_conn)
+        reader = threading.Thread(name="%sReader" % name,
+                                  target=self._read_responses, args=[name])
+        reader.start()
+        # forget about readers for retired subscribers that have
+        # already stopped, so they don't pile up with every re-fork
+        self._readers = [r for r in self._readers if r.is_alive()]
+        self._readers.append(reader)
+        return RPCChannel(child_conn, compress=self.compress)
+
+    def _read_responses(self, name):
+        """ Read responses from the named subscriber and hand them to
+        the RPC calls waiting for them. """
+        channel = self._channels[name]
+        try:
+            while not self._terminate.is_set():
+                try:
+                    if not channel.poll(self.poll_wait):
+                        continue
+                    req_id, data = channel.recv()
+                except (EOFError, IOError):
+                    self.logger.debug("RPC channel to %s closed" % name)
+                    break
+                if req_id is None:
+                    # a subscriber that is retiring sends a message
+                    # with no request ID once it has answered all of
+                    # its outstanding requests
+                    self.logger.debug("RPC channel to %s retired" % name)
+                    break
+                waiter = self._pending.get(req_id)
+                if waiter is None:
+                    self.logger.error("Got response to unknown RPC request "
+                                      "%s from %s" % (req_id, name))
+                    continue
+                waiter[1] = data
+                waiter[0].set()
+        finally:
+            channel.close()
+            # nothing more will be read from this channel, so calls
+            # still waiting on it fail rather than waiting forever
+            for waiter in list(self._pending.values()):
+                if waiter[2] is channel and not waiter[0].is_set():
+                    waiter[1] = xmlrpclib.Fault(
+                        xmlrpclib.APPLICATION_ERROR,
+                        "RPC channel to %s closed" % name)
+                    waiter[0].set()
 
     def publish(self, method, args=None, kwargs=None):
         """ Publish an RPC call to the queue for consumption by all
         subscribers. """
-        for queue in self._queues.values():
-            queue.put((None, (method, args or [], kwargs or dict())))
+        for channel in self._channels.values():
+            channel.send(None, (method, args or [], kwargs or dict()))
 
     def rpc(self, dest, method, args=None, kwargs=None):
         """ Make an RPC call to the named subscriber, expecting a
-        response.  This opens a
-        :class:`multiprocessing.connection.Listener` and passes the
-        Listener address to the child as part of the RPC call, so that
-        the child can connect to the Listener to submit its results.
+        response.  The call is sent over the subscriber's persistent
+        channel with a new request ID, and this blocks until the
+        response with the same ID is received.
+
+        :raises: :exc:`xmlrpclib.Fault` if the subscriber does not
+                 respond within :attr:`timeout` seconds, or if its
+                 channel is closed before it responds
         """
-        listener = Listener()
-        self.logger.debug("Created new RPC listener at %s" % listener.address)
-        self._listeners.append(listener)
+        self._id_lock.acquire()
+        try:
+            req_id = self._next_id
+            self._next_id += 1
+        finally:
+            self._id_lock.release()
+        channel = self._channels[dest]
+        waiter = [threading.Event(), None, channel]
+        self._pending[req_id] = waiter
         try:
-            self._queues[dest].put((listener.address,
-                                    (method, args or [], kwargs or dict())))
-            conn = listener.accept()
             try:
-                while not self._terminate.is_set():
-                    if conn.poll(self.poll_wait):
-                        return conn.recv()
-            finally:
-                conn.close()
+                channel.send(req_id, (method, args or [], kwargs or dict()))
+            except (EOFError, IOError):
+                err = sys.exc_info()[1]
+                raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                      "Failed to send %s to %s: %s" %
+                                      (method, dest, err))
+            start = time.time()
+            while not self._terminate.is_set():
+                waiter[0].wait(self.poll_wait)
+                if waiter[0].is_set():
+                    if isinstance(waiter[1], xmlrpclib.Fault):
+                        raise waiter[1]
+                    return waiter[1]
+                if (self.timeout is not None and
+                        time.time() - start > self.timeout):
+                    raise xmlrpclib.Fault(
+                        xmlrpclib.APPLICATION_ERROR,
+                        "%s did not respond to %s within %s seconds" %
+                        (dest, method, self.timeout))
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "Server is shutting down")
         finally:
-            listener.close()
-            self._listeners.remove(listener)
+            del self._pending[req_id]
+
+    def close_channels(self):
+        """ Close this process' copies of the parent ends of all
+        channels without waiting for the reader threads.  This is used
+        by preforked children, which inherit a copy of the RPCQueue
+        from the parent but must not hold the parent's channels open.
+        """
+        for channel in self._channels.values():
+            channel.close()
 
     def close(self):
-        """ Close queues and connections. """
+        """ Close channels.  The channels are closed by the threads
+        that read from them, which stop within :attr:`poll_wait`
+        seconds. """
         self._terminate.set()
-        self.logger.debug("Closing RPC queues")
-        for name, queue in self._queues.items():
-            self.logger.debug("Closing RPC queue to %s" % name)
-            queue.close()
-
-        # close any listeners that are waiting for connections
-        self.logger.debug("Closing RPC connections")
-        for listener in self._listeners:
-            self.logger.debug("Closing RPC connection at %s" %
-                              listener.address)
-            listener.close()
+        self.logger.debug("Closing RPC channels")
+        for reader in self._readers:
+            self.logger.debug("Waiting for %s to stop" % reader.name)
+            reader.join()
 
 
 class DualEvent(object):
@@ -142,7 +327,11 @@ class ChildCore(Core):
     handle anything else (authentication, probes, etc.) because those
     are all much faster.  There's no reason that it couldn't handle
     those, though, if the pipe communication "protocol" were made more
-    robust. """
+    robust.
+
+    If a ``parent`` core is given, the child is preforked: rather than
+    loading plugins itself, it adopts the state of the parent at the
+    time it is forked, including all loaded plugins. """
 
     #: How long to wait while polling for new RPC commands.  This
     #: doesn't affect the speed with which a command is processed, but
@@ -151,21 +340,37 @@ class ChildCore(Core):
     #: every ``poll_wait`` seconds.
     poll_wait = 3.0
 
-    def __init__(self, name, rpc_q, terminate):
+    def __init__(self, name, rpc_q, terminate, parent=None):
         """
         :param name: The name of this child
         :type name: string
-        :param read_q: The queue the child will read from for RPC
-                       communications from the parent process.
-        :type read_q: multiprocessing.Queue
-        :param write_q: The queue the child will write the results of
-                        RPC calls to.
-        :type write_q: multiprocessing.Queue
+        :param rpc_q: The channel the child will read RPC calls from
+                      the parent process from, and write the results
+                      of RPC calls to.
+        :type rpc_q: Bcfg2.Server.MultiprocessingCore.RPCChannel
         :param terminate: An event that flags ChildCore objects to shut
                           themselves down.
         :type terminate: multiprocessing.Event
+        :param parent: The fully loaded parent core to adopt the
+                       state of, if this child is to be preforked.
+        :type parent: Bcfg2.Server.MultiprocessingCore.MultiprocessingCore
         """
-        Core.__init__(self)
+        if parent is None:
+            Core.__init__(self)
+        else:
+            # share everything the parent has loaded -- plugins,
+            # metadata, the FAM, etc.  once the child is forked, this
+            # is all a copy-on-write copy of the parent's state.
+            self.__dict__.update(parent.__dict__)
+
+        #: The parent core this child was preforked from, or None if
+        #: the child loads plugins itself
+        self.parent = parent
+
+        #: Flag that is set when this child has been replaced by a
+        #: newly forked child, and should shut down once it has
+        #: answered all outstanding requests
+        self._retired = threading.Event()
 
         #: The name of this child
         self.name = name
@@ -174,7 +379,7 @@ class ChildCore(Core):
         #: to determine when this child should shut down.
         self.terminate = terminate
 
-        #: The queue used for RPC communication
+        #: The channel used for RPC communication
         self.rpc_q = rpc_q
 
         # override this setting so that the child doesn't try to write
@@ -189,16 +394,46 @@ class ChildCore(Core):
     def _run(self):
         return True
 
-    def _dispatch(self, address, data):
+    def run(self):
+        if self.parent is None:
+            return Core.run(self)
+
+        # we are now running in the newly forked child process.
+        # anything that refers to the parent core needs to refer to
+        # this child instead.
+        Bcfg2.Server.core = self
+        for plugin in self.plugins.values():
+            plugin.core = self
+        Bcfg2.Server.Cache.remove_expire_hook(self.parent._expire_hook)
+        Bcfg2.Server.Cache.remove_expire_hook(self.parent.cache_dispatch)
+        Bcfg2.Server.Cache.add_expire_hook(self._expire_hook)
+
+        # the parent held these locks, and the plugins held theirs,
+        # while forking, so the child's copies are still locked.
+        # other threads in the parent may also have held the cache
+        # lock, and they don't exist here to release it.
+        self.lock = threading.Lock()
+        self.db_write_lock = threading.RLock()
+        Bcfg2.Server.Cache.after_fork()
+        for plugin in self.plugins.values():
+            plugin.after_fork(True)
+
+        # drop resources that belong to the parent: the listening
+        # socket, and the parent ends of the RPC channels to all
+        # children
+        if self.parent.server is not None:
+            self.parent.server.server_close()
+        self.parent.rpc_q.close_channels()
+
+        try:
+            self._block()
+        except:
+            self.shutdown()
+            raise
+
+    def _dispatch(self, req_id, data):
         """ Method dispatcher used for commands received from
-        the RPC queue. """
-        if address is not None:
-            # if the key is None, then no response is expected.  we
-            # make the return connection before dispatching the actual
-            # RPC call so that the parent is blocking for a connection
-            # as briefly as possible
-            self.logger.debug("Connecting to parent via %s" % address)
-            client = Client(address)
+        the RPC channel. """
         method, args, kwargs = data
         func = None
         rv = None
@@ -217,35 +452,52 @@ class ChildCore(Core):
                 self.logger.error("%s: Method %s is not exposed" % (self.name,
                                                                     method))
                 func = None
-        if func is not None:
-            self.logger.debug("%s: Calling RPC method %s" % (self.name,
-                                                             method))
-            rv = func(*args, **kwargs)
-        if address is not None:
-            # if the key is None, then no response is expected
-            self.logger.debug("Returning data to parent via %s" % address)
-            client.send(rv)
+        try:
+            if func is not None:
+                self.logger.debug("%s: Calling RPC method %s" % (self.name,
+                                                                 method))
+                rv = func(*args, **kwargs)
+        except:
+            self.logger.error("%s: Unexpected failure calling RPC method %s: "
+                              "%s" % (self.name, method, sys.exc_info()[1]),
+                              exc_info=1)
+        if req_id is not None:
+            # if the request ID is None, then no response is
+            # expected.  otherwise we always respond, even on failure,
+            # so that the parent isn't left waiting forever
+            self.logger.debug("%s: Returning result of RPC request %s" %
+                              (self.name, req_id))
+            self.rpc_q.send(req_id, rv)
 
     def _block(self):
         self._rmi = self._get_rmi()
-        while not self.terminate.is_set():
+        while not self.terminate.is_set() and not self._retired.is_set():
             try:
-                address, data = self.rpc_q.get(timeout=self.poll_wait)
+                if not self.rpc_q.poll(self.poll_wait):
+                    continue
+                req_id, data = self.rpc_q.recv()
                 threadname = "-".join(str(i) for i in data)
                 rpc_thread = threading.Thread(name=threadname,
                                               target=self._dispatch,
-                                              args=[address, data])
+                                              args=[req_id, data])
                 rpc_thread.start()
-            except Empty:
-                pass
+            except (EOFError, IOError):
+                self.logger.error("%s: RPC channel to parent closed" %
+                                  self.name)
+                break
             except KeyboardInterrupt:
                 break
         self.shutdown()
 
     def shutdown(self):
-        Core.shutdown(self)
-        self.logger.info("%s: Closing RPC command queue" % self.name)
-        self.rpc_q.close()
+        if self.parent is None:
+            Core.shutdown(self)
+        elif self._running:
+            # the FAM and the plugins belong to the parent, so a
+            # preforked child does not shut them down
+            self.logger.info("%s: Shutting down core..." % self.name)
+            self._running = False
+            self._stop_bind_workers()
 
         while len(threading.enumerate()) > 1:
             threads = [t for t in threading.enumerate()
@@ -256,6 +508,16 @@ class ChildCore(Core):
             time.sleep(1)
         self.logger.info("%s: All threads stopped" % self.name)
 
+        if self._retired.is_set():
+            # tell the parent that all outstanding requests have been
+            # answered
+            self.rpc_q.send(None, None)
+
+        # close the channel last, so that threads that were still
+        # running RPC calls could return their results
+        self.logger.info("%s: Closing RPC channel" % self.name)
+        self.rpc_q.close()
+
     def _get_rmi(self):
         rmi = dict()
         for pname, pinst in self._get_rmi_objects().items():
@@ -267,18 +529,25 @@ class ChildCore(Core):
                 rmi["%s.%s" % (pname, mname)] = getattr(pinst, mname)
         return rmi
 
+    @exposed
+    def retire(self):
+        """ Shut down once all outstanding requests have been
+        answered, because this child has been replaced """
+        self.logger.info("%s: Retiring" % self.name)
+        self._retired.set()
+
     @exposed
     def expire_cache(self, *tags, **kwargs):
         """ Expire cached data """
         Bcfg2.Server.Cache.expire(*tags, exact=kwargs.pop("exact", False))
 
     @exposed
-    def GetConfig(self, client):
+    def GetConfig(self, client, digest=None, revision=None):
         """ Render the configuration for a client """
         self.metadata.update_client_list()
         self.logger.debug("%s: Building configuration for %s" %
                           (self.name, client))
-        return lxml.etree.tostring(self.BuildConfiguration(client))
+        return self.RenderConfigurationIfModified(client, digest, revision)
 
 
 class MultiprocessingCore(BuiltinCore):
@@ -294,12 +563,47 @@ class MultiprocessingCore(BuiltinCore):
             '--children', dest="core_children",
             cf=('server', 'children'), type=int,
             default=multiprocessing.cpu_count(),
-            help='Spawn this number of children for the multiprocessing core')]
+            help='Spawn this number of children for the multiprocessing core'),
+        Bcfg2.Options.Option(
+            cf=('server', 'dispatch'), dest="core_dispatch",
+            default='least-loaded', choices=['least-loaded', 'affinity'],
+            help='How the multiprocessing core picks the child that '
+            'renders a client configuration'),
+        Bcfg2.Options.Option(
+            cf=('server', 'affinity_max_outstanding'),
+            dest="core_affinity_max_outstanding", type=int, default=2,
+            help='With affinity dispatch, send a client to the least '
+            'loaded child instead of its own child if its own child has '
+            'this many requests outstanding'),
+        Bcfg2.Options.BooleanOption(
+            cf=('server', 'child_compression'), dest="core_child_compression",
+            help='Compress large results sent from children to the parent '
+            'process'),
+        Bcfg2.Options.BooleanOption(
+            cf=('server', 'prefork'), dest="core_prefork",
+            help='Fork children after plugins have been loaded, so that the '
+            'loaded repository is shared with the children'),
+        Bcfg2.Options.Option(
+            cf=('server', 'child_timeout'), dest="core_child_timeout",
+            type=float, default=300.0,
+            help='How long to wait for a child process to answer a request '
+            'before failing it, in seconds')]
+
+    #: The number of points each child gets on the consistent hash
+    #: ring used for ``affinity`` dispatch.  More points spread
+    #: clients more evenly across children.
+    hash_ring_points = 100
 
     #: How long to wait for a child process to shut down cleanly
     #: before it is terminated.
     shutdown_timeout = 10.0
 
+    #: With ``prefork``, how often to check whether the repository has
+    #: changed since the children were forked, in seconds.  Children
+    #: are re-forked once the repository has changed and then been
+    #: stable for this long.
+    refork_interval = 10.0
+
     def __init__(self):
         BuiltinCore.__init__(self)
 
@@ -309,29 +613,47 @@ class MultiprocessingCore(BuiltinCore):
         #: Pipe.)
         self.pipes = dict()
 
-        #: A queue that keeps track of which children are available to
-        #: render a configuration.  A child is popped from the queue
-        #: when it starts to render a config, then it's pushed back on
-        #: when it's done.  This lets us use a blocking call to
-        #: :func:`Queue.Queue.get` when waiting for an available
-        #: child.
-        self.available_children = \
-            Queue(maxsize=Bcfg2.Options.setup.core_children)
-
         #: The flag that indicates when to stop child threads and
         #: processes
         self.terminate = DualEvent(threading_event=self.terminate)
 
         #: A :class:`Bcfg2.Server.MultiprocessingCore.RPCQueue` object
         #: used to send or publish commands to children.
-        self.rpc_q = RPCQueue()
+        self.rpc_q = RPCQueue(
+            compress=Bcfg2.Options.setup.core_child_compression,
+            timeout=Bcfg2.Options.setup.core_child_timeout)
 
-        #: A list of children that will be cycled through
+        #: A list of the names of all children
         self._all_children = []
 
-        #: An iterator that each child will be taken from in sequence,
-        #: to provide a round-robin distribution of render requests
-        self.children = None
+        #: A dict of child name -> the number of requests that have
+        #: been dispatched to that child and not yet answered.  Render
+        #: requests are sent to the child with the fewest outstanding
+        #: requests.
+        self.outstanding = dict()
+
+        #: The index in :attr:`_all_children` of the child that is
+        #: preferred when several children are equally loaded, so that
+        #: an idle server distributes requests round-robin
+        self._next_child = 0
+
+        #: Lock used to make child selection atomic
+        self._dispatch_lock = threading.Lock()
+
+        #: A sorted list of (hash, child name) tuples that forms the
+        #: consistent hash ring used for ``affinity`` dispatch
+        self._hash_ring = []
+
+        #: The FAM generation at the time the children were last
+        #: forked with ``prefork``
+        self._forked_generation = None
+
+        #: The :class:`threading.Thread` that re-forks children when
+        #: the repository changes, with ``prefork``
+        self.refork_thread = None
+        if Bcfg2.Options.setup.core_prefork:
+            self.refork_thread = threading.Thread(name="ReforkThread",
+                                                  target=self._refork_thread)
 
     def __str__(self):
         if hasattr(Bcfg2.Options.setup, "server"):
@@ -342,24 +664,121 @@ class MultiprocessingCore(BuiltinCore):
             return "%s(%s children)" % (self.__class__.__name__,
                                         len(self._all_children))
 
-    def _run(self):
-        for cnum in range(Bcfg2.Options.setup.core_children):
-            name = "Child-%s" % cnum
+    def _start_child(self, name):
+        """ Start a child process.  If a child with the same name is
+        already running, it is replaced.
 
-            self.logger.debug("Starting child %s" % name)
-            child_q = self.rpc_q.add_subscriber(name)
+        :param name: The name of the child
+        :type name: string
+        """
+        self.logger.debug("Starting child %s" % name)
+        child_q = self.rpc_q.add_subscriber(name)
+        if Bcfg2.Options.setup.core_prefork:
+            childcore = ChildCore(name, child_q, self.terminate, parent=self)
+        else:
             childcore = ChildCore(name, child_q, self.terminate)
-            child = multiprocessing.Process(target=childcore.run, name=name)
+        child = multiprocessing.Process(target=childcore.run, name=name)
+        # hold the FAM lock so that the child isn't forked while an
+        # event set is only partially handled, and the database write
+        # lock so that it isn't forked in the middle of a write.  a
+        # preforked child shares the parent's plugins, so they get to
+        # hold their own locks, too.
+        if Bcfg2.Options.setup.core_prefork:
+            plugins = list(self.plugins.values())
+        else:
+            plugins = []
+        prepared = []
+        self.lock.acquire()
+        self.db_write_lock.acquire()
+        try:
+            for plugin in plugins:
+                plugin.before_fork()
+                prepared.append(plugin)
+            # the child must not share the parent's database
+            # connections; both reconnect when they next need to
+            self._close_db_connections()
             child.start()
-            self.logger.debug("Child %s started with PID %s" % (name,
-                                                                child.pid))
+        finally:
+            for plugin in reversed(prepared):
+                plugin.after_fork(False)
+            self.db_write_lock.release()
+            self.lock.release()
+        # the child has its own copy of its end of the channel now
+        child_q.close()
+        self.logger.debug("Child %s started with PID %s" % (name, child.pid))
+
+    def _start_children(self):
+        """ Start all children. """
+        for cnum in range(Bcfg2.Options.setup.core_children):
+            name = "Child-%s" % cnum
+            self._start_child(name)
             self._all_children.append(name)
+            self.outstanding[name] = 0
+            for point in range(self.hash_ring_points):
+                self._hash_ring.append((self._hash("%s-%s" % (name, point)),
+                                        name))
+        self._hash_ring.sort()
         self.logger.debug("Started %s children: %s" % (len(self._all_children),
                                                        self._all_children))
-        self.children = cycle(self._all_children)
+
+    def _run(self):
+        if not Bcfg2.Options.setup.core_prefork:
+            self._start_children()
         Bcfg2.Server.Cache.add_expire_hook(self.cache_dispatch)
         return BuiltinCore._run(self)
 
+    def _block(self):
+        if Bcfg2.Options.setup.core_prefork:
+            # plugins have been loaded and the initial FAM events
+            # handled, so the children can be forked now.  the server
+            # is listening, but it doesn't accept connections until
+            # BuiltinCore._block() is called.
+            self._forked_generation = self.fam.generation
+            self._start_children()
+            self.refork_thread.start()
+        return BuiltinCore._block(self)
+
+    def _refork_thread(self):
+        """ The thread that re-forks children with ``prefork`` once
+        the repository has changed and then been stable for
+        :attr:`refork_interval` seconds. """
+        self.logger.debug("Re-fork thread starting")
+        last_generation = self._forked_generation
+        while not self.terminate.is_set():
+            self.terminate.wait(self.refork_interval)
+            if self.terminate.is_set():
+                break
+            generation = self.fam.generation
+            if (generation != self._forked_generation and
+                    generation == last_generation and
+                    not self.fam.pending()):
+                self._refork()
+            last_generation = generation
+        self.logger.info("Re-fork thread terminated")
+
+    def _refork(self):
+        """ Replace all children with newly forked children that share
+        the current state of the parent.  Old children finish the
+        requests they have already been given and then shut down. """
+        self.logger.info("Repository changed, re-forking %s children" %
+                         len(self._all_children))
+        start = time.time()
+        self._forked_generation = self.fam.generation
+        for name in self._all_children:
+            self._start_child(name)
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:refork" % self.__class__.__name__, time.time() - start)
+
+    @exposed
+    def refork(self, _):
+        """ Re-fork all children immediately with ``prefork``, rather
+        than waiting for the repository to change. """
+        if not Bcfg2.Options.setup.core_prefork:
+            self.logger.error("Children are only re-forked with prefork")
+            return False
+        self._refork()
+        return True
+
     def shutdown(self):
         BuiltinCore.shutdown(self)
         self.logger.info("Closing RPC command queues")
@@ -436,13 +855,111 @@ class MultiprocessingCore(BuiltinCore):
         """ Publish cache expiration events to child nodes. """
         self.rpc_q.publish("expire_cache", args=tags, kwargs=dict(exact=exact))
 
+    @staticmethod
+    def _hash(key):
+        """ Get the position of a key on the consistent hash ring.
+
+        :param key: The key to hash
+        :type key: string
+        :returns: int
+        """
+        return int(md5(key.encode('UTF-8')).hexdigest()[:8], 16)
+
+    def _affinity_child(self, client):
+        """ Get the child that a client is assigned to on the
+        consistent hash ring.  Since each client is always rendered
+        by the same child, its cached data (metadata, Packages
+        collections, etc.) is only kept in that one child.
+
+        :param client: The hostname of the client
+        :type client: string
+        :returns: string - the name of the child
+        """
+        idx = bisect.bisect(self._hash_ring, (self._hash(client), ''))
+        return self._hash_ring[idx % len(self._hash_ring)][1]
+
+    def _least_loaded_child(self):
+        """ Get the child with the fewest outstanding requests.
+        Ties are broken round-robin.
+
+        :returns: string - the name of the child
+        """
+        count = len(self._all_children)
+        candidates = [self._all_children[(self._next_child + i) % count]
+                      for i in range(count)]
+        childname = min(candidates, key=lambda c: self.outstanding[c])
+        self._next_child = (self._all_children.index(childname) + 1) % count
+        return childname
+
+    def _checkout_child(self, client=None):
+        """ Pick the child to render a configuration, and count a
+        new outstanding request against it.  With the default
+        ``least-loaded`` dispatch, this is the child with the fewest
+        outstanding requests.  With ``affinity`` dispatch, this is the
+        child the client hashes to, unless that child already has
+        ``affinity_max_outstanding`` requests outstanding, in which
+        case the least loaded child is used.  Every call must be
+        paired with a call to :func:`_checkin_child`.
+
+        :param client: The hostname of the client to render a
+                       configuration for
+        :type client: string
+        :returns: string - the name of the child
+        """
+        self._dispatch_lock.acquire()
+        try:
+            childname = None
+            if (client is not None and
+                    Bcfg2.Options.setup.core_dispatch == 'affinity'):
+                preferred = self._affinity_child(client)
+                if (self.outstanding[preferred] <
+                        Bcfg2.Options.setup.core_affinity_max_outstanding):
+                    childname = preferred
+                Bcfg2.Server.Statistics.stats.add_value(
+                    "%s:GetConfig:affinity" % self.__class__.__name__,
+                    int(childname is not None))
+            if childname is None:
+                childname = self._least_loaded_child()
+            self.outstanding[childname] += 1
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:GetConfig:queue_depth" % self.__class__.__name__,
+                sum(self.outstanding.values()))
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:%s:outstanding" % (self.__class__.__name__, childname),
+                self.outstanding[childname])
+            return childname
+        finally:
+            self._dispatch_lock.release()
+
+    def _checkin_child(self, childname):
+        """ Mark an outstanding request to the given child as
+        finished. """
+        self._dispatch_lock.acquire()
+        try:
+            self.outstanding[childname] -= 1
+        finally:
+            self._dispatch_lock.release()
+
     @exposed
-    def GetConfig(self, address):
+    def GetConfig(self, address, digest=None, revision=None):
         client = self.resolve_client(address)[0]
-        childname = self.children.next()
+        childname = self._checkout_child(client)
         self.logger.debug("Building configuration for %s on %s" % (client,
                                                                    childname))
-        return self.rpc_q.rpc(childname, "GetConfig", args=[client])
+        start = time.time()
+        try:
+            # the child compares the digest, so that an unmodified
+            # configuration is never sent to the parent at all
+            return self.rpc_q.rpc(childname, "GetConfig",
+                                  args=[client, digest, revision])
+        finally:
+            self._checkin_child(childname)
+            elapsed = time.time() - start
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:%s:GetConfig" % (self.__class__.__name__, childname),
+                elapsed)
+            Bcfg2.Server.Statistics.stats.add_histogram_value(
+                "%s:GetConfig:latency" % self.__class__.__name__, elapsed)
 
     @exposed
     def get_statistics(self, address):
@@ -480,4 +997,9 @@ class MultiprocessingCore(BuiltinCore):
                 self.rpc_q.rpc(childname, "get_statistics", args=[address]),
                 prefix=childname)
         _aggregate_statistics(BuiltinCore.get_statistics(self, address))
+        for childname, count in self.outstanding.items():
+            # report the current number of requests in flight, rather
+            # than a running summary
+            stats["%s:%s:in_flight" % (self.__class__.__name__,
+                                       childname)] = (count, count, count, 1)
         return stats
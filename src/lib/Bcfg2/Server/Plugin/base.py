@@ -92,6 +92,30 @@ class Plugin(Debuggable):
         self.debug_log("Shutting down %s plugin" % self.name)
         self.running = False
 
+    def before_fork(self):
+        """ Prepare for the server to fork a child process that
+        shares this plugin, as the
+        :class:`Bcfg2.Server.MultiprocessingCore.MultiprocessingCore`
+        does with ``prefork``.  Plugins that use locks should acquire
+        them here, so that the child is not forked while another
+        thread holds them.
+
+        :returns: None """
+        pass
+
+    def after_fork(self, child):
+        """ Clean up after the server has forked a child process.
+        This is called in both the parent and the child after every
+        :func:`before_fork`.  Locks acquired by :func:`before_fork`
+        should be released in the parent and recreated in the child,
+        since the thread that held them does not exist there.
+
+        :param child: True if this is called in the newly forked
+                      child, False if it is called in the parent
+        :type child: bool
+        :returns: None """
+        pass
+
     def set_debug(self, debug):
         self.debug_log("%s: debug = %s" % (self.name, self.debug_flag),
                        flag=True)
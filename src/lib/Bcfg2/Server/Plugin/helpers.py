@@ -13,7 +13,7 @@ import Bcfg2.Server
 import Bcfg2.Options
 import Bcfg2.Server.FileMonitor
 from Bcfg2.Logger import Debuggable
-from Bcfg2.Compat import CmpMixin, wraps
+from Bcfg2.Compat import CmpMixin, wraps, all  # pylint: disable=W0622
 from Bcfg2.Server.Plugin.base import Plugin
 from Bcfg2.Server.Plugin.interfaces import Generator, TemplateDataProvider
 from Bcfg2.Server.Plugin.exceptions import SpecificityError, \
@@ -33,6 +33,10 @@ except ImportError:
 
 LOGGER = logging.getLogger(__name__)
 
+#: Operations in the compiled form of a
+#: :class:`Bcfg2.Server.Plugin.helpers.StructFile`
+_MATCH_TEST, _MATCH_TEXT, _MATCH_ELEMENT = range(3)
+
 
 def removecomment(stream):
     """ A Genshi filter that removes comments from the stream.  This
@@ -700,6 +704,18 @@ class StructFile(XMLFileBacked):
                                create=create)
         self.template = None
 
+        #: Whether or not the result of matching against this file
+        #: depends only on the groups a client is a member of.  This
+        #: is False if the file is a template or contains any
+        #: ``<Client>`` tags.
+        self.host_independent = False
+
+        #: The data in this file, compiled by :func:`_compile` into a
+        #: form that can be matched without walking and copying the
+        #: whole document.  None if the file is a template or cannot
+        #: be compiled.
+        self._compiled = None
+
     def Index(self):
         XMLFileBacked.Index(self)
         if (self.name.endswith('.genshi') or
@@ -723,6 +739,8 @@ class StructFile(XMLFileBacked):
                 err = sys.exc_info()[1]
                 self.logger.error('Genshi parse error in %s: %s' % (self.name,
                                                                     err))
+        self.host_independent = (self.template is None and
+                                 not self.xdata.xpath("//Client"))
 
         if HAS_CRYPTO and self.encryption:
             for el in self.xdata.xpath("//*[@encrypted]"):
@@ -743,8 +761,125 @@ class StructFile(XMLFileBacked):
                         self.logger.debug(msg)
                     else:
                         raise PluginExecutionError(msg)
+        self._compile()
     Index.__doc__ = XMLFileBacked.Index.__doc__
 
+    def _compile(self):
+        """ Compile the data in this file for :func:`Match` and
+        :func:`XMLMatch`.  Each element that is not a ``<Group>``,
+        ``<Client>``, or other tag in :attr:`_include_tests` is stored
+        as a copy without its children, and its children are
+        flattened into a list of operations: copy a child element,
+        append some text, or check a ``<Group>`` or ``<Client>`` tag
+        and skip everything it contains if it does not match.  Group
+        and client names are extracted ahead of time, so matching
+        neither walks nor copies the whole document.
+
+        Templates are not compiled, since they must be rendered for
+        each client, and neither are files whose class overrides the
+        matching methods. """
+        self._compiled = None
+        if self.template is not None:
+            return
+        for name in ["_include_element", "_match", "_xml_match"]:
+            method = getattr(self, name)
+            if getattr(method, "__func__", None) is not \
+                    StructFile.__dict__[name]:
+                return
+        self._compiled = self._compile_element(self.xdata)
+
+    def _compile_element(self, element):
+        """ Compile a single element that is not a ``<Group>`` or
+        ``<Client>`` tag (or other tag in :attr:`_include_tests`)
+        for :func:`_compile`.
+
+        :param element: The element to compile
+        :type element: lxml.etree._Element
+        :returns: tuple of ``(<element>, <operations>)``, where
+                  ``<element>`` is a copy of the element without its
+                  children.  ``<operations>`` is a list of tuples,
+                  each of which is one of ``(_MATCH_TEST, <test>,
+                  <index to skip to if the test fails>)``,
+                  ``(_MATCH_TEXT, <text>, None)``, or
+                  ``(_MATCH_ELEMENT, <compiled child>, None)``.
+        """
+        if len(element):
+            shell = copy.deepcopy(element)
+            shell[:] = []
+        else:
+            shell = copy.copy(element)
+        ops = []
+        self._compile_children(element, ops)
+        return (shell, ops)
+
+    def _compile_children(self, element, ops):
+        """ Recursive helper for :func:`_compile_element` that adds
+        operations for the children of ``element`` to ``ops``,
+        descending into ``<Group>`` and ``<Client>`` tags. """
+        for child in element.iterchildren():
+            if isinstance(child, lxml.etree._Comment):  # pylint: disable=W0212
+                continue
+            if child.tag in self._include_tests:
+                if (child.tag in ['Group', 'Client'] and
+                        self._include_tests[child.tag] is
+                        StructFile._include_tests[child.tag]):
+                    test = (child.tag, child.get('name'),
+                            child.get('negate', 'false').lower() == 'true',
+                            child)
+                else:
+                    test = (None, None, None, child)
+                idx = len(ops)
+                ops.append(None)
+                if child.text:
+                    ops.append((_MATCH_TEXT, child.text, None))
+                self._compile_children(child, ops)
+                ops[idx] = (_MATCH_TEST, test, len(ops))
+            else:
+                ops.append((_MATCH_ELEMENT, self._compile_element(child),
+                            None))
+
+    def _run_compiled(self, ops, metadata, groups, args):
+        """ Run compiled operations (see :func:`_compile_element`)
+        against client metadata.
+
+        :returns: tuple of ``(<matching texts>, <matching compiled
+                  child elements>)`` """
+        texts = []
+        children = []
+        i = 0
+        while i < len(ops):
+            op, arg, skip = ops[i]
+            i += 1
+            if op == _MATCH_TEST:
+                tag, name, negate, element = arg
+                if tag == 'Group':
+                    matches = negate != (name in groups)
+                elif tag == 'Client':
+                    matches = negate != (name == metadata.hostname)
+                else:
+                    matches = self._include_element(element, metadata, *args)
+                if not matches:
+                    i = skip
+            elif op == _MATCH_TEXT:
+                texts.append(arg)
+            else:
+                children.append(arg)
+        return texts, children
+
+    def _build(self, compiled, metadata, groups, args, text=False):
+        """ Build a copy of a compiled element that only contains the
+        children that match the given client metadata.  If ``text`` is
+        True, text from matching ``<Group>`` and ``<Client>`` tags is
+        appended to the element's text, as in :func:`XMLMatch`. """
+        element, ops = compiled
+        rv = copy.copy(element)
+        texts, children = self._run_compiled(ops, metadata, groups, args)
+        for child in children:
+            rv.append(self._build(child, metadata, groups, args, text=text))
+        if text and texts:
+            rv.text = (rv.text or '') + ''.join(texts)
+        return rv
+
     def _decrypt(self, element):
         """ Decrypt a single encrypted properties file element """
         if not element.text or not element.text.strip():
@@ -823,6 +958,12 @@ class StructFile(XMLFileBacked):
         provides a sane prototype for the Match() function while
         keeping the internals consistent. """
         rv = []
+        if self._compiled is not None:
+            groups = set(metadata.groups)
+            for child in self._run_compiled(self._compiled[1], metadata,
+                                            groups, args)[1]:
+                rv.append(self._build(child, metadata, groups, args))
+            return rv
         if self.template is None:
             entries = self.entries
         else:
@@ -876,6 +1017,9 @@ class StructFile(XMLFileBacked):
         interface to accept a different number of arguments.  This
         provides a sane prototype for the Match() function while
         keeping the internals consistent. """
+        if self._compiled is not None:
+            return self._build(self._compiled, metadata,
+                               set(metadata.groups), args, text=True)
         if self.template is None:
             rv = copy.deepcopy(self.xdata)
         else:
@@ -996,6 +1140,10 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         Plugin.__init__(self, core)
         Generator.__init__(self)
         XMLDirectoryBacked.__init__(self, self.data)
+
+        #: The result of the last call to :func:`_get_matches`, as a
+        #: tuple of ``(<metadata>, <source files>, <result>)``
+        self._last_matches = None
     __init__.__doc__ = Plugin.__init__.__doc__
 
     def HandleEvent(self, event):
@@ -1014,7 +1162,9 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         """ Whether or not a given candidate matches the abstract
         entry given.  By default this does strict matching (i.e., the
         entry name matches the candidate name), but this can be
-        overridden to provide regex matching, etc.
+        overridden to provide regex matching, etc.  Subclasses that
+        override this will usually need to override :func:`_key` or
+        :func:`_candidates` as well.
 
         :param entry: The entry to find a match for
         :type entry: lxml.etree._Element
@@ -1027,6 +1177,70 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         return (entry.tag == candidate.tag and
                 entry.get('name') == candidate.get('name'))
 
+    def _key(self, element):
+        """ Get the key that candidate elements are indexed under
+        within a matched document, and that an abstract entry is
+        looked up by.  Only candidates with the same key as an entry
+        are passed to :func:`_matches`.
+
+        :param element: The candidate or abstract entry
+        :type element: lxml.etree._Element
+        :returns: string
+        """
+        return element.get('name')
+
+    def _candidates(self, entry, index):
+        """ Get the elements in one matched document that might match
+        the given entry.
+
+        :param entry: The entry to find candidates for
+        :type entry: lxml.etree._Element
+        :param index: The index of a matched document, as a dict of
+                      ``<tag> => <key> => list of elements``
+        :type index: dict
+        :returns: list of lxml.etree._Element objects
+        """
+        return index.get(entry.tag, dict()).get(self._key(entry), [])
+
+    def _get_matches(self, metadata):
+        """ Get the matched document of each source file for the given
+        client, along with an index of the elements in it.  Matching a
+        file means copying or rendering the whole thing, so the result
+        for the most recent client is kept for as long as its metadata
+        object is in use (i.e., for the rest of its build) and the
+        files are unchanged, rather than redone for every entry that
+        is bound.  Only one result is kept, so memory use doesn't grow
+        with the number of clients.
+
+        :param metadata: The client metadata to match against
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: list of tuples of ``(<source file>, <index>)``; see
+                  :func:`_candidates` for the format of the index.
+        """
+        sources = [(src, getattr(src, "xdata", None))
+                   for src in self.entries.values()]
+        cached = self._last_matches
+        if (cached is not None and cached[0] is metadata and
+                cached[1] == sources):
+            return cached[2]
+
+        rv = []
+        for src, _ in sources:
+            index = dict()
+            for el in src.XMLMatch(metadata).iter():
+                if isinstance(el, lxml.etree._Comment):  # pylint: disable=W0212
+                    continue
+                index.setdefault(el.tag, dict()).setdefault(
+                    self._key(el), []).append(el)
+            rv.append((src, index))
+        self._last_matches = (metadata, sources, rv)
+        return rv
+
+    def is_host_independent(self, entry, metadata):
+        return all(getattr(src, "host_independent", False)
+                   for src in self.entries.values())
+    is_host_independent.__doc__ = Generator.is_host_independent.__doc__
+
     def BindEntry(self, entry, metadata):
         """ Bind the attributes that apply to an entry to it.  The
         entry is modified in-place.
@@ -1038,8 +1252,8 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         :returns: None
         """
         matching = []
-        for src in self.entries.values():
-            for candidate in src.XMLMatch(metadata).xpath("//%s" % entry.tag):
+        for src, index in self._get_matches(metadata):
+            for candidate in self._candidates(entry, index):
                 if self._matches(entry, metadata, candidate):
                     matching.append((src, candidate))
         if len(matching) == 0:
@@ -11,6 +11,7 @@ from Bcfg2.Compat import Queue, Empty, Full, cPickle
 from Bcfg2.Server.Plugin.base import Plugin
 from Bcfg2.Server.Plugin.exceptions import PluginInitError, \
     MetadataRuntimeError, MetadataConsistencyError
+from Bcfg2.Server.Statistics import track_statistics
 
 # Since this file basically just contains abstract interface
 # descriptions, just about every function declaration has unused
@@ -37,6 +38,13 @@ class Generator(object):
        :func:`HandleEntry`.
     """
 
+    #: Whether or not :func:`HandlesEntry` depends only on the tag
+    #: and name of the entry, and not on the client metadata.  If
+    #: this is True, the Bcfg2 core remembers which entries the plugin
+    #: does not handle, and doesn't ask again until the plugin handles
+    #: a FAM event.
+    handles_entry_by_name = False
+
     def HandlesEntry(self, entry, metadata):
         """ HandlesEntry is the slow path method for routing
         configuration binding requests.  It is called if the
@@ -68,6 +76,42 @@ class Generator(object):
         """
         return entry
 
+    def is_host_independent(self, entry, metadata):
+        """ Whether or not the bound form of the given entry depends
+        only on the abstract entry itself and on the groups the
+        client is a member of -- i.e., not on the client hostname or
+        on any other client metadata.  If this returns True and the
+        ``[caching] binding`` option is enabled, the Bcfg2 core binds
+        the entry once and shares the result between all clients
+        with the same set of groups.
+
+        :param entry: The entry to bind
+        :type entry: lxml.etree._Element
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :return: bool
+        """
+        return False
+
+    @track_statistics("Bind")
+    def timed_bind(self, bind, entry, metadata):
+        """ Bind an entry with the given callable, which is either a
+        value from ``Entries`` or :func:`HandleEntry`.  The Bcfg2 core
+        binds all entries through this method so that the time spent
+        binding entries is tracked per plugin, as ``<plugin>:Bind``.
+        This should not be overridden.
+
+        :param bind: The callable that binds the entry
+        :type bind: callable
+        :param entry: The entry to bind
+        :type entry: lxml.etree._Element
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :return: lxml.etree._Element - The fully bound entry
+        :raises: :class:`Bcfg2.Server.Plugin.exceptions.PluginExecutionError`
+        """
+        return bind(entry, metadata)
+
 
 class Structure(object):
     """ Structure Plugins contribute to abstract client
@@ -220,6 +264,18 @@ class Metadata(object):
         """ Re-read the cached list of clients """
         raise NotImplementedError
 
+    def index_client(self, imd):
+        """ Called by the core whenever it caches the final metadata
+        for a client, so that the plugin can index it to speed up
+        queries by group, profile, etc.  Metadata plugins that don't
+        index clients need not implement this.
+
+        :param imd: The final metadata for the client
+        :type imd: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :return: None
+        """
+        pass
+
 
 class Connector(object):
     """ Connector plugins augment client metadata instances with
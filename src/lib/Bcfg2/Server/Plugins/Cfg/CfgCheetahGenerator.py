@@ -5,7 +5,7 @@
 import Bcfg2.Options
 from Bcfg2.Server.Plugin import PluginExecutionError, \
     DefaultTemplateDataProvider, get_template_data
-from Bcfg2.Server.Plugins.Cfg import CfgGenerator
+from Bcfg2.Server.Plugins.Cfg import CfgGenerator, CfgTemplateCache
 
 try:
     from Cheetah.Template import Template
@@ -45,14 +45,20 @@ class CfgCheetahGenerator(CfgGenerator):
         CfgGenerator.__init__(self, fname, spec)
         if not HAS_CHEETAH:
             raise PluginExecutionError("Cheetah is not available")
+        self.render_cache = CfgTemplateCache(self.name)
     __init__.__doc__ = CfgGenerator.__init__.__doc__
 
     def get_data(self, entry, metadata):
+        return self.render_cache.render(
+            get_template_data(entry, metadata, self.name,
+                              default=DefaultCheetahDataProvider()),
+            self._render)
+    get_data.__doc__ = CfgGenerator.get_data.__doc__
+
+    def _render(self, data):
+        """ Render the template with the given template variables """
         template = Template(self.data.decode(Bcfg2.Options.setup.encoding),
                             compilerSettings=self.settings)
-        for key, val in get_template_data(
-            entry, metadata, self.name,
-            default=DefaultCheetahDataProvider()).items():
+        for key, val in data.items():
             setattr(template, key, val)
         return template.respond()
-    get_data.__doc__ = CfgGenerator.get_data.__doc__
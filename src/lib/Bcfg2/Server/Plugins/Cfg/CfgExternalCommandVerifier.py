@@ -3,11 +3,132 @@
 import os
 import sys
 import shlex
+import select
+import hashlib
+import threading
+import subprocess
+from collections import deque
+import Bcfg2.Options
 from Bcfg2.Utils import Executor
+from Bcfg2.Compat import Queue, Empty, unicode  # pylint: disable=W0622
+from Bcfg2.Server.Cache import Cache, add_derived
 from Bcfg2.Server.Plugin import PluginExecutionError
 from Bcfg2.Server.Plugins.Cfg import CfgVerifier, CfgVerificationError
 
 
+class VerifierWorkerPool(object):
+    """ A pool of long-lived processes running a :file:`:test` script
+    that speaks the persistent verifier protocol.  For each file to be
+    verified, the length of the file in bytes is written to the
+    worker's stdin on a line by itself, followed by the file contents.
+    The worker must answer with a single line: ``OK`` if the file is
+    valid, or an error message if it is not.  Workers are started as
+    they are needed, up to ``size`` at once, and run until the pool is
+    closed. """
+
+    def __init__(self, cmd, size, timeout=None):
+        """
+        :param cmd: The command to run to start a worker
+        :type cmd: list
+        :param size: The maximum number of workers to run at once
+        :type size: int
+        :param timeout: Kill a worker that takes longer than this
+                        many seconds to answer
+        :type timeout: float
+        """
+        self.cmd = cmd
+        self.size = max(size, 1)
+        self.timeout = timeout
+
+        #: All running workers
+        self.workers = []
+
+        #: Workers that are not currently verifying a file
+        self.idle = Queue()
+
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _acquire(self):
+        """ Get an idle worker, starting a new one if there are none
+        and the pool is not full. """
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except Empty:
+                pass
+            self.lock.acquire()
+            try:
+                if len(self.workers) < self.size:
+                    proc = subprocess.Popen(self.cmd, bufsize=0,
+                                            close_fds=True,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+                    self.workers.append(proc)
+                    return proc
+            finally:
+                self.lock.release()
+            # wait for a worker to become idle, but check again
+            # periodically in case busy workers exit
+            try:
+                return self.idle.get(True, 1)
+            except Empty:
+                pass
+
+    def _discard(self, proc):
+        """ Stop a worker and remove it from the pool """
+        self.lock.acquire()
+        try:
+            if proc in self.workers:
+                self.workers.remove(proc)
+        finally:
+            self.lock.release()
+        if proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.wait()
+
+    def verify(self, data):
+        """ Verify the given data with a worker.
+
+        :param data: The file contents to verify
+        :type data: bytes
+        :returns: None if the data is valid, or the error message
+                  from the worker if it is not
+        :raises: OSError if the worker cannot be started, exits, or
+                 times out
+        """
+        proc = self._acquire()
+        try:
+            proc.stdin.write(("%d\n" % len(data)).encode('ascii') + data)
+            proc.stdin.flush()
+            if not select.select([proc.stdout], [], [], self.timeout)[0]:
+                raise OSError("Verifier %s timed out" % self.cmd[-1])
+            line = proc.stdout.readline()
+            if not line:
+                raise OSError("Verifier %s exited with %s" %
+                              (self.cmd[-1], proc.wait()))
+        except (IOError, OSError):
+            self._discard(proc)
+            raise OSError(sys.exc_info()[1])
+        if self.closed:
+            self._discard(proc)
+        else:
+            self.idle.put(proc)
+        line = line.decode('utf-8').strip()
+        if line == "OK":
+            return None
+        return line
+
+    def close(self):
+        """ Stop all workers """
+        self.closed = True
+        for proc in self.workers[:]:
+            self._discard(proc)
+
+
 class CfgExternalCommandVerifier(CfgVerifier):
     """ Invoke an external script to verify
     :ref:`server-plugins-generators-cfg` file contents """
@@ -15,23 +136,95 @@ class CfgExternalCommandVerifier(CfgVerifier):
     #: Handle :file:`:test` files
     __basenames__ = [':test']
 
+    #: The command only sees the file contents, so the result is the
+    #: same for every client
+    host_independent = True
+
+    #: Scripts that contain this string are run as long-lived
+    #: workers with :class:`VerifierWorkerPool`, rather than once for
+    #: each file verified
+    persistent_marker = "bcfg2-verifier: persistent"
+
+    options = [
+        Bcfg2.Options.Option(
+            cf=("cfg", "verifier_workers"), dest="cfg_verifier_workers",
+            type=int, default=4,
+            help="Number of long-lived worker processes to run for each "
+            "persistent Cfg verifier"),
+        Bcfg2.Options.Option(
+            cf=("cfg", "verifier_cache_size"),
+            dest="cfg_verifier_cache_size", type=int, default=1000,
+            help="Number of successful verifications to remember for "
+            "each Cfg verifier")]
+
     def __init__(self, name, specific):
         CfgVerifier.__init__(self, name, specific)
         self.cmd = []
         self.exc = Executor(timeout=30)
+
+        #: The :class:`VerifierWorkerPool` used to run the script, if
+        #: it supports the persistent verifier protocol
+        self.pool = None
+
+        #: The SHA-256 digests of data that has passed verification
+        #: since the script last changed
+        self.results = Cache("Cfg", "verify", name)
+        add_derived("Cfg", "verify")
+
+        #: The digests in :attr:`results`, oldest first, so that the
+        #: oldest can be dropped when there are too many
+        self._digests = deque()
+        self._lock = threading.Lock()
     __init__.__doc__ = CfgVerifier.__init__.__doc__
 
     def verify_entry(self, entry, metadata, data):
+        if isinstance(data, unicode):
+            bdata = data.encode('utf-8')
+        else:
+            bdata = data
+        digest = hashlib.sha256(bdata).hexdigest()
+        if digest in self.results:
+            return
+
         try:
-            result = self.exc.run(self.cmd, inputdata=data)
-            if not result.success:
-                raise CfgVerificationError(result.error)
+            if self.pool is not None:
+                error = self.pool.verify(bdata)
+            else:
+                result = self.exc.run(self.cmd, inputdata=data)
+                error = None
+                if not result.success:
+                    error = result.error
         except OSError:
             raise CfgVerificationError(sys.exc_info()[1])
+        if error is not None:
+            raise CfgVerificationError(error)
+        self._add_result(digest)
     verify_entry.__doc__ = CfgVerifier.verify_entry.__doc__
 
+    def _add_result(self, digest):
+        """ Remember that data with the given digest passed
+        verification, forgetting the oldest results if there are more
+        than ``[cfg] verifier_cache_size``. """
+        self._lock.acquire()
+        try:
+            self.results[digest] = True
+            self._digests.append(digest)
+            while len(self._digests) > \
+                    Bcfg2.Options.setup.cfg_verifier_cache_size:
+                try:
+                    del self.results[self._digests.popleft()]
+                except KeyError:
+                    pass
+        finally:
+            self._lock.release()
+
     def handle_event(self, event):
         CfgVerifier.handle_event(self, event)
+        self.results.expire()
+        self._digests.clear()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
         if not self.data:
             return
         self.cmd = []
@@ -42,4 +235,8 @@ class CfgExternalCommandVerifier(CfgVerifier):
             else:
                 raise PluginExecutionError("Cannot execute %s" % self.name)
         self.cmd.append(self.name)
+        if self.persistent_marker in self.data:
+            self.pool = VerifierWorkerPool(
+                self.cmd, Bcfg2.Options.setup.cfg_verifier_workers,
+                timeout=self.exc.timeout)
     handle_event.__doc__ = CfgVerifier.handle_event.__doc__
@@ -8,7 +8,7 @@ import traceback
 import Bcfg2.Options
 from Bcfg2.Server.Plugin import PluginExecutionError, removecomment, \
     DefaultTemplateDataProvider, get_template_data
-from Bcfg2.Server.Plugins.Cfg import CfgGenerator
+from Bcfg2.Server.Plugins.Cfg import CfgGenerator, CfgTemplateCache
 from genshi.template import TemplateLoader, NewTextTemplate
 from genshi.template.base import TemplateError
 from genshi.template.eval import UndefinedError, Suite
@@ -88,6 +88,7 @@ class CfgGenshiGenerator(CfgGenerator):
         CfgGenerator.__init__(self, fname, spec)
         self.template = None
         self.loader = self.__loader_cls__(max_cache_size=0)
+        self.render_cache = CfgTemplateCache(self.name)
     __init__.__doc__ = CfgGenerator.__init__.__doc__
 
     def get_data(self, entry, metadata):
@@ -95,10 +96,15 @@ class CfgGenshiGenerator(CfgGenerator):
             raise PluginExecutionError("Failed to load template %s" %
                                        self.name)
 
-        stream = self.template.generate(
-            **get_template_data(
-                entry, metadata, self.name,
-                default=DefaultGenshiDataProvider())).filter(removecomment)
+        return self.render_cache.render(
+            get_template_data(entry, metadata, self.name,
+                              default=DefaultGenshiDataProvider()),
+            self._render)
+    get_data.__doc__ = CfgGenerator.get_data.__doc__
+
+    def _render(self, data):
+        """ Render the template with the given template variables """
+        stream = self.template.generate(**data).filter(removecomment)
         try:
             try:
                 return stream.render('text',
@@ -121,7 +127,6 @@ class CfgGenshiGenerator(CfgGenerator):
             # this needs to be a blanket except, since it can catch
             # any error raised by the genshi template.
             self._handle_genshi_exception(sys.exc_info())
-    get_data.__doc__ = CfgGenerator.get_data.__doc__
 
     def _handle_genshi_exception(self, exc):
         """ this is horrible, and I deeply apologize to whoever gets
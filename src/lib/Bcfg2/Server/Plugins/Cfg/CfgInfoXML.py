@@ -20,6 +20,12 @@ class CfgInfoXML(CfgInfo):
         self.infoxml.BindEntry(entry, metadata)
     bind_info_to_entry.__doc__ = CfgInfo.bind_info_to_entry.__doc__
 
+    @property
+    def host_independent(self):
+        """ :file:`info.xml` files are host-independent unless they
+        contain ``<Client>`` tags """
+        return self.infoxml.host_independent
+
     def handle_event(self, event):
         self.infoxml.HandleEvent()
     handle_event.__doc__ = CfgInfo.handle_event.__doc__
@@ -7,7 +7,7 @@ import sys
 import Bcfg2.Options
 from Bcfg2.Server.Plugin import PluginExecutionError, \
     DefaultTemplateDataProvider, get_template_data
-from Bcfg2.Server.Plugins.Cfg import CfgGenerator
+from Bcfg2.Server.Plugins.Cfg import CfgGenerator, CfgTemplateCache
 
 try:
     from jinja2 import Environment, FileSystemLoader
@@ -66,6 +66,7 @@ class CfgJinja2Generator(CfgGenerator):
         if not HAS_JINJA2:
             raise PluginExecutionError("Jinja2 is not available")
         self.template = None
+        self.render_cache = CfgTemplateCache(self.name)
         encoding = Bcfg2.Options.setup.encoding
         self.loader = self.__loader_cls__('/',
                                           encoding=encoding)
@@ -84,9 +85,10 @@ class CfgJinja2Generator(CfgGenerator):
         if self.template is None:
             raise PluginExecutionError("Failed to load template %s" %
                                        self.name)
-        return self.template.render(
+        return self.render_cache.render(
             get_template_data(entry, metadata, self.name,
-                              default=DefaultJinja2DataProvider()))
+                              default=DefaultJinja2DataProvider()),
+            self.template.render)
     get_data.__doc__ = CfgGenerator.get_data.__doc__
 
     def handle_event(self, event):
@@ -16,3 +16,6 @@ class CfgPlaintextGenerator(CfgGenerator):
     #: Very low priority to avoid matching host- or group-specific
     #: files with other extensions -- e.g., .genshi, .crypt, etc.
     __priority__ = 100
+
+    #: Plaintext files are the same for every client they apply to
+    host_independent = True
@@ -8,9 +8,12 @@ import operator
 import lxml.etree
 import Bcfg2.Options
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.FileMonitor
+from Bcfg2.Server.Cache import Cache, add_derived
 from Bcfg2.Server.Plugin import PluginExecutionError
 # pylint: disable=W0622
-from Bcfg2.Compat import u_str, unicode, b64encode, any, walk_packages
+from Bcfg2.Compat import u_str, unicode, b64encode, any, all, \
+    walk_packages
 # pylint: enable=W0622
 
 try:
@@ -79,6 +82,13 @@ class CfgBaseFileMatcher(Bcfg2.Server.Plugin.SpecificData):
     #: Flag to indicate an experimental handler.
     experimental = False
 
+    #: Whether or not the output of this handler depends only on the
+    #: file it handles (and the groups it is specific to), and not on
+    #: the client hostname or any other client metadata.  Entries
+    #: bound solely by host-independent handlers can be shared
+    #: between clients with the same groups.
+    host_independent = False
+
     def __init__(self, name, specific):
         if not self.__specific__ and not specific:
             specific = Bcfg2.Server.Plugin.Specificity(all=True)
@@ -513,6 +523,294 @@ class CfgDefaultInfo(CfgInfo):
     bind_info_to_entry.__doc__ = CfgInfo.bind_info_to_entry.__doc__
 
 
+#: Stands in for a metadata attribute or dict key that does not
+#: exist when recording what a template accessed
+_MISSING = object()
+
+
+def _freeze(value):
+    """ Get a hashable representation of a value accessed by a
+    template, so it can be used as part of a cache key.  Sets, lists,
+    tuples and dicts are converted recursively, files from the
+    repository (e.g., Properties files) are represented by their
+    contents, and XML elements are serialized.
+
+    :raises: TypeError if the value cannot be made hashable """
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    elif isinstance(value, Bcfg2.Server.Plugin.FileBacked):
+        return (value.__class__, value.name, value.data)
+    elif isinstance(value, lxml.etree._Element):  # pylint: disable=W0212
+        return lxml.etree.tostring(value)
+    hash(value)
+    return value
+
+
+def _lookup(metadata, desc):
+    """ Look up the value of the metadata access described by
+    ``desc`` (as recorded by :class:`MetadataRecorder`) for the given
+    client metadata. """
+    kind, attr = desc[0], desc[1]
+    if kind == 'call':
+        return _freeze(getattr(metadata, attr)(*desc[2]))
+    value = getattr(metadata, attr, _MISSING)
+    if kind == 'in':
+        return desc[2] in value
+    elif kind == 'key':
+        return _freeze(value.get(desc[2], _MISSING))
+    return _freeze(value)
+
+
+class _RecordingSet(object):
+    """ Wraps a set-valued metadata attribute (e.g.,
+    ``metadata.groups``) for :class:`MetadataRecorder`.  Membership
+    tests are recorded individually; anything else records the
+    contents of the whole set. """
+
+    def __init__(self, recorder, attr, value):
+        self._recorder = recorder
+        self._attr = attr
+        self._value = value
+
+    def _whole(self):
+        """ Record that the whole set was used, and return it """
+        self._recorder.record(('attr', self._attr))
+        return self._value
+
+    def __contains__(self, item):
+        return self._recorder.record(('in', self._attr, item))
+
+    def __iter__(self):
+        return iter(self._whole())
+
+    def __len__(self):
+        return len(self._whole())
+
+    def __nonzero__(self):
+        return bool(self._whole())
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        return self._whole() == other
+
+    def __ne__(self, other):
+        return self._whole() != other
+
+    def __and__(self, other):
+        return self._whole() & other
+    __rand__ = __and__
+
+    def __or__(self, other):
+        return self._whole() | other
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        return self._whole() - other
+
+    def __rsub__(self, other):
+        return other - self._whole()
+
+    def __xor__(self, other):
+        return self._whole() ^ other
+    __rxor__ = __xor__
+
+    def __getattr__(self, attr):
+        return getattr(self._whole(), attr)
+
+    def __repr__(self):
+        return repr(self._whole())
+
+
+class _RecordingDict(_RecordingSet):
+    """ Wraps a dict-valued metadata attribute (e.g.,
+    ``metadata.Properties`` or ``metadata.Probes``) for
+    :class:`MetadataRecorder`.  Lookups of single keys are recorded
+    individually; anything else records the contents of the whole
+    dict. """
+
+    def __contains__(self, key):
+        return (self._recorder.record(('key', self._attr, key)) is not
+                _MISSING)
+
+    def __getitem__(self, key):
+        self._recorder.record(('key', self._attr, key))
+        return self._value[key]
+
+    def get(self, key, default=None):
+        """ Get a single value from the dict """
+        self._recorder.record(('key', self._attr, key))
+        return self._value.get(key, default)
+
+    def has_key(self, key):
+        """ Test if the dict has the given key """
+        return key in self
+
+
+class MetadataRecorder(object):
+    """ Wraps a
+    :class:`Bcfg2.Server.Plugins.Metadata.ClientMetadata` object,
+    and records which attributes, groups, and connector data a
+    template reads from it, so that the rendered template can be
+    reused for other clients that have the same values for those,
+    and only those, attributes. """
+
+    def __init__(self, metadata):
+        self._metadata = metadata
+        #: The accesses recorded so far, in order
+        self._signature = []
+        #: The values of the recorded accesses
+        self._values = dict()
+        self._cacheable = True
+
+    def record(self, desc):
+        """ Record an access to the client metadata and return its
+        (frozen) value """
+        if desc not in self._values:
+            try:
+                self._values[desc] = _lookup(self._metadata, desc)
+            except TypeError:
+                self._cacheable = False
+                self._values[desc] = None
+            self._signature.append(desc)
+        return self._values[desc]
+
+    def get_signature(self):
+        """ Get the accesses recorded so far and their values, or
+        None if the template used data that cannot be recorded (e.g.,
+        ``metadata.query``) and so must not be cached.
+
+        :returns: tuple of (tuple of accesses, tuple of values)
+        """
+        if not self._cacheable:
+            return None
+        signature = tuple(self._signature)
+        return (signature, tuple(self._values[d] for d in signature))
+
+    def inGroup(self, group):  # pylint: disable=C0103
+        """ Test to see if client is a member of group """
+        return self.record(('in', 'groups', group))
+
+    def group_in_category(self, category):
+        """ Get the group in the given category that the client is a
+        member of """
+        return self.record(('call', 'group_in_category', (category, )))
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        value = getattr(self._metadata, attr, _MISSING)
+        if value is _MISSING:
+            # the template may handle missing attributes, so the
+            # fact that it's missing must be recorded, too
+            self.record(('attr', attr))
+            raise AttributeError(attr)
+        elif attr == 'query' or callable(value):
+            # templates that look at other clients, or call methods
+            # we don't know about, can't be cached
+            self._cacheable = False
+        elif isinstance(value, (set, frozenset)):
+            return _RecordingSet(self, attr, value)
+        elif isinstance(value, dict):
+            return _RecordingDict(self, attr, value)
+        else:
+            self.record(('attr', attr))
+        return value
+
+    def __repr__(self):
+        for attr in ['hostname', 'profile', 'groups']:
+            self.record(('attr', attr))
+        return repr(self._metadata)
+
+
+class CfgTemplateCache(object):
+    """ Memoizes the output of a template-based
+    :class:`Bcfg2.Server.Plugins.Cfg.CfgGenerator`, if the
+    ``[caching] templates`` option is set.
+
+    Each time the template is rendered, the client metadata is
+    wrapped in a :class:`MetadataRecorder` so that the parts of the
+    metadata the template read are known, and the output is cached
+    keyed on the values of exactly those parts.  Since the template
+    follows the same path through its code whenever it reads the same
+    values, a later client for which all of the recorded accesses
+    have the same values gets the same output.  A template that only
+    looks at ``metadata.profile``, for instance, is rendered once per
+    profile.
+
+    The cache is dropped whenever anything in the repository
+    changes. """
+
+    def __init__(self, name):
+        #: The cached output, keyed on (accesses, other template
+        #: variables, values of the accesses)
+        self.cache = Cache("Cfg", "render", name)
+        add_derived("Cfg", "render")
+
+        #: The distinct sets of metadata accesses recorded from
+        #: rendering this template
+        self.signatures = []
+
+        #: The FAM generation the cache is valid for
+        self.generation = None
+
+    def render(self, data, render):
+        """ Get the output of a template, either from the cache or by
+        rendering it.
+
+        :param data: The template variables, as returned by
+                     :func:`Bcfg2.Server.Plugin.helpers.get_template_data`.
+                     The ``metadata`` variable is replaced with a
+                     :class:`MetadataRecorder` when the template is
+                     rendered.
+        :type data: dict
+        :param render: A function that renders the template with the
+                       template variables given as its only argument.
+        :type render: callable
+        :returns: The output of ``render``
+        """
+        if not Bcfg2.Options.setup.cfg_template_cache:
+            return render(data)
+
+        try:
+            static = _freeze(dict((k, v) for k, v in data.items()
+                                  if k != 'metadata'))
+        except TypeError:
+            return render(data)
+
+        generation = Bcfg2.Server.FileMonitor.get_fam().generation
+        if generation != self.generation:
+            self.cache.expire()
+            self.signatures = []
+            self.generation = generation
+
+        metadata = data['metadata']
+        for signature in self.signatures[:]:
+            try:
+                values = tuple(_lookup(metadata, d) for d in signature)
+            except (TypeError, AttributeError):
+                continue
+            try:
+                return self.cache[(signature, static, values)]
+            except KeyError:
+                pass
+
+        recorder = MetadataRecorder(metadata)
+        data = dict(data)
+        data['metadata'] = recorder
+        rv = render(data)
+        result = recorder.get_signature()
+        if result is not None:
+            signature, values = result
+            if signature not in self.signatures:
+                self.signatures.append(signature)
+            self.cache[(signature, static, values)] = rv
+        return rv
+
+
 class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
     """ Handle a collection of host- and group-specific Cfg files with
     multiple different Cfg handlers in a single directory. """
@@ -520,6 +818,12 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
     def __init__(self, basename, path, entry_type):
         Bcfg2.Server.Plugin.EntrySet.__init__(self, basename, path, entry_type)
         self.specific = None
+
+        #: Handlers bucketed by handler type and specificity, used by
+        #: :func:`get_handlers`.  This is built lazily, one handler
+        #: type at a time, and is dropped whenever a file in this
+        #: entry set changes.
+        self._handler_index = None
     __init__.__doc__ = Bcfg2.Server.Plugin.EntrySet.__doc__
 
     def set_debug(self, debug):
@@ -538,6 +842,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         :returns: None
         """
         action = event.code2str()
+        self._handler_index = None
 
         if event.filename not in self.entries:
             if action not in ['exists', 'created', 'changed']:
@@ -587,6 +892,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         :returns: None
         :raises: :class:`Bcfg2.Server.Plugin.exceptions.SpecificityError`
         """
+        self._handler_index = None
         fpath = os.path.join(self.path, event.filename)
         if hdlr.__basenames__:
             fdesc = "/".join(hdlr.__basenames__)
@@ -675,8 +981,34 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         return entry
     bind_entry.__doc__ = Bcfg2.Server.Plugin.EntrySet.bind_entry.__doc__
 
+    def is_host_independent(self, entry, metadata):
+        """ Whether or not the bound entry depends only on the groups
+        the client is a member of.  This is True if every handler
+        that applies to the client is host-independent and none of
+        them are host-specific.
+
+        :param entry: The abstract entry to check
+        :type entry: lxml.etree._Element
+        :param metadata: The client metadata to check
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: bool
+        """
+        try:
+            generator = self.best_matching(metadata,
+                                           self.get_handlers(metadata,
+                                                             CfgGenerator))
+        except PluginExecutionError:
+            return False
+        handlers = [generator]
+        for handler_type in [CfgInfo, CfgFilter, CfgVerifier]:
+            handlers.extend(self.get_handlers(metadata, handler_type))
+        return all(hdlr.host_independent and not hdlr.specific.hostname
+                   for hdlr in handlers)
+
     def get_handlers(self, metadata, handler_type):
         """ Get all handlers of the given type for the given metadata.
+        Handlers are returned from most to least specific, so the
+        first handler is the best match.
 
         :param metadata: The metadata to get all handlers for.
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
@@ -684,13 +1016,45 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         :type handler_type: type
         :returns: list of Cfg handler classes
         """
-        rv = []
-        for ent in self.entries.values():
-            if (isinstance(ent, handler_type) and
-                    (not ent.__specific__ or ent.specific.matches(metadata))):
-                rv.append(ent)
+        index = self._handler_index
+        if index is None:
+            index = self._handler_index = dict()
+        if handler_type not in index:
+            index[handler_type] = self._index_handlers(handler_type)
+        hosts, groups, rest = index[handler_type]
+        rv = list(hosts.get(metadata.hostname, []))
+        rv.extend(hdlr for group, hdlr in groups if group in metadata.groups)
+        rv.extend(rest)
         return rv
 
+    def _index_handlers(self, handler_type):
+        """ Sort all handlers of the given type from most to least
+        specific and bucket them by specificity, so that
+        :func:`get_handlers` doesn't need to check each handler
+        against the client metadata.
+
+        :param handler_type: The type of Cfg handler to index
+        :type handler_type: type
+        :returns: tuple of (dict of <hostname>: <list of host-specific
+                  handlers>, list of (<group>, <handler>) tuples in
+                  priority order, list of handlers that apply to all
+                  clients)
+        """
+        handlers = [ent for ent in self.entries.values()
+                    if isinstance(ent, handler_type)]
+        handlers.sort(key=operator.attrgetter("specific"))
+        hosts = dict()
+        groups = []
+        rest = []
+        for hdlr in handlers:
+            if not hdlr.__specific__ or hdlr.specific.all:
+                rest.append(hdlr)
+            elif hdlr.specific.hostname:
+                hosts.setdefault(hdlr.specific.hostname, []).append(hdlr)
+            elif hdlr.specific.group:
+                groups.append((hdlr.specific.group, hdlr))
+        return (hosts, groups, rest)
+
     def bind_info_to_entry(self, entry, metadata):
         """ Bind entry metadata to the entry with the best CfgInfo
         handler
@@ -891,7 +1255,12 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
             cf=("cfg", "handlers"), dest="cfg_handlers",
             help="Cfg handlers to load",
             type=Bcfg2.Options.Types.comma_list, action=CfgHandlerAction,
-            default=_handlers)]
+            default=_handlers),
+        Bcfg2.Options.BooleanOption(
+            cf=('caching', 'templates'), dest="cfg_template_cache",
+            default=False,
+            help="Cache rendered Cfg templates, keyed on the client "
+            "metadata they use")]
 
     def __init__(self, core):
         global _CFG  # pylint: disable=W0603
@@ -921,6 +1290,14 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
         return bool(self.entries[entry.get('name')].get_handlers(metadata,
                                                                  CfgGenerator))
 
+    def is_host_independent(self, entry, metadata):
+        if entry.get('name') not in self.entries:
+            return False
+        return self.entries[entry.get('name')].is_host_independent(entry,
+                                                                   metadata)
+    is_host_independent.__doc__ = \
+        Bcfg2.Server.Plugin.Generator.is_host_independent.__doc__
+
     def AcceptChoices(self, entry, metadata):
         return self.entries[entry.get('name')].list_accept_choices(entry,
                                                                    metadata)
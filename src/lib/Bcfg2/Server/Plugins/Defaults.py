@@ -30,10 +30,15 @@ class Defaults(Bcfg2.Server.Plugins.Rules.Rules,
 
     def validate_goals(self, metadata, config):
         """ Apply defaults """
+        shared = getattr(Bcfg2.Options.setup, "binding_cache", False)
         for struct in config.getchildren():
             for entry in struct.getchildren():
                 try:
-                    self.BindEntry(entry, metadata)
+                    if shared:
+                        self.core.bind_shared(self, self.BindEntry, entry,
+                                              metadata)
+                    else:
+                        self.BindEntry(entry, metadata)
                 except Bcfg2.Server.Plugin.PluginExecutionError:
                     # either no matching defaults (which is okay),
                     # or multiple matching defaults (which is not
@@ -9,9 +9,11 @@ import copy
 import errno
 import socket
 import logging
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.FileMonitor
 from Bcfg2.Utils import locked
@@ -559,6 +561,18 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.uuid = {}
         self.session_cache = {}
         self.cache = Cache("Metadata")
+
+        #: Inverted indexes of the groups, profiles, and bundles of
+        #: clients whose final metadata is cached by the core, used
+        #: by the ``get_client_names_by_*()`` queries.  Each index is
+        #: a dict of group/profile/bundle name -> set of hostnames.
+        self._index = dict(groups=dict(), profile=dict(), bundles=dict())
+
+        #: The clients in :attr:`_index`, as a dict of hostname ->
+        #: dict of index name -> values for the client
+        self._indexed = dict()
+        self._index_lock = threading.Lock()
+        Bcfg2.Server.Cache.add_expire_hook(self._expire_index)
         self.default = None
         self.pdirty = False
         self.password = Bcfg2.Options.setup.password
@@ -580,6 +594,21 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 open(os.path.join(repo, cls.name, fname),
                      "w").write(kwargs[aname])
 
+    def shutdown(self):
+        super(Metadata, self).shutdown()
+        Bcfg2.Server.Cache.remove_expire_hook(self._expire_index)
+
+    def after_fork(self, child):
+        if child:
+            # another thread may have been updating the indexes when
+            # the child was forked.  clients are indexed again as
+            # their metadata is built.
+            self._index_lock = threading.Lock()
+            self._indexed.clear()
+            for index in self._index.values():
+                index.clear()
+    after_fork.__doc__ = Bcfg2.Server.Plugin.Plugin.after_fork.__doc__
+
     @property
     def use_database(self):
         """ Expose self._use_db publicly for use in
@@ -1304,33 +1333,115 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         return set([g.name for g in self.groups.values()
                     if g.category == category])
 
+    def index_client(self, imd):
+        """ Add the final metadata for a client to the inverted
+        indexes used by :func:`get_client_names_by_groups`,
+        :func:`get_client_names_by_profiles`, and
+        :func:`get_client_names_by_bundles`.  The core calls this
+        whenever it caches a client metadata object, and the client
+        is removed from the indexes when its metadata is expired with
+        :func:`Bcfg2.Server.Cache.expire`.  Clients stay indexed when
+        their cached metadata is evicted by a cache policy, since
+        eviction does not mean that the metadata has changed, and any
+        later change still expires it.
+
+        :param imd: The client metadata to index
+        :type imd: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        values = dict(groups=frozenset(imd.groups),
+                      profile=frozenset([imd.profile]),
+                      bundles=frozenset(imd.bundles))
+        self._index_lock.acquire()
+        try:
+            self._unindex_client(imd.hostname)
+            self._indexed[imd.hostname] = values
+            for name, index in self._index.items():
+                for value in values[name]:
+                    index.setdefault(value, set()).add(imd.hostname)
+        finally:
+            self._index_lock.release()
+
+    def _unindex_client(self, hostname):
+        """ Remove a client from the inverted indexes.  The caller
+        must hold :attr:`_index_lock`. """
+        values = self._indexed.pop(hostname, None)
+        if values is None:
+            return
+        for name, index in self._index.items():
+            for value in values[name]:
+                index[value].discard(hostname)
+                if not index[value]:
+                    del index[value]
+
+    def _expire_index(self, tags, exact, count):  # pylint: disable=W0613
+        """ Expire hook for the unified cache that removes clients from
+        the inverted indexes when their metadata is expired """
+        if tags and "Metadata" not in tags:
+            return
+        self._index_lock.acquire()
+        try:
+            hosts = [t for t in tags if t in self._indexed]
+            if hosts:
+                for hostname in hosts:
+                    self._unindex_client(hostname)
+            elif not tags or tuple(tags) == ("Metadata", ):
+                self._indexed.clear()
+                for index in self._index.values():
+                    index.clear()
+        finally:
+            self._index_lock.release()
+
+    def _get_client_names_by(self, name, values, match_all):
+        """ Get the names of clients that have all (if ``match_all``
+        is True) or any of the given values for the named index
+        (``groups``, ``profile``, or ``bundles``).  Clients that are
+        not indexed are looked up by building their metadata. """
+        clients = set(self.list_clients())
+        rv = set()
+        self._index_lock.acquire()
+        try:
+            unindexed = clients.difference(self._indexed)
+            index = self._index[name]
+            if match_all:
+                if values:
+                    matches = [index.get(v, set()) for v in values]
+                    matches.sort(key=len)
+                    found = matches[0].intersection(*matches[1:])
+                else:
+                    found = self._indexed
+            else:
+                found = set()
+                for value in values:
+                    found.update(index.get(value, set()))
+            rv.update(clients.intersection(found))
+        finally:
+            self._index_lock.release()
+
+        for client in unindexed:
+            mdata = self.core.build_metadata(client)
+            if name == "profile":
+                client_values = set([mdata.profile])
+            else:
+                client_values = getattr(mdata, name)
+            if match_all:
+                if client_values.issuperset(values):
+                    rv.add(client)
+            elif client_values.intersection(values):
+                rv.add(client)
+        return list(rv)
+
     def get_client_names_by_profiles(self, profiles):
         """ return a list of names of clients in the given profile groups """
-        rv = []
-        for client in self.list_clients():
-            mdata = self.core.build_metadata(client)
-            if mdata.profile in profiles:
-                rv.append(client)
-        return rv
+        return self._get_client_names_by("profile", profiles, False)
 
     def get_client_names_by_groups(self, groups):
         """ return a list of names of clients in the given groups """
-        rv = []
-        for client in self.list_clients():
-            mdata = self.core.build_metadata(client)
-            if mdata.groups.issuperset(groups):
-                rv.append(client)
-        return rv
+        return self._get_client_names_by("groups", groups, True)
 
     def get_client_names_by_bundles(self, bundles):
         """ given a list of bundles, return a list of names of clients
         that use those bundles """
-        rv = []
-        for client in self.list_clients():
-            mdata = self.core.build_metadata(client)
-            if mdata.bundles.issuperset(bundles):
-                rv.append(client)
-        return rv
+        return self._get_client_names_by("bundles", bundles, True)
 
     def merge_additional_groups(self, imd, groups):
         for group in groups:
@@ -49,21 +49,30 @@ in your ``Source`` subclass.  For an example of this kind of
 import os
 import re
 import sys
+import hashlib
+import threading
+import Bcfg2.Options
 from Bcfg2.Logger import Debuggable
 from Bcfg2.Compat import HTTPError, HTTPBasicAuthHandler, \
-    HTTPPasswordMgrWithDefaultRealm, install_opener, build_opener, urlopen, \
-    cPickle, md5
+    HTTPPasswordMgrWithDefaultRealm, build_opener, Request, cPickle, md5, \
+    Queue, Empty
 from Bcfg2.Server.Statistics import track_statistics
 
 
-def fetch_url(url):
-    """ Return the content of the given URL.
+def _open_url(url, headers=None):
+    """ Open the given URL.  HTTP basic authentication credentials
+    may be given in the URL.  A new opener is built for each request,
+    rather than installing a global opener, so this is safe to call
+    from several threads at once.
 
-    :param url: The URL to fetch content from.
+    :param url: The URL to open.
     :type url: string
+    :param headers: Additional HTTP request headers
+    :type headers: dict
     :raises: ValueError - Malformed URL
     :raises: URLError - Failure fetching URL
-    :returns: string - the content of the page at the given URL """
+    :returns: file-like response object """
+    handlers = []
     if '@' in url:
         mobj = re.match(r'(\w+://)([^:]+):([^@]+)@(.*)$', url)
         if not mobj:
@@ -73,8 +82,102 @@ def fetch_url(url):
         url = mobj.group(1) + mobj.group(4)
         auth = HTTPBasicAuthHandler(HTTPPasswordMgrWithDefaultRealm())
         auth.add_password(None, url, user, passwd)
-        install_opener(build_opener(auth))
-    return urlopen(url).read()
+        handlers.append(auth)
+    return build_opener(*handlers).open(Request(url, headers=headers or {}))
+
+
+def fetch_url(url):
+    """ Return the content of the given URL.
+
+    :param url: The URL to fetch content from.
+    :type url: string
+    :raises: ValueError - Malformed URL
+    :raises: URLError - Failure fetching URL
+    :returns: string - the content of the page at the given URL """
+    return _open_url(url).read()
+
+
+def fetch_url_conditional(url, etag=None, last_modified=None):
+    """ Return the content of the given URL, unless it has not
+    changed since it was last fetched.  This uses HTTP conditional
+    requests, so the server must support ``ETag`` or
+    ``Last-Modified`` for this to have any effect.
+
+    :param url: The URL to fetch content from.
+    :type url: string
+    :param etag: The ``ETag`` header returned when the URL was last
+                 fetched
+    :type etag: string
+    :param last_modified: The ``Last-Modified`` header returned when
+                          the URL was last fetched
+    :type last_modified: string
+    :raises: ValueError - Malformed URL
+    :raises: URLError - Failure fetching URL
+    :returns: tuple of (content, ETag, Last-Modified).  The content
+              is None if the URL has not changed.
+    """
+    headers = dict()
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = _open_url(url, headers=headers)
+    except HTTPError:
+        if sys.exc_info()[1].code == 304:
+            return (None, etag, last_modified)
+        raise
+    info = response.info()
+    return (response.read(), info.get('ETag'), info.get('Last-Modified'))
+
+
+def threaded_map(func, items, max_threads):
+    """ Call ``func`` on each of the given items, using at most
+    ``max_threads`` threads at once.  If any call raises an
+    exception, the first one (in the order of ``items``) is raised
+    once all calls have finished.
+
+    :param func: The function to call
+    :type func: callable
+    :param items: The items to call ``func`` with
+    :type items: iterable
+    :param max_threads: The maximum number of threads to use
+    :type max_threads: int
+    :returns: list - the return values of ``func``, in the same order
+              as ``items``
+    """
+    items = list(items)
+    if max_threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    queue = Queue()
+    for idx in range(len(items)):
+        queue.put(idx)
+
+    def worker():
+        """ Call ``func`` on items until there are none left """
+        while True:
+            try:
+                idx = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[idx] = func(items[idx])
+            except:  # pylint: disable=W0702
+                errors[idx] = sys.exc_info()[1]
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for err in errors:
+        if err is not None:
+            raise err
+    return results
 
 
 class SourceInitError(Exception):
@@ -82,6 +185,12 @@ class SourceInitError(Exception):
     pass
 
 
+class SourceChecksumError(Exception):
+    """ Raised when downloaded repository metadata does not match the
+    checksum published by the repository. """
+    pass
+
+
 #: A regular expression used to determine the base name of a repo from
 #: its URL.  This is used when generating repo configs and by
 #: :func:`Source.get_repo_name`.  It handles `Pulp
@@ -224,6 +333,15 @@ class Source(Debuggable):  # pylint: disable=R0902
         #: symbols>``.  This will not necessarily be populated.
         self.recommends = dict()
 
+        #: A dict of ``<local file name>`` -> ``(<checksum type>,
+        #: <checksum>)`` for metadata files whose checksums are
+        #: published by the repository (e.g., in a yum repository's
+        #: ``repomd.xml``).  A file with a known checksum is not
+        #: downloaded again if the local copy matches, and downloaded
+        #: files are checked against it.  The checksum type is any
+        #: algorithm supported by :func:`hashlib.new`.
+        self.checksums = dict()
+
         self._init_attributes(xsource)
 
         #: The file (or directory) used for this source's cache data
@@ -674,32 +792,125 @@ class Source(Debuggable):  # pylint: disable=R0902
 
     def update(self):
         """ Download metadata from the upstream repository and cache
-        it locally.
+        it locally.  Up to ``[packages] download_threads`` files are
+        downloaded at once.  A file is not downloaded again if the
+        local copy matches the checksum in :attr:`checksums`, or if
+        the server reports that it has not changed since it was last
+        downloaded.
 
         :raises: ValueError - If any URL in :attr:`urls` is malformed
         :raises: OSError - If there is an error writing the local
                  cache
         :raises: HTTPError - If there is an error fetching the remote
                  data
+        :raises: :class:`Bcfg2.Server.Plugins.Packages.Source.SourceChecksumError`
+                 - If downloaded data does not match its checksum
         """
-        for url in self.urls:
-            self.logger.info("Packages: Updating %s" % url)
-            fname = self.escape_url(url)
+        threaded_map(self._update_url, self.urls,
+                     Bcfg2.Options.setup.packages_download_threads)
+
+    def _update_url(self, url):
+        """ Download a single metadata file, if it has changed.
+
+        :param url: The URL to download
+        :type url: string
+        """
+        fname = self.escape_url(url)
+        vfile = fname + ".validators"
+        if os.path.exists(fname) and fname in self.checksums:
+            if self._checksum_matches(fname, open(fname, 'rb').read()):
+                self.logger.info("Packages: %s is up to date" % url)
+                return
+            # the local copy is known to be bad, so don't let the
+            # server tell us that it hasn't changed
+            self._remove_validators(vfile)
+
+        etag = last_modified = None
+        if os.path.exists(fname) and os.path.exists(vfile):
             try:
-                open(fname, 'wb').write(fetch_url(url))
-            except ValueError:
-                self.logger.error("Packages: Bad url string %s" % url)
-                raise
+                etag, last_modified = cPickle.load(open(vfile, 'rb'))
+            except:  # pylint: disable=W0702
+                self.logger.info("Packages: Could not load cache "
+                                 "validators for %s: %s" %
+                                 (url, sys.exc_info()[1]))
+
+        self.logger.info("Packages: Updating %s" % url)
+        try:
+            data, etag, last_modified = \
+                fetch_url_conditional(url, etag=etag,
+                                      last_modified=last_modified)
+        except ValueError:
+            self.logger.error("Packages: Bad url string %s" % url)
+            raise
+        except HTTPError:
+            err = sys.exc_info()[1]
+            self.logger.error("Packages: Failed to fetch url %s. HTTP "
+                              "response code=%s" % (url, err.code))
+            raise
+        if data is None:
+            self.logger.info("Packages: %s has not changed" % url)
+            return
+
+        if not self._checksum_matches(fname, data):
+            msg = "Packages: Checksum of %s does not match %s checksum %s" % \
+                ((url, ) + self.checksums[fname])
+            self.logger.error(msg)
+            self._remove_validators(vfile)
+            raise SourceChecksumError(msg)
+
+        try:
+            # write to a temp file and rename it, so that an
+            # interrupted download doesn't leave a truncated file
+            # that looks current
+            open(fname + ".new", 'wb').write(data)
+            os.rename(fname + ".new", fname)
+            if etag or last_modified:
+                cPickle.dump((etag, last_modified), open(vfile, 'wb'), 2)
+            else:
+                self._remove_validators(vfile)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.error("Packages: Could not write data from %s to "
+                              "local cache at %s: %s" % (url, fname, err))
+            raise
+
+    def _remove_validators(self, vfile):
+        """ Remove a saved set of cache validators, so that the next
+        download of the file they belong to is unconditional.
+
+        :param vfile: The file the validators are saved in
+        :type vfile: string
+        """
+        if os.path.exists(vfile):
+            try:
+                os.unlink(vfile)
             except OSError:
-                err = sys.exc_info()[1]
-                self.logger.error("Packages: Could not write data from %s to "
-                                  "local cache at %s: %s" % (url, fname, err))
-                raise
-            except HTTPError:
-                err = sys.exc_info()[1]
-                self.logger.error("Packages: Failed to fetch url %s. HTTP "
-                                  "response code=%s" % (url, err.code))
-                raise
+                self.logger.error("Packages: Could not remove cache "
+                                  "validators %s: %s" %
+                                  (vfile, sys.exc_info()[1]))
+
+    def _checksum_matches(self, fname, data):
+        """ Check data against the checksum for the given file in
+        :attr:`checksums`.
+
+        :param fname: The local file name of the metadata file
+        :type fname: string
+        :param data: The content of the file
+        :type data: string
+        :returns: bool - True if the checksum matches, or if there is
+                  no (usable) checksum for the file
+        """
+        if fname not in self.checksums:
+            return True
+        ctype, checksum = self.checksums[fname]
+        try:
+            digest = hashlib.new(ctype)
+        except ValueError:
+            self.logger.warning("Packages: Unknown checksum type %s for %s" %
+                                (ctype, fname))
+            return True
+        digest.update(data)
+        return digest.hexdigest() == checksum
 
     def applies(self, metadata):
         """ Return true if this source applies to the given client,
@@ -55,6 +55,7 @@ import re
 import sys
 import time
 import copy
+import gzip
 import errno
 import socket
 import logging
@@ -70,7 +71,7 @@ from Bcfg2.Compat import StringIO, cPickle, HTTPError, URLError, \
 # pylint: enable=W0622
 from Bcfg2.Server.Plugins.Packages.Collection import Collection
 from Bcfg2.Server.Plugins.Packages.Source import SourceInitError, Source, \
-    fetch_url
+    fetch_url, threaded_map
 from Bcfg2.Server.Statistics import track_statistics
 
 LOGGER = logging.getLogger(__name__)
@@ -994,6 +995,36 @@ class YumCollection(Collection):
             pass
 
 
+def iterparse(fname, tag):
+    """ Incrementally parse an XML file, which may be gzipped,
+    yielding each element with the given tag once it has been
+    completely parsed.  Once the caller is done with an element, it is
+    cleared and removed from the tree, along with its preceding
+    siblings, so memory use does not grow with the size of the file.
+
+    :param fname: The path to the file to parse
+    :type fname: string
+    :param tag: The tag of the elements to yield
+    :type tag: string
+    :returns: iterator of lxml.etree._Element objects
+    """
+    source = open(fname, 'rb')
+    if source.read(2) == b'\x1f\x8b':
+        source.close()
+        source = gzip.open(fname, 'rb')
+    else:
+        source.seek(0)
+    try:
+        for _, elem in lxml.etree.iterparse(source, tag=tag,
+                                            remove_blank_text=True):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    finally:
+        source.close()
+
+
 class YumSource(Source):
     """ Handle yum sources """
 
@@ -1080,8 +1111,11 @@ class YumSource(Source):
         """ A list of URLs to the base metadata file for each
         repository described by this source. """
         rv = []
-        for umap in self.url_map:
-            rv.extend(self._get_urls_from_repodata(umap['url'], umap['arch']))
+        for urls in threaded_map(
+                lambda umap: self._get_urls_from_repodata(umap['url'],
+                                                          umap['arch']),
+                self.url_map, Bcfg2.Options.setup.packages_download_threads):
+            rv.extend(urls)
         return rv
 
     def _get_urls_from_repodata(self, url, arch):
@@ -1133,6 +1167,14 @@ class YumSource(Source):
                 fullurl = url + floc.get('href')
                 urls.append(fullurl)
                 self.file_to_arch[self.escape_url(fullurl)] = arch
+                checksum = elt.find(RPO + 'checksum')
+                if checksum is not None and checksum.text:
+                    # yum calls sha1 "sha"
+                    ctype = checksum.get('type', 'sha256')
+                    if ctype == 'sha':
+                        ctype = 'sha1'
+                    self.checksums[self.escape_url(fullurl)] = \
+                        (ctype, checksum.text.strip())
         return urls
 
     # pylint: disable=R0911,R0912
@@ -1242,14 +1284,19 @@ class YumSource(Source):
             elif fname.find('comps'):
                 groups.append(fname)
 
+        # the metadata is streamed, rather than parsed into one big
+        # tree, since it can be very large
         for fname in primaries:
             farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_primary(fdata, farch)
+            self.parse_primary(iterparse(fname, XP + 'package'), farch)
         for fname in filelists:
             farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_filelist(fdata, farch)
+            if not self.needed_paths:
+                # filelists are only used to find the packages that
+                # provide file dependencies
+                self.filemap.setdefault(farch, dict())
+                continue
+            self.parse_filelist(iterparse(fname, FL + 'package'), farch)
         for fname in groups:
             fdata = lxml.etree.parse(fname).getroot()
             self.parse_group(fdata)
@@ -1273,10 +1320,14 @@ class YumSource(Source):
 
     @track_statistics()
     def parse_filelist(self, data, arch):
-        """ parse filelists.xml.gz data """
+        """ parse filelists.xml.gz data.  ``data`` can be the root
+        element of the document, or any iterable of ``package``
+        elements. """
         if arch not in self.filemap:
             self.filemap[arch] = dict()
-        for pkg in data.findall(FL + 'package'):
+        for pkg in data:
+            if pkg.tag != FL + 'package':
+                continue
             for fentry in pkg.findall(FL + 'file'):
                 if fentry.text in self.needed_paths:
                     if fentry.text in self.filemap[arch]:
@@ -1287,7 +1338,9 @@ class YumSource(Source):
 
     @track_statistics()
     def parse_primary(self, data, arch):
-        """ parse primary.xml.gz data """
+        """ parse primary.xml.gz data.  ``data`` can be the root
+        element of the document, or any iterable of ``package``
+        elements. """
         if arch not in self.packages:
             self.packages[arch] = set()
         if arch not in self.deps:
@@ -1295,7 +1348,7 @@ class YumSource(Source):
         if arch not in self.provides:
             self.provides[arch] = {}
         versionmap = {}
-        for pkg in data.getchildren():
+        for pkg in data:
             if not pkg.tag.endswith('package'):
                 continue
             pkgname = pkg.find(XP + 'name').text
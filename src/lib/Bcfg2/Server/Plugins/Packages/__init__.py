@@ -14,6 +14,7 @@ from Bcfg2.Compat import urlopen, HTTPError, URLError, MutableMapping
 from Bcfg2.Server.Plugins.Packages.Collection import Collection, \
     get_collection_class
 from Bcfg2.Server.Plugins.Packages.PackagesSources import PackagesSources
+from Bcfg2.Server.Plugins.Packages.Source import threaded_map
 from Bcfg2.Server.Statistics import track_statistics
 
 
@@ -120,6 +121,11 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
             cf=("packages", "version"), dest="packages_version",
             help="Set default Package entry version", default="auto",
             choices=["auto", "any"]),
+        Bcfg2.Options.Option(
+            cf=("packages", "download_threads"),
+            dest="packages_download_threads", type=int, default=4,
+            help="Number of repository metadata files and sources to "
+            "download at once"),
         Bcfg2.Options.PathOption(
             cf=("packages", "yum_config"),
             help="The default path for generated yum configs",
@@ -469,8 +475,10 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
 
         for source in self.sources.entries:
             cachefiles.add(source.cachefile)
-            if Bcfg2.Options.setup.packages_metadata:
-                source.setup_data(force_update)
+        if Bcfg2.Options.setup.packages_metadata:
+            threaded_map(lambda s: s.setup_data(force_update),
+                         self.sources.entries,
+                         Bcfg2.Options.setup.packages_download_threads)
 
         for cfile in glob.glob(os.path.join(self.cachepath, "cache-*")):
             if cfile not in cachefiles:
@@ -204,6 +204,7 @@ class PkgSrc(Bcfg2.Server.Plugin.XMLFileBacked):
         self.cache = None
         self.pnode = None
         self.priority = -1
+        self.host_independent = False
 
     def HandleEvent(self, _=None):
         """Read file upon update."""
@@ -223,6 +224,7 @@ class PkgSrc(Bcfg2.Server.Plugin.XMLFileBacked):
             raise PluginExecutionError(msg)
         self.pnode = self.__node__(xdata, self.items)
         self.cache = None
+        self.host_independent = not xdata.xpath("//Client")
         try:
             self.priority = int(xdata.get('priority'))
         except (ValueError, TypeError):
@@ -256,6 +258,7 @@ class Pkgmgr(Bcfg2.Server.Plugin.PrioDir):
     __author__ = 'bcfg-dev@mcs.anl.gov'
     __child__ = PkgSrc
     __element__ = 'Package'
+    handles_entry_by_name = True
 
     def HandleEvent(self, event):
         '''Handle events and update dispatch table'''
@@ -6,6 +6,7 @@ import sys
 import time
 import copy
 import operator
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Cache
@@ -115,11 +116,33 @@ class ProbeStore(Debuggable):
         database). """
         raise NotImplementedError
 
-    def commit(self):
+    def commit(self, hostname=None):
         """ Commit the current data in the cache to the persistent
         backend store. This is not used with the
         :class:`Bcfg2.Server.Plugins.Probes.DBProbeStore`, because it
-        commits on every change. """
+        commits on every change.
+
+        :param hostname: The client whose data has changed.  If this
+                         is not given, data for all clients is
+                         committed.
+        :type hostname: string
+        """
+        pass
+
+    def shutdown(self):
+        """ Commit any data that has not yet been committed. """
+        pass
+
+    def before_fork(self):
+        """ Acquire any locks that must not be held by another
+        thread when the server forks.  See
+        :func:`Bcfg2.Server.Plugin.base.Plugin.before_fork`. """
+        pass
+
+    def after_fork(self, child):
+        """ Release the locks acquired by :func:`before_fork` in the
+        parent, or recreate them in the child.  See
+        :func:`Bcfg2.Server.Plugin.base.Plugin.after_fork`. """
         pass
 
 
@@ -144,25 +167,51 @@ class DBProbeStore(ProbeStore, Bcfg2.Server.Plugin.DatabaseBacked):
 
     @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
     def set_groups(self, hostname, groups):
-        Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
         olddata = self._groupcache.get(hostname, [])
+        # save the groups before the cache is expired, so that other
+        # server processes that reload them get the new ones
+        self._atomic(self._save_groups)(hostname, groups)
+        Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
         self._groupcache[hostname] = groups
-        for group in groups:
-            try:
-                ProbesGroupsModel.objects.get_or_create(
-                    hostname=hostname,
-                    group=group)
-            except ProbesGroupsModel.MultipleObjectsReturned:
-                ProbesGroupsModel.objects.filter(hostname=hostname,
-                                                 group=group).delete()
-                ProbesGroupsModel.objects.get_or_create(
-                    hostname=hostname,
-                    group=group)
-        ProbesGroupsModel.objects.filter(
-            hostname=hostname).exclude(group__in=groups).delete()
         if olddata != groups:
             self.core.metadata_cache.expire(hostname)
 
+    @staticmethod
+    def _atomic(func):
+        """ Wrap the given function so that it runs in a single
+        database transaction """
+        from Bcfg2.Reporting.Compat import transaction
+        return transaction.atomic(func)
+
+    @staticmethod
+    def _bulk_create(model, records):
+        """ Create the given records in a single query where the
+        installed version of Django supports it (1.4+), or one at a
+        time otherwise """
+        if hasattr(model.objects, "bulk_create"):
+            model.objects.bulk_create(records)
+        else:
+            for record in records:
+                record.save()
+
+    def _save_groups(self, hostname, groups):
+        """ Make the probe groups in the database match the given
+        list, loading the existing groups in one query and writing
+        only the rows that have changed. """
+        existing = set()
+        stale = []
+        for record in ProbesGroupsModel.objects.filter(hostname=hostname):
+            if record.group in existing or record.group not in groups:
+                stale.append(record.pk)
+            else:
+                existing.add(record.group)
+        if stale:
+            ProbesGroupsModel.objects.filter(pk__in=stale).delete()
+        new = [ProbesGroupsModel(hostname=hostname, group=group)
+               for group in set(groups) if group not in existing]
+        if new:
+            self._bulk_create(ProbesGroupsModel, new)
+
     def _load_data(self, hostname):
         Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
         Bcfg2.Server.Cache.expire("Probes", "probedata", hostname)
@@ -178,47 +227,85 @@ class DBProbeStore(ProbeStore, Bcfg2.Server.Plugin.DatabaseBacked):
 
     @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
     def set_data(self, hostname, data):
+        changed = self._atomic(self._save_data)(hostname, data)
         Bcfg2.Server.Cache.expire("Probes", "probedata", hostname)
-        self._datacache[hostname] = ClientProbeDataSet()
-        expire_metadata = False
-        for probe, pdata in data.items():
-            self._datacache[hostname][probe] = pdata
-            try:
-                record, created = ProbesDataModel.objects.get_or_create(
-                    hostname=hostname,
-                    probe=probe)
-            except ProbesDataModel.MultipleObjectsReturned:
-                ProbesDataModel.objects.filter(hostname=hostname,
-                                               probe=probe).delete()
-                record, created = ProbesDataModel.objects.get_or_create(
-                    hostname=hostname,
-                    probe=probe)
-            expire_metadata |= created
-            if record.data != pdata:
-                record.data = pdata
-                record.save()
-                expire_metadata = True
-        qset = ProbesDataModel.objects.filter(
-            hostname=hostname).exclude(probe__in=data.keys())
-        if len(qset):
-            qset.delete()
-            expire_metadata = True
-        if expire_metadata:
+        self._datacache[hostname] = ClientProbeDataSet(data)
+        if changed:
             self.core.metadata_cache.expire(hostname)
 
+    def _save_data(self, hostname, data):
+        """ Make the probe data in the database match the given dict,
+        loading the existing data in one query, deleting and creating
+        rows in bulk, and only updating rows whose data has changed.
+        Returns True if anything was changed. """
+        existing = dict()
+        stale = []
+        for record in ProbesDataModel.objects.filter(hostname=hostname):
+            if record.probe in existing or record.probe not in data:
+                stale.append(record.pk)
+            else:
+                existing[record.probe] = record
+        if stale:
+            ProbesDataModel.objects.filter(pk__in=stale).delete()
+        new = [ProbesDataModel(hostname=hostname, probe=probe, data=pdata)
+               for probe, pdata in data.items() if probe not in existing]
+        if new:
+            self._bulk_create(ProbesDataModel, new)
+        changed = False
+        for probe, record in existing.items():
+            if record.data != data[probe]:
+                record.data = data[probe]
+                record.save()
+                changed = True
+        return bool(stale or new or changed)
+
 
 class XMLProbeStore(ProbeStore):
     """ Caching abstraction layer between ``probed.xml`` and the
-    Probes plugin."""
+    Probes plugin.
+
+    Writing all of ``probed.xml`` every time a client submits probe
+    data would make each submission take time proportional to the
+    number of clients, so instead each changed client is appended to a
+    journal, ``probed.journal``.  When the journal holds more records
+    than there are clients, it is folded back into ``probed.xml``.
+
+    A client's data is written before its cached data is expired, so
+    that other server processes that reload it when they see the
+    expiration get the new data. """
+
+    #: The journal is never compacted if it holds fewer records than
+    #: this
+    min_journal_records = 100
+
     def __init__(self, core, datadir):
         ProbeStore.__init__(self, core, datadir)
         self._fname = os.path.join(datadir, 'probed.xml')
+        self._journal = os.path.join(datadir, 'probed.journal')
+
+        #: The number of records in :attr:`_journal`
+        self._journal_records = 0
+
+        #: Held while reading or writing :attr:`_fname` or
+        #: :attr:`_journal`, so that reloading the data can't miss
+        #: a record that is being written
+        self._write_lock = threading.RLock()
         self._load_data()
 
     def _load_data(self, _=None):
-        """ Load probe data from probed.xml """
-        Bcfg2.Server.Cache.expire("Probes", "probegroups")
-        Bcfg2.Server.Cache.expire("Probes", "probedata")
+        """ Load probe data from probed.xml and probed.journal """
+        self._write_lock.acquire()
+        try:
+            Bcfg2.Server.Cache.expire("Probes", "probegroups")
+            Bcfg2.Server.Cache.expire("Probes", "probedata")
+            self._read_files()
+        finally:
+            self._write_lock.release()
+        self.core.metadata_cache.expire()
+
+    def _read_files(self):
+        """ Read probe data from probed.xml and probed.journal into
+        the cache.  :attr:`_write_lock` must be held. """
         if not os.path.exists(self._fname):
             self.commit()
         try:
@@ -229,69 +316,157 @@ class XMLProbeStore(ProbeStore):
             self.logger.error("Failed to read file probed.xml: %s" % err)
             return
         for client in data.getchildren():
-            self._datacache[client.get('name')] = \
-                ClientProbeDataSet(timestamp=client.get("timestamp"))
-            self._groupcache[client.get('name')] = []
-            for pdata in client:
-                if pdata.tag == 'Probe':
-                    self._datacache[client.get('name')][pdata.get('name')] = \
-                        ProbeData(pdata.get("value"))
-                elif pdata.tag == 'Group':
-                    self._groupcache[client.get('name')].append(
-                        pdata.get('name'))
+            self._load_client(client)
 
-        self.core.metadata_cache.expire()
+        self._journal_records = 0
+        if os.path.exists(self._journal):
+            try:
+                for line in open(self._journal, 'rb'):
+                    try:
+                        client = lxml.etree.XML(
+                            line, parser=Bcfg2.Server.XMLParser)
+                    except lxml.etree.XMLSyntaxError:
+                        # most likely a record that was only partly
+                        # written when the server stopped
+                        self.logger.warning("Skipping malformed record in "
+                                            "%s" % self._journal)
+                        continue
+                    self._load_client(client)
+                    self._journal_records += 1
+            except IOError:
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to read file %s: %s" %
+                                  (self._journal, err))
+
+    def _load_client(self, client):
+        """ Load probe data and groups for a single client from a
+        ``<Client>`` tag """
+        hostname = client.get('name')
+        self._datacache[hostname] = \
+            ClientProbeDataSet(timestamp=client.get("timestamp"))
+        self._groupcache[hostname] = []
+        for pdata in client:
+            if pdata.tag == 'Probe':
+                self._datacache[hostname][pdata.get('name')] = \
+                    ProbeData(pdata.get("value"))
+            elif pdata.tag == 'Group':
+                self._groupcache[hostname].append(pdata.get('name'))
 
     def _load_groups(self, hostname):
         self._load_data(hostname)
 
-    def commit(self):
-        """ Write received probe data to probed.xml """
+    def _get_client_element(self, hostname):
+        """ Get a ``<Client>`` tag describing the probe data and
+        groups for a single client """
+        # make a copy of probe data for this client in case it
+        # submits probe data while we're trying to write it
+        probedata = copy.copy(self._datacache.get(hostname,
+                                                  ClientProbeDataSet()))
+        ctag = lxml.etree.Element('Client', name=hostname,
+                                  timestamp=str(int(probedata.timestamp)))
+        for probe in sorted(probedata):
+            try:
+                lxml.etree.SubElement(ctag, 'Probe', name=probe,
+                                      value=probedata[probe].decode('utf-8'))
+            except AttributeError:
+                lxml.etree.SubElement(ctag, 'Probe', name=probe,
+                                      value=probedata[probe])
+        for group in sorted(self._groupcache.get(hostname, [])):
+            lxml.etree.SubElement(ctag, "Group", name=group)
+        return ctag
+
+    def commit(self, hostname=None):
+        """ Write received probe data.  If ``hostname`` is given, the
+        client is appended to the journal, and its cached data is
+        expired once it has been written; otherwise, all of
+        probed.xml is written. """
+        self._write_lock.acquire()
+        try:
+            if hostname is None:
+                self._compact()
+                return
+            self._append(hostname)
+        finally:
+            self._write_lock.release()
+
+        # expiring the data tells other server processes to reload
+        # it, so keep our own copy, which is already current
+        groups = self._groupcache.get(hostname)
+        data = self._datacache.get(hostname)
+        Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
+        Bcfg2.Server.Cache.expire("Probes", "probedata", hostname)
+        if groups is not None:
+            self._groupcache[hostname] = groups
+        if data is not None:
+            self._datacache[hostname] = data
+        self.core.metadata_cache.expire(hostname)
+
+    def _append(self, hostname):
+        """ Append a client to the journal, and compact the journal
+        if it has grown too large.  :attr:`_write_lock` must be
+        held. """
+        record = lxml.etree.tostring(self._get_client_element(hostname),
+                                     xml_declaration=False) + b'\n'
+        try:
+            jfile = open(self._journal, 'ab')
+            jfile.write(record)
+            jfile.close()
+            self._journal_records += 1
+        except IOError:
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to write %s: %s" %
+                              (self._journal, err))
+            return
+        if self._journal_records > max(len(self._datacache),
+                                       self.min_journal_records):
+            self._compact()
+
+    def _compact(self):
+        """ Write all probe data to probed.xml and remove the journal.
+        :attr:`_write_lock` must be held. """
         top = lxml.etree.Element("Probed")
-        for client, probed in sorted(self._datacache.items()):
-            # make a copy of probe data for this client in case it
-            # submits probe data while we're trying to write
-            # probed.xml
-            probedata = copy.copy(probed)
-            ctag = \
-                lxml.etree.SubElement(top, 'Client', name=client,
-                                      timestamp=str(int(probedata.timestamp)))
-            for probe in sorted(probedata):
-                try:
-                    lxml.etree.SubElement(
-                        ctag, 'Probe', name=probe,
-                        value=self._datacache[client][probe].decode('utf-8'))
-                except AttributeError:
-                    lxml.etree.SubElement(
-                        ctag, 'Probe', name=probe,
-                        value=self._datacache[client][probe])
-            for group in sorted(self._groupcache[client]):
-                lxml.etree.SubElement(ctag, "Group", name=group)
+        for client in sorted(self._datacache.keys()):
+            top.append(self._get_client_element(client))
+        tmpfile = "%s.new" % self._fname
         try:
-            top.getroottree().write(self._fname,
+            top.getroottree().write(tmpfile,
                                     xml_declaration=False,
                                     pretty_print='true')
-        except IOError:
+            os.rename(tmpfile, self._fname)
+        except (IOError, OSError):
             err = sys.exc_info()[1]
             self.logger.error("Failed to write %s: %s" % (self._fname, err))
+            return
+        try:
+            os.unlink(self._journal)
+        except OSError:
+            pass
+        self._journal_records = 0
+
+    def shutdown(self):
+        self.commit()
+    shutdown.__doc__ = ProbeStore.shutdown.__doc__
+
+    def before_fork(self):
+        self._write_lock.acquire()
+    before_fork.__doc__ = ProbeStore.before_fork.__doc__
+
+    def after_fork(self, child):
+        if child:
+            self._write_lock = threading.RLock()
+        else:
+            self._write_lock.release()
+    after_fork.__doc__ = ProbeStore.after_fork.__doc__
 
     def set_groups(self, hostname, groups):
-        Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
-        olddata = self._groupcache.get(hostname, [])
+        # the cached groups are expired by commit() once they have
+        # been written
         self._groupcache[hostname] = groups
-        if olddata != groups:
-            self.core.metadata_cache.expire(hostname)
 
     def set_data(self, hostname, data):
-        Bcfg2.Server.Cache.expire("Probes", "probedata", hostname)
-        self._datacache[hostname] = ClientProbeDataSet()
-        expire_metadata = False
-        for probe, pdata in data.items():
-            olddata = self._datacache[hostname].get(probe, ProbeData(''))
-            self._datacache[hostname][probe] = pdata
-            expire_metadata |= olddata != data
-        if expire_metadata:
-            self.core.metadata_cache.expire(hostname)
+        # the cached data is expired by commit() once it has been
+        # written
+        self._datacache[hostname] = ClientProbeDataSet(data)
 
 
 class ClientProbeDataSet(dict):
@@ -361,7 +536,8 @@ class ProbeData(str):  # pylint: disable=E0012,R0924
 
 class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
     """ Handle universal and group- and host-specific probe files """
-    ignore = re.compile(r'^(\.#.*|.*~|\..*\.(tmp|sw[px])|probed\.xml)$')
+    ignore = re.compile(r'^(\.#.*|.*~|\..*\.(tmp|sw[px])|'
+                        r'probed\.(xml|xml\.new|journal))$')
     probename = \
         re.compile(r'(.*/)?(?P<basename>\S+?)(\.(?P<mode>(?:G\d\d)|H)_\S+)?$')
     bangline = re.compile(r'^#!\s*(?P<interpreter>.*)$')
@@ -371,23 +547,77 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
         self.plugin_name = plugin_name
         Bcfg2.Server.Plugin.EntrySet.__init__(self, r'[0-9A-Za-z_\-]+', path,
                                               Bcfg2.Server.Plugin.SpecificData)
+
+        #: Rendered probes, keyed by the result of
+        #: :func:`_get_cache_key`
+        self._probe_cache = dict()
+
+        #: The groups and hostnames that probes are specific to, or
+        #: None if they need to be recalculated
+        self._specific = None
         Bcfg2.Server.FileMonitor.get_fam().AddMonitor(path, self)
 
     def HandleEvent(self, event):
-        """ handle events on everything but probed.xml """
+        """ handle events on everything but probed.xml and its
+        journal """
         if (event.filename != self.path and
-                not event.filename.endswith("probed.xml")):
+                not self.ignore.match(os.path.basename(event.filename))):
+            self._probe_cache = dict()
+            self._specific = None
             return self.handle_event(event)
 
+    def _get_cache_key(self, metadata):
+        """ Get the key under which probes for the given client are
+        cached.  Clients get the same probes if they are in the same
+        groups (counting only groups that probes are specific to),
+        have the same hostname (if any probes are specific to it),
+        and can or cannot handle unicode probes. """
+        if self._specific is None:
+            groups = set()
+            hosts = set()
+            for entry in list(self.entries.values()):
+                if entry.specific.group:
+                    groups.add(entry.specific.group)
+                elif entry.specific.hostname:
+                    hosts.add(entry.specific.hostname)
+            self._specific = (groups, hosts)
+        groups, hosts = self._specific
+        if metadata.hostname in hosts:
+            hostname = metadata.hostname
+        else:
+            hostname = None
+        return (hostname,
+                frozenset(g for g in metadata.groups if g in groups),
+                bool(metadata.version_info and
+                     metadata.version_info > (1, 3, 1, '', 0)))
+
     def get_probe_data(self, metadata):
         """ Get an XML description of all probes for a client suitable
-        for sending to that client.
+        for sending to that client.  Probes are only rendered once
+        for each combination of groups, hostname, and client version
+        that affects them (see :func:`_get_cache_key`), until the
+        probes change.
 
         :param metadata: The client metadata to get probes for.
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: list of lxml.etree._Element objects, each of which
                   represents one probe.
         """
+        # hold on to the cache that was current when rendering
+        # started, so that probes rendered from entries that change
+        # meanwhile are stored in the discarded cache, not the new one
+        cache = self._probe_cache
+        key = self._get_cache_key(metadata)
+        probes = cache.get(key)
+        if probes is None:
+            probes = cache[key] = self._render_probes(metadata)
+        # the caller takes ownership of the returned elements, so
+        # don't give it the cached ones
+        return [copy.copy(probe) for probe in probes]
+
+    def _render_probes(self, metadata):
+        """ Render all probes for a client.  See
+        :func:`get_probe_data`. """
         ret = []
         build = dict()
         candidates = self.get_matching(metadata)
@@ -472,7 +702,19 @@ class Probes(Bcfg2.Server.Plugin.Probing,
             cgroups.update(groups)
         self.probestore.set_groups(client.hostname, list(cgroups))
         self.probestore.set_data(client.hostname, cdata)
-        self.probestore.commit()
+        self.probestore.commit(client.hostname)
+
+    def shutdown(self):
+        super(Probes, self).shutdown()
+        self.probestore.shutdown()
+
+    def before_fork(self):
+        self.probestore.before_fork()
+    before_fork.__doc__ = Bcfg2.Server.Plugin.Plugin.before_fork.__doc__
+
+    def after_fork(self, child):
+        self.probestore.after_fork(child)
+    after_fork.__doc__ = Bcfg2.Server.Plugin.Plugin.after_fork.__doc__
 
     def ReceiveDataItem(self, client, data):
         """ Receive probe results pertaining to client.  Returns a
@@ -29,14 +29,30 @@ class Rules(Bcfg2.Server.Plugin.PrioDir):
         self._regex_cache = dict()
 
     def HandlesEntry(self, entry, metadata):
-        for src in self.entries.values():
-            for candidate in src.XMLMatch(metadata).xpath("//%s" % entry.tag):
+        for _, index in self._get_matches(metadata):
+            for candidate in self._candidates(entry, index):
                 if self._matches(entry, metadata, candidate):
                     return True
         return False
 
     HandleEntry = Bcfg2.Server.Plugin.PrioDir.BindEntry
 
+    def _key(self, element):
+        if element.tag == "Path":
+            # trailing slashes are ignored when matching Path entries;
+            # see _matches() below
+            return (element.get("name") or "").rstrip("/")
+        return Bcfg2.Server.Plugin.PrioDir._key(self, element)
+
+    def _candidates(self, entry, index):
+        if self._regex_enabled:
+            # any rule might be a regex that matches the entry
+            rv = []
+            for candidates in index.get(entry.tag, dict()).values():
+                rv.extend(candidates)
+            return rv
+        return Bcfg2.Server.Plugin.PrioDir._candidates(self, entry, index)
+
     def _matches(self, entry, metadata, candidate):
         if Bcfg2.Server.Plugin.PrioDir._matches(self, entry, metadata,
                                                 candidate):
@@ -43,6 +43,10 @@ class SEModules(Bcfg2.Server.Plugin.GroupSpool):
     #: SEModules manages ``SEModule`` entries
     entry_type = 'SEModule'
 
+    #: Whether or not SEModules handles an entry only depends on the
+    #: entry name
+    handles_entry_by_name = True
+
     def _get_module_filename(self, entry):
         """ GroupSpool stores entries as /foo.pp, but we want people
         to be able to specify module entries as name='foo' or
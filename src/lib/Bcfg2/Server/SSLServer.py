@@ -12,6 +12,8 @@ import threading
 import time
 from Bcfg2.Compat import xmlrpclib, SimpleXMLRPCServer, SocketServer, \
     b64decode
+from Bcfg2.Utils import CONTENT_ENCODINGS, DecompressedSizeError, \
+    get_compressor, get_decompressor, select_content_encoding
 
 
 class XMLRPCACLCheckException(Exception):
@@ -155,16 +157,32 @@ class SSLServer(SocketServer.TCPServer, object):
             self.logger.error("Unknown protocol %s" % (protocol))
             raise Exception("unknown protocol %s" % protocol)
 
+        #: The SSL context shared by all connections, so that the
+        #: key, certificate, and CA are only loaded once, and so that
+        #: clients can resume TLS sessions.  This is None on versions
+        #: of Python without :class:`ssl.SSLContext`.
+        self.ssl_context = None
+        if hasattr(ssl, "SSLContext"):
+            self.ssl_context = ssl.SSLContext(self.ssl_protocol)
+            self.ssl_context.verify_mode = self.mode
+            if self.certfile:
+                self.ssl_context.load_cert_chain(self.certfile, self.keyfile)
+            if self.ca:
+                self.ssl_context.load_verify_locations(self.ca)
+
     def get_request(self):
         (sock, sockinfo) = self.socket.accept()
         sock.settimeout(self.timeout)  # pylint: disable=E1101
-        sslsock = ssl.wrap_socket(sock,
-                                  server_side=True,
-                                  certfile=self.certfile,
-                                  keyfile=self.keyfile,
-                                  cert_reqs=self.mode,
-                                  ca_certs=self.ca,
-                                  ssl_version=self.ssl_protocol)
+        if self.ssl_context is not None:
+            sslsock = self.ssl_context.wrap_socket(sock, server_side=True)
+        else:
+            sslsock = ssl.wrap_socket(sock,
+                                      server_side=True,
+                                      certfile=self.certfile,
+                                      keyfile=self.keyfile,
+                                      cert_reqs=self.mode,
+                                      ca_certs=self.ca,
+                                      ssl_version=self.ssl_protocol)
         return sslsock, sockinfo
 
     def close_request(self, request):
@@ -188,14 +206,67 @@ class SSLServer(SocketServer.TCPServer, object):
 class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     """ XML-RPC request handler.
 
-    Adds support for HTTP authentication.
+    Adds support for HTTP authentication, and for compressed requests
+    and responses.  Connections are kept open for further requests
+    (HTTP/1.1 keep-alive) until the client closes them or they are
+    idle for longer than the server timeout.
     """
 
+    protocol_version = "HTTP/1.1"
+
+    #: Once a client has authenticated on a connection, later requests
+    #: on the same connection with the same credentials are not
+    #: authenticated again for this many seconds.  This must be less
+    #: than the time the Metadata plugin keeps the client name it
+    #: found while authenticating (90 seconds).
+    auth_cache_ttl = 60
+
+    #: Responses larger than this many bytes are compressed if the
+    #: client accepts a content coding we support
+    encode_threshold = 1400
+
+    #: Compressed responses are compressed and sent in pieces of this
+    #: many bytes
+    compress_chunk_size = 256 * 1024
+
+    #: Requests are read in pieces of this many bytes
+    max_chunk_size = 10 * 1024 * 1024
+
+    #: Compressed requests that decompress to more than this many
+    #: bytes are refused
+    max_decompressed_size = 10 * max_chunk_size
+
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger(self.__class__.__name__)
+
+        #: A tuple of (Authorization header, time) for the last
+        #: successful authentication on this connection
+        self._authenticated = None
         SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.__init__(self, *args,
                                                                **kwargs)
 
+    def setup(self):
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.setup(self)
+        # responses are written in several pieces (the status line,
+        # headers, and body), so don't delay sending them while
+        # waiting for acknowledgements
+        try:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                    1)
+        except socket.error:
+            pass
+
+    def handle_one_request(self):
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle_one_request(
+                self)
+        except (socket.error, ssl.SSLError):
+            # clients may close a kept-alive connection at any time
+            # between requests, without shutting down SSL first
+            self.logger.debug("Connection from %s closed: %s" %
+                              (self.client_address[0], sys.exc_info()[1]))
+            self.close_connection = 1
+
     def authenticate(self):
         try:
             header = self.headers['Authorization']
@@ -227,6 +298,12 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         """
         if not SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.parse_request(self):
             return False
+        header = self.headers.get('Authorization')
+        if (self._authenticated is not None and
+                self._authenticated[0] == header and
+                time.time() - self._authenticated[1] < self.auth_cache_ttl):
+            return True
+        self._authenticated = None
         try:
             if not self.authenticate():
                 self.logger.error("Authentication Failure")
@@ -236,23 +313,104 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             self.logger.error("Unexpected Authentication Failure", exc_info=1)
             self.send_error(401, self.responses[401][0])
             return False
+        self._authenticated = (header, time.time())
         return True
 
+    def _write(self, data):
+        """ Write data to the client, retrying if the SSL layer asks
+        us to. """
+        failcount = 0
+        while True:
+            try:
+                # If we hit SSL3_WRITE_PENDING here try to resend.
+                self.wfile.write(data)
+                return
+            except ssl.SSLError:
+                e = sys.exc_info()[1]
+                if str(e).find("SSL3_WRITE_PENDING") < 0:
+                    raise
+                self.logger.error("SSL3_WRITE_PENDING")
+                failcount += 1
+                if failcount < 5:
+                    continue
+                raise
+
+    def _send_response_body(self, response):
+        """ Send a successful XML-RPC response, compressed with the
+        best content coding the client accepts if it is larger than
+        :attr:`encode_threshold`.  Compressed responses are
+        compressed and written a piece at a time with chunked
+        transfer coding, or, for HTTP/1.0 clients, with the end of
+        the response marked by closing the connection. """
+        encoding = None
+        if len(response) > self.encode_threshold:
+            encoding = select_content_encoding(
+                self.headers.get("accept-encoding", ""))
+        self.send_response(200)
+        self.send_header("Content-type", "text/xml")
+        # advertise the content codings we can accept, so that the
+        # client can compress later requests (RFC 7694)
+        self.send_header("Accept-Encoding", ", ".join(CONTENT_ENCODINGS))
+        if encoding is None:
+            self.send_header("Content-length", str(len(response)))
+            self.end_headers()
+            self._write(response)
+        else:
+            self.send_header("Content-Encoding", encoding)
+            chunked = self.request_version != "HTTP/1.0"
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.close_connection = 1
+            self.end_headers()
+            compressor = get_compressor(encoding)
+            for start in range(0, len(response), self.compress_chunk_size):
+                data = compressor.compress(
+                    response[start:start + self.compress_chunk_size])
+                if data:
+                    self._write_chunk(data, chunked)
+            self._write_chunk(compressor.flush(), chunked)
+            if chunked:
+                self._write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data, chunked):
+        """ Write a piece of a response body, with chunked transfer
+        coding if ``chunked`` is True. """
+        if not chunked:
+            self._write(data)
+        elif data:
+            self._write(("%x\r\n" % len(data)).encode('ascii') + data +
+                        b"\r\n")
+
     def do_POST(self):
         try:
-            max_chunk_size = 10 * 1024 * 1024
+            encoding = self.headers.get("content-encoding", "identity")
+            encoding = encoding.strip().lower()
+            decompressor = None
+            if encoding != "identity":
+                try:
+                    decompressor = get_decompressor(
+                        encoding, max_length=self.max_decompressed_size)
+                except ValueError:
+                    self.logger.error("Unsupported content coding %s from "
+                                      "%s" % (encoding, self.client_address))
+                    self.send_error(415, self.responses[415][0])
+                    return
+
             size_remaining = int(self.headers["content-length"])
             L = []
             while size_remaining:
-                chunk_size = min(size_remaining, max_chunk_size)
-                chunk = self.rfile.read(chunk_size).decode('utf-8')
+                chunk_size = min(size_remaining, self.max_chunk_size)
+                chunk = self.rfile.read(chunk_size)
                 if not chunk:
                     break
+                size_remaining -= len(chunk)
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
                 L.append(chunk)
-                size_remaining -= len(L[-1])
-            data = ''.join(L)
-            if data is None:
-                return  # response has been sent
+            if decompressor is not None:
+                L.append(decompressor.flush())
+            data = b''.join(L).decode('utf-8')
 
             response = self.server._marshaled_dispatch(self.client_address,
                                                        data)
@@ -261,11 +419,22 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         except XMLRPCACLCheckException:
             self.send_error(401, self.responses[401][0])
             self.end_headers()
+        except DecompressedSizeError:
+            self.logger.error("Request from %s decompressed to more than %s "
+                              "bytes" % (self.client_address,
+                                         self.max_decompressed_size))
+            # the rest of the request is not read
+            self.close_connection = 1
+            self.send_error(413, self.responses[413][0])
         except:  # pylint: disable=W0702
             self.logger.error("Unexpected dispatch error for %s: %s" %
                               (self.client_address, sys.exc_info()[1]))
             try:
                 self.send_response(500)
+                # the request may not have been read completely, so it
+                # is not safe to read another from this connection
+                self.send_header("Connection", "close")
+                self.close_connection = 1
                 self.send_header("Content-length", "0")
                 self.end_headers()
             except:
@@ -275,27 +444,8 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 raise
         else:
             # got a valid XML RPC response
-            client_address = self.request.getpeername()
             try:
-                self.send_response(200)
-                self.send_header("Content-type", "text/xml")
-                self.send_header("Content-length", str(len(response)))
-                self.end_headers()
-                failcount = 0
-                while True:
-                    try:
-                        # If we hit SSL3_WRITE_PENDING here try to resend.
-                        self.wfile.write(response)
-                        break
-                    except ssl.SSLError:
-                        e = sys.exc_info()[1]
-                        if str(e).find("SSL3_WRITE_PENDING") < 0:
-                            raise
-                        self.logger.error("SSL3_WRITE_PENDING")
-                        failcount += 1
-                        if failcount < 5:
-                            continue
-                        raise
+                self._send_response_body(response)
             except socket.error:
                 err = sys.exc_info()[1]
                 if isinstance(err, socket.timeout):
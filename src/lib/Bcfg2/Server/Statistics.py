@@ -58,6 +58,10 @@ class Statistic(object):
 class Statistics(object):
     """ A collection of named :class:`Statistic` objects. """
 
+    #: The default upper bounds (in seconds) of the buckets used by
+    #: :func:`add_histogram_value`
+    histogram_buckets = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
     def __init__(self):
         self.data = dict()
 
@@ -77,6 +81,30 @@ class Statistics(object):
         else:
             self.data[name].add_value(value)
 
+    def add_histogram_value(self, name, value, buckets=None):
+        """ Add a value to a histogram.  A histogram is kept as a set
+        of :class:`Statistic` objects, one per bucket, named
+        ``<name>:<=<bound>`` for the smallest bucket bound that is
+        greater than or equal to the value, or ``<name>:><bound>`` if
+        the value is greater than the largest bound.  The count of
+        each bucket statistic is the number of values in that bucket.
+
+        :param name: The name of the histogram
+        :type name: string
+        :param value: The value to add to the histogram
+        :type value: int or float
+        :param buckets: A sorted list of bucket upper bounds.
+                        Defaults to :attr:`histogram_buckets`.
+        :type buckets: list
+        """
+        if buckets is None:
+            buckets = self.histogram_buckets
+        for bound in buckets:
+            if value <= bound:
+                self.add_value("%s:<=%s" % (name, bound), value)
+                return
+        self.add_value("%s:>%s" % (name, buckets[-1]), value)
+
     def display(self):
         """ Return a dict of all :class:`Statistic` object values.
         Keys are the statistic names, and values are tuples of the
@@ -11,8 +11,21 @@ import shlex
 import sys
 import subprocess
 import threading
+import zlib
 from Bcfg2.Compat import input, any  # pylint: disable=W0622
 
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+#: The HTTP content codings supported by :func:`get_compressor` and
+#: :func:`get_decompressor`, most preferred first
+CONTENT_ENCODINGS = ['gzip']
+if HAS_ZSTD:
+    CONTENT_ENCODINGS.insert(0, 'zstd')
+
 
 class ClassName(object):
     """ This very simple descriptor class exists only to get the name
@@ -355,3 +368,167 @@ def is_string(strng, encoding):
         return True
     except:  # pylint: disable=W0702
         return False
+
+
+def get_compressor(encoding, level=None):
+    """ Get an object that compresses data incrementally with the
+    given HTTP content coding.  The object has ``compress(data)`` and
+    ``flush()`` methods that return compressed data, like the objects
+    returned by :func:`zlib.compressobj`.
+
+    :param encoding: The content coding to use; one of
+                     :attr:`CONTENT_ENCODINGS`
+    :type encoding: string
+    :param level: The compression level, or None for the default
+    :type level: int
+    :raises: ValueError if the content coding is not supported
+    """
+    if encoding == 'gzip':
+        if level is None:
+            level = 6
+        # a window size of 16 + MAX_WBITS produces a gzip header and
+        # trailer rather than a zlib one
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd' and HAS_ZSTD:
+        if level is None:
+            level = 3
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("Unsupported content coding %s" % encoding)
+
+
+class DecompressedSizeError(Exception):
+    """ Raised by the objects returned by :func:`get_decompressor`
+    when the decompressed data is longer than the ``max_length``
+    they were given. """
+    pass
+
+
+class _LimitedDecompressor(object):
+    """ Base class for decompressors that raise
+    :exc:`DecompressedSizeError` once they have produced more than
+    ``max_length`` bytes in total. """
+
+    def __init__(self, max_length):
+        #: The number of bytes that may still be produced
+        self.remaining = max_length
+
+    def _count(self, data):
+        """ Count decompressed data against the limit, and return
+        it. """
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise DecompressedSizeError("Decompressed data is too long")
+        return data
+
+
+class _LimitedZlibDecompressor(_LimitedDecompressor):
+    """ A :func:`zlib.decompressobj` that never produces more than
+    one byte past the limit, however well the data compresses. """
+
+    def __init__(self, wbits, max_length):
+        _LimitedDecompressor.__init__(self, max_length)
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data):
+        """ Decompress data """
+        # input that would produce more than max_length bytes is left
+        # in unconsumed_tail, and the limit is exceeded anyway
+        return self._count(self._decompressor.decompress(
+            data, self.remaining + 1))
+
+    def flush(self):
+        """ Get any remaining decompressed data """
+        return self._count(self._decompressor.flush())
+
+
+class _LimitedZstdDecompressor(_LimitedDecompressor):
+    """ A zstd decompressor that stops once it has produced more than
+    the limit.  zstd decompression objects can't limit their output,
+    so data is decompressed with a stream writer, which hands the
+    output to :func:`write` in small pieces. """
+
+    def __init__(self, max_length):
+        _LimitedDecompressor.__init__(self, max_length)
+        self._output = []
+        self._writer = zstandard.ZstdDecompressor().stream_writer(self)
+
+    def write(self, data):
+        """ Receive a piece of decompressed data from the stream
+        writer """
+        self._output.append(self._count(data))
+        return len(data)
+
+    def decompress(self, data):
+        """ Decompress data """
+        self._writer.write(data)
+        rv = b''.join(self._output)
+        self._output = []
+        return rv
+
+    def flush(self):
+        """ Get any remaining decompressed data """
+        return b''
+
+
+def get_decompressor(encoding, max_length=None):
+    """ Get an object that decompresses data incrementally with the
+    given HTTP content coding.  The object has ``decompress(data)``
+    and ``flush()`` methods that return decompressed data, like the
+    objects returned by :func:`zlib.decompressobj`.
+
+    :param encoding: The content coding to use; one of
+                     :attr:`CONTENT_ENCODINGS`
+    :type encoding: string
+    :param max_length: The maximum total length of the decompressed
+                       data.  If this is exceeded, the object raises
+                       :exc:`DecompressedSizeError`.  None means no
+                       limit.
+    :type max_length: int
+    :raises: ValueError if the content coding is not supported
+    """
+    if encoding in ['gzip', 'x-gzip']:
+        if max_length is not None:
+            return _LimitedZlibDecompressor(16 + zlib.MAX_WBITS, max_length)
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd' and HAS_ZSTD:
+        if max_length is not None:
+            return _LimitedZstdDecompressor(max_length)
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unsupported content coding %s" % encoding)
+
+
+def select_content_encoding(accept, supported=None):
+    """ Pick the most preferred supported content coding that is
+    acceptable according to the value of an ``Accept-Encoding``
+    header.  Quality values are only used to exclude codings with a
+    quality of 0.  ``*`` only matches codings that are not listed
+    explicitly.
+
+    :param accept: The value of the ``Accept-Encoding`` header
+    :type accept: string
+    :param supported: The content codings to choose from, most
+                      preferred first.  Defaults to
+                      :attr:`CONTENT_ENCODINGS`.
+    :type supported: list of strings
+    :returns: string - The content coding to use, or None if the data
+              should not be compressed
+    """
+    if supported is None:
+        supported = CONTENT_ENCODINGS
+    qualities = dict()
+    for item in accept.split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        qualities[coding] = quality
+    for coding in supported:
+        if qualities.get(coding, qualities.get('*', 0)) > 0:
+            return coding
+    return None
@@ -0,0 +1,133 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+from mock import Mock
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Client import Client, Proxy
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestClient(Bcfg2TestCase):
+    config = b'<Configuration revision="1" version="2.0"/>'
+
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("probe_timeout")
+        set_setup_default("bundle_quick", False)
+        set_setup_default("remove", "none")
+        set_setup_default("server", "https://localhost:6789")
+        set_setup_default("file")
+        set_setup_default("profile")
+        set_setup_default("decision", "none")
+        self.tmpdir = tempfile.mkdtemp()
+        Bcfg2.Options.setup.cache = os.path.join(self.tmpdir, "config.xml")
+
+    def tearDown(self):
+        Bcfg2.Options.setup.cache = None
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        client = Client()
+        client.run_probes = Mock()
+        client._proxy = Mock()
+        client.fatal_error = Mock(side_effect=SystemExit)
+        return client
+
+    def write_cache(self, data):
+        open(Bcfg2.Options.setup.cache, 'wb').write(data)
+
+    def read_cache(self):
+        return open(Bcfg2.Options.setup.cache, 'rb').read()
+
+    def test_read_config_cache(self):
+        client = self.get_obj()
+        self.assertIsNone(client.read_config_cache())
+
+        self.write_cache(b"<Configuration/>")
+        self.assertIsNone(client.read_config_cache())
+
+        self.write_cache(self.config)
+        self.assertEqual(client.read_config_cache(),
+                         (self.config, hashlib.sha256(self.config).hexdigest(),
+                          "1"))
+
+    def test_get_config(self):
+        client = self.get_obj()
+        client.proxy.GetConfig.return_value = self.config.decode('utf-8')
+
+        # without a cached configuration, the configuration is
+        # downloaded and cached
+        self.assertEqual(client.get_config(), self.config)
+        client.proxy.GetConfig.assert_called_with()
+        self.assertEqual(self.read_cache(), self.config)
+
+        # with one, the digest and revision are sent, and a changed
+        # configuration replaces the cached copy
+        new = b'<Configuration revision="2" version="2.0"/>'
+        client.proxy.GetConfig.return_value = new.decode('utf-8')
+        self.assertEqual(client.get_config(), new)
+        client.proxy.GetConfig.assert_called_with(
+            hashlib.sha256(self.config).hexdigest(), "1")
+        self.assertEqual(self.read_cache(), new)
+
+        # the cached copy is used if the server says it is current
+        client.proxy.GetConfig.return_value = \
+            Client.unmodified_config.decode('utf-8')
+        self.assertEqual(client.get_config(), new)
+        client.proxy.GetConfig.assert_called_with(
+            hashlib.sha256(new).hexdigest(), "2")
+        self.assertEqual(self.read_cache(), new)
+
+    def test_get_config_old_server(self):
+        """ servers that don't take a digest are asked again without
+        it """
+        client = self.get_obj()
+        self.write_cache(self.config)
+        new = b'<Configuration revision="2" version="2.0"/>'
+
+        for error in [
+                xmlrpclib.Fault(1, "GetConfig() takes exactly 2 arguments "
+                                "(4 given)"),
+                Proxy.ProxyError(xmlrpclib.Fault(
+                    1, "TypeError:GetConfig() takes 2 positional arguments "
+                    "but 4 were given"))]:
+            def get_config(*args):
+                if args:
+                    raise error
+                return new.decode('utf-8')
+
+            client.proxy.GetConfig = Mock(side_effect=get_config)
+            self.assertEqual(client.get_config(), new)
+            self.assertEqual(client.proxy.GetConfig.call_count, 2)
+            client.proxy.GetConfig.assert_called_with()
+            self.assertEqual(self.read_cache(), new)
+            self.write_cache(self.config)
+
+    def test_get_config_error(self):
+        """ other failures are fatal, and the cached configuration
+        is kept """
+        client = self.get_obj()
+        self.write_cache(self.config)
+
+        for error in [xmlrpclib.Fault(1, "Critical failure: Client "
+                                      "metadata resolution error"),
+                      Proxy.ProxyError("Server failure: timed out")]:
+            client.proxy.GetConfig = Mock(side_effect=error)
+            self.assertRaises(SystemExit, client.get_config)
+            client.proxy.GetConfig.assert_called_once_with(
+                hashlib.sha256(self.config).hexdigest(), "1")
+            self.assertTrue(client.fatal_error.called)
+            client.fatal_error.reset_mock()
+            self.assertEqual(self.read_cache(), self.config)
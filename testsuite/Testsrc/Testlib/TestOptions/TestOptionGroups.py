@@ -153,3 +153,13 @@ class TestWildcardSectionGroups(OptionTestCase):
         self.assertEqual(self.results.five_three_bar, "bar three")
         self.assertItemsEqual(self.results.sections,
                               ["five:one", "five:two", "five:three"])
+
+    @make_config(config)
+    def test_wildcard_section_groups_reread(self, config_file):
+        """reading config again does not duplicate wildcard options."""
+        self.parser.parse(["-C", config_file])
+        group = self.options[0]
+        self.assertEqual(len(group), 4)
+        self.assertItemsEqual(group.from_config(self.parser._cfp),
+                              ["four:one", "four:two"])
+        self.assertEqual(len(group), 4)
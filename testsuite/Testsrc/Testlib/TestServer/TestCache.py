@@ -1,5 +1,7 @@
 import os
 import sys
+import time
+from mock import Mock, MagicMock, patch
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -12,6 +14,8 @@ while path != "/":
     path = os.path.dirname(path)
 from common import *
 
+import Bcfg2.Server.Cache
+import Bcfg2.Server.Statistics
 from Bcfg2.Server.Cache import *
 
 
@@ -52,3 +56,227 @@ class TestCache(Bcfg2TestCase):
         probe_cache2 = Cache("Probes", "data")
         self.assertItemsEqual(list(iter(probe_cache)),
                               list(iter(probe_cache2)))
+
+    def test_expire_exact(self):
+        cache = Cache("Packages", "pkg_groups", "collection1")
+        cache['groups1'] = set(['foo'])
+        cache['groups2'] = set(['bar'])
+        cache.expire("groups1")
+        self.assertItemsEqual(list(iter(cache)), ["groups2"])
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+    def test_expire_hooks(self):
+        hook = Mock()
+        add_expire_hook(hook)
+        try:
+            expire("hooks.example.com")
+            hook.assert_called_with(("hooks.example.com",), False, 0)
+        finally:
+            remove_expire_hook(hook)
+        hook.reset_mock()
+        expire("foo.example.com")
+        self.assertFalse(hook.called)
+        # removing a hook that isn't registered is harmless
+        remove_expire_hook(hook)
+
+    @patch("Bcfg2.Server.Cache._derived", set())
+    def test_derived(self):
+        add_derived("Cfg", "render")
+        self.assertTrue(is_derived(("Cfg", "render")))
+        self.assertTrue(is_derived(("Cfg", "render", "/etc/motd")))
+        self.assertFalse(is_derived(("Cfg", )))
+        self.assertFalse(is_derived(("Cfg", "verify", "/etc/motd")))
+        self.assertFalse(is_derived(()))
+
+
+class TestCacheRegistry(Bcfg2TestCase):
+    def setUp(self):
+        self.registry = Bcfg2.Server.Cache._CacheRegistry()
+
+    def test_index(self):
+        foo = frozenset(["Metadata", "foo.example.com"])
+        bar = frozenset(["Probes", "probedata", "bar.example.com"])
+        self.registry[foo] = 1
+        self.registry[bar] = 2
+        self.assertItemsEqual(self.registry.iterate("Metadata"), [foo])
+        self.assertItemsEqual(self.registry.iterate("Probes"), [])
+        self.assertItemsEqual(self.registry.iterate("Probes", "probedata"),
+                              [bar])
+        self.assertItemsEqual(self.registry.iter_all("Probes"), [bar])
+        self.assertItemsEqual(self.registry.iter_all(), [foo, bar])
+        self.assertItemsEqual(self.registry.iter_all("bogus"), [])
+
+        del self.registry[foo]
+        self.assertItemsEqual(self.registry.iterate("Metadata"), [])
+        self.assertNotIn("Metadata", self.registry._tag_index)
+
+        self.assertEqual(self.registry.pop(bar), 2)
+        self.assertEqual(self.registry._tag_index, dict())
+
+        self.registry.update({foo: 3})
+        self.assertEqual(self.registry.setdefault(bar, 4), 4)
+        self.assertItemsEqual(self.registry.iter_all("foo.example.com"),
+                              [foo])
+        self.registry.clear()
+        self.assertEqual(self.registry._tag_index, dict())
+        self.assertItemsEqual(self.registry.iter_all(), [])
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare the tag index to a full scan over 100k entries """
+        def scan_all(registry, *tags):
+            tags = frozenset(tags)
+            return [key for key in list(registry.keys())
+                    if key.issuperset(tags)]
+
+        def scan_iterate(registry, *tags):
+            tags = frozenset(tags)
+            return [key for key in list(registry.keys())
+                    if (key.issuperset(tags) and
+                        len(key.difference(tags)) == 1)]
+
+        hosts = ["host%d.example.com" % i for i in range(25000)]
+        for host in hosts:
+            self.registry[frozenset(["Metadata", host])] = host
+            self.registry[frozenset(["Probes", "probegroups", host])] = host
+            self.registry[frozenset(["Probes", "probedata", host])] = host
+        for i in range(25000):
+            self.registry[frozenset(["Packages", "pkg_sets",
+                                     "collection%d" % (i % 10),
+                                     "set%d" % i])] = i
+        self.assertEqual(len(self.registry), 100000)
+
+        queries = [("Packages", "pkg_sets", "collection3"),
+                   ("Probes", "probegroups", hosts[100]),
+                   (hosts[200], )]
+
+        start = time.time()
+        for tags in queries:
+            expected = scan_all(self.registry, *tags)
+        scan_time = time.time() - start
+
+        start = time.time()
+        for tags in queries:
+            actual = list(self.registry.iter_all(*tags))
+        index_time = time.time() - start
+
+        self.assertItemsEqual(actual, expected)
+        report_benchmark("iter_all() on %d entries: scan %.4fs, index %.4fs" %
+                         (len(self.registry), scan_time, index_time))
+
+        start = time.time()
+        expected = scan_iterate(self.registry, "Packages", "pkg_sets",
+                                "collection3")
+        scan_time = time.time() - start
+
+        start = time.time()
+        actual = list(self.registry.iterate("Packages", "pkg_sets",
+                                            "collection3"))
+        index_time = time.time() - start
+
+        self.assertItemsEqual(actual, expected)
+        self.assertEqual(len(actual), 2500)
+        report_benchmark("iterate() on %d entries: scan %.4fs, index %.4fs" %
+                         (len(self.registry), scan_time, index_time))
+
+
+class TestCachePolicy(Bcfg2TestCase):
+    def setUp(self):
+        self.registry = Bcfg2.Server.Cache._CacheRegistry()
+        self.cache = Bcfg2.Server.Cache._Cache(self.registry,
+                                               frozenset(["Metadata"]),
+                                               namespace="Metadata")
+
+    def tearDown(self):
+        Bcfg2.Server.Statistics.stats.data.clear()
+
+    def test_max_entries(self):
+        self.registry.set_policy("Metadata", max_entries=2)
+        other = Bcfg2.Server.Cache._Cache(self.registry,
+                                          frozenset(["Probes"]))
+        other['foo'] = 'probes'
+        self.cache['foo'] = 1
+        self.cache['bar'] = 2
+        self.assertEqual(self.cache['foo'], 1)
+        self.cache['baz'] = 3
+        # bar was the least recently used item
+        self.assertItemsEqual(self.cache.keys(), ['foo', 'baz'])
+        self.assertItemsEqual(other.keys(), ['foo'])
+        self.cache['quux'] = 4
+        self.assertItemsEqual(self.cache.keys(), ['baz', 'quux'])
+        stats = Bcfg2.Server.Statistics.stats.display()
+        self.assertEqual(stats['Cache:Metadata:eviction'][3], 2)
+
+        # replacing an item does not evict anything
+        self.cache['baz'] = 5
+        self.assertItemsEqual(self.cache.keys(), ['baz', 'quux'])
+
+        # deleted items stop counting against the limit
+        del self.cache['baz']
+        self.cache['foo'] = 6
+        self.assertItemsEqual(self.cache.keys(), ['foo', 'quux'])
+
+    def test_set_policy_existing(self):
+        for i in range(10):
+            self.cache['host%d' % i] = i
+        self.registry.set_policy("Metadata", max_entries=4)
+        self.assertEqual(len(self.cache), 4)
+        self.registry.set_policy("Metadata")
+        self.assertIsNone(self.registry.get_policy("Metadata"))
+        for i in range(10):
+            self.cache['host%d' % i] = i
+        self.assertEqual(len(self.cache), 10)
+
+    @patch("time.time")
+    def test_max_age(self, mock_time):
+        mock_time.return_value = 100
+        self.registry.set_policy("Metadata", max_age=60)
+        self.cache['foo'] = 1
+        mock_time.return_value = 150
+        self.cache['bar'] = 2
+        self.assertEqual(self.cache.get('foo'), 1)
+        mock_time.return_value = 170
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(self.cache.get('bar'), 2)
+        self.assertItemsEqual(self.cache.keys(), ['bar'])
+        mock_time.return_value = 250
+        self.assertEqual(len(self.cache), 0)
+
+        stats = Bcfg2.Server.Statistics.stats.display()
+        self.assertEqual(stats['Cache:Metadata:eviction'][3], 2)
+        # two hits and one miss
+        self.assertEqual(stats['Cache:Metadata:hit'][3], 3)
+        self.assertAlmostEqual(stats['Cache:Metadata:hit'][2], 2.0 / 3)
+
+    def test_max_size(self):
+        self.registry.set_policy("Metadata", max_size=20000)
+        for i in range(10):
+            self.cache['host%d' % i] = "x" * 5000
+        self.assertEqual(len(self.cache), 3)
+        self.assertItemsEqual(self.cache.keys(),
+                              ['host7', 'host8', 'host9'])
+        policy = self.registry.get_policy("Metadata")
+        self.assertLessEqual(policy.size, 20000)
+        del self.cache['host9']
+        self.assertEqual(len(policy), 2)
+        self.assertLessEqual(policy.size, 15000)
+        self.registry.clear()
+        self.assertEqual(len(policy), 0)
+        self.assertEqual(policy.size, 0)
+
+    def test_sizeof(self):
+        self.assertGreater(Bcfg2.Server.Cache._sizeof(["x" * 1000] * 2),
+                           1000)
+        self.assertGreater(Bcfg2.Server.Cache._sizeof(dict(a="x" * 1000)),
+                           1000)
+        lst = []
+        lst.append(lst)
+        self.assertGreater(Bcfg2.Server.Cache._sizeof(lst), 0)
+
+    def test_sizeof_limit(self):
+        data = dict(("key%d" % i, "x" * 100) for i in range(1000))
+        self.assertGreater(Bcfg2.Server.Cache._sizeof(data),
+                           Bcfg2.Server.Cache._sizeof(data, limit=100))
+        self.assertLess(Bcfg2.Server.Cache._sizeof(data, limit=100),
+                        sys.getsizeof(data) + 100 * sys.getsizeof("x" * 100))
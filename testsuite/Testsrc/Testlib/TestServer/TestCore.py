@@ -0,0 +1,642 @@
+import os
+import sys
+import copy
+import hashlib
+import lxml.etree
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+import Bcfg2.Server.Cache
+import Bcfg2.Server.Plugin
+import Bcfg2.Server.Plugins.Rules
+from Bcfg2.Server.Core import *
+
+
+class FakeMetadata(object):
+    """ just enough of a client metadata object to build and
+    fingerprint a configuration """
+
+    def __init__(self, hostname, groups=None, **kwargs):
+        self.hostname = hostname
+        self.groups = set(groups or [])
+        self.bundles = set()
+        self.profile = None
+        self.connectors = []
+        self.query = Mock()
+        self.__dict__.update(kwargs)
+
+
+class FakeGenerator(Bcfg2.Server.Plugin.Generator):
+    """ a generator that binds Path entries listed in ``Entries``
+    with the client's groups, and counts how often it binds them """
+    sort_order = 500
+
+    def __init__(self, name="FakeGenerator", paths=None,
+                 host_independent=True):
+        self.name = name
+        self.host_independent = host_independent
+        self.bound = []
+        self.Entries = dict(Path=dict())
+        for path in paths or ["/etc/foo"]:
+            self.Entries["Path"][path] = self.bind_entry
+
+    def is_host_independent(self, entry, metadata):
+        return self.host_independent
+
+    def bind_entry(self, entry, metadata):
+        self.bound.append((entry.get("name"), metadata.hostname))
+        entry.set("type", "file")
+        entry.text = "groups: %s" % " ".join(sorted(metadata.groups))
+        return entry
+
+
+class TestMetadataFingerprint(Bcfg2TestCase):
+    def test_metadata_fingerprint(self):
+        metadata = FakeMetadata("foo.example.com", groups=["a", "b"],
+                                Probes=dict(os="debian"))
+        fingerprint = metadata_fingerprint(metadata)
+        self.assertEqual(fingerprint, metadata_fingerprint(metadata))
+
+        # equal data fingerprints identically, no matter how it was
+        # built or in what order
+        self.assertEqual(
+            fingerprint,
+            metadata_fingerprint(FakeMetadata("foo.example.com",
+                                              groups=["b", "a"],
+                                              Probes=dict(os="debian"))))
+
+        # the query object is ignored
+        metadata.query = Mock()
+        self.assertEqual(fingerprint, metadata_fingerprint(metadata))
+
+        for attr, value in [("groups", set(["a"])),
+                            ("profile", "a"),
+                            ("Probes", dict(os="redhat"))]:
+            other = FakeMetadata("foo.example.com", groups=["a", "b"],
+                                 Probes=dict(os="debian"))
+            setattr(other, attr, value)
+            self.assertNotEqual(fingerprint, metadata_fingerprint(other))
+
+    def test_metadata_fingerprint_xml(self):
+        xdata = lxml.etree.Element("Properties")
+        lxml.etree.SubElement(xdata, "Foo").text = "foo"
+        metadata = FakeMetadata("foo.example.com", Properties=dict(x=xdata))
+        fingerprint = metadata_fingerprint(metadata)
+        metadata.Properties["x"] = copy.deepcopy(xdata)
+        self.assertEqual(fingerprint, metadata_fingerprint(metadata))
+        metadata.Properties["x"][0].text = "bar"
+        self.assertNotEqual(fingerprint, metadata_fingerprint(metadata))
+
+    def test_metadata_fingerprint_file_backed(self):
+        pfile = Bcfg2.Server.Plugin.FileBacked("/test/foo.json")
+        pfile.data = "{}"
+        metadata = FakeMetadata("foo.example.com",
+                                Properties=dict(foo=copy.copy(pfile)))
+        fingerprint = metadata_fingerprint(metadata)
+        metadata.Properties["foo"] = copy.copy(pfile)
+        self.assertEqual(fingerprint, metadata_fingerprint(metadata))
+        pfile.data = '{"foo": "bar"}'
+        metadata.Properties["foo"] = copy.copy(pfile)
+        self.assertNotEqual(fingerprint, metadata_fingerprint(metadata))
+
+    def test_metadata_fingerprint_unknown(self):
+        # objects whose contents are unknown can't be fingerprinted,
+        # not even by identity
+        metadata = FakeMetadata("foo.example.com",
+                                TemplateHelper=dict(foo=object()))
+        self.assertRaises(TypeError, metadata_fingerprint, metadata)
+
+
+class TestCore(Bcfg2TestCase):
+    test_obj = Core
+
+    #: Options that are set for each test, and restored afterwards
+    options = dict(client_metadata_cache="off",
+                   config_cache=False,
+                   binding_cache=False,
+                   bind_threads=1,
+                   cache_namespaces=[])
+
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        set_setup_default("verbose", False)
+        set_setup_default("config", "/etc/bcfg2.conf")
+        set_setup_default("filemonitor", Mock(__name__="Pseudo"))
+        set_setup_default("perflog", False)
+        self.saved_options = dict()
+        for option, value in self.options.items():
+            self.saved_options[option] = getattr(Bcfg2.Options.setup,
+                                                 option, None)
+            setattr(Bcfg2.Options.setup, option, value)
+        self.cores = []
+
+    def tearDown(self):
+        for core in self.cores:
+            Bcfg2.Server.Cache.remove_expire_hook(core._expire_hook)
+            core._stop_bind_workers()
+        Bcfg2.Server.Cache.expire()
+        for option, value in self.saved_options.items():
+            setattr(Bcfg2.Options.setup, option, value)
+
+    @patch("atexit.register")
+    @patch("Bcfg2.Server.FileMonitor.get_fam")
+    def get_obj(self, mock_get_fam, mock_atexit_register):
+        core = self.test_obj()
+        core.fam.generation = 0
+        self.cores.append(core)
+        return core
+
+    def test__set_cache_policies(self):
+        core = self.get_obj()
+        Bcfg2.Options.setup.cache_namespaces = ["caching:Metadata",
+                                                "caching:Cfg-render"]
+        Bcfg2.Options.setup.caching_Metadata_max_entries = 10
+        Bcfg2.Options.setup.caching_Metadata_max_age = None
+        Bcfg2.Options.setup.caching_Metadata_max_size = None
+        Bcfg2.Options.setup.caching_Cfg_render_max_entries = None
+        Bcfg2.Options.setup.caching_Cfg_render_max_age = 60
+        Bcfg2.Options.setup.caching_Cfg_render_max_size = 1024
+        try:
+            core._set_cache_policies()
+            policy = Bcfg2.Server.Cache._cache.get_policy("Metadata")
+            self.assertEqual(policy.max_entries, 10)
+            self.assertIsNone(policy.max_age)
+            policy = Bcfg2.Server.Cache._cache.get_policy("Cfg-render")
+            self.assertIsNone(policy.max_entries)
+            self.assertEqual(policy.max_age, 60)
+            self.assertEqual(policy.max_size, 1024)
+        finally:
+            Bcfg2.Server.Cache.set_policy("Metadata")
+            Bcfg2.Server.Cache.set_policy("Cfg-render")
+
+    def get_building_core(self, metadata):
+        """ get a core that builds a configuration with one Path
+        entry for the given metadata """
+        core = self.get_obj()
+        core.build_metadata = Mock(return_value=metadata)
+        core.GetStructures = Mock(return_value=[])
+        core.validate_structures = Mock()
+        core.validate_goals = Mock()
+        core.client_run_hook = Mock()
+
+        def bind_structures(structures, metadata, config):
+            lxml.etree.SubElement(config, "Path", name="/etc/motd",
+                                  type="file")
+
+        core.BindStructures = Mock(side_effect=bind_structures)
+        return core
+
+    def test_RenderConfiguration(self):
+        metadata = FakeMetadata("foo.example.com", groups=["group1"])
+        core = self.get_building_core(metadata)
+
+        # without the configuration cache, every call builds the
+        # configuration
+        rv = core.RenderConfiguration("foo.example.com")
+        config = lxml.etree.XML(rv)
+        self.assertEqual(config.tag, "Configuration")
+        self.assertEqual(len(config.xpath("//Path")), 1)
+        core.build_metadata.assert_called_once_with("foo.example.com")
+        self.assertEqual(core.RenderConfiguration("foo.example.com"), rv)
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # with the cache, the metadata is only built once on a miss,
+        # and the configuration is built once
+        Bcfg2.Options.setup.config_cache = True
+        core.build_metadata.reset_mock()
+        core.BindStructures.reset_mock()
+        self.assertEqual(core.RenderConfiguration("foo.example.com"), rv)
+        core.build_metadata.assert_called_once_with("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 1)
+
+        core.client_run_hook.reset_mock()
+        self.assertEqual(core.RenderConfiguration("foo.example.com"), rv)
+        self.assertEqual(core.BindStructures.call_count, 1)
+        self.assertItemsEqual(
+            core.client_run_hook.call_args_list,
+            [call("start_client_run", metadata),
+             call("end_client_run", metadata)])
+
+        # a change to the metadata invalidates the cached config
+        metadata.groups.add("group2")
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # so does a change to the revision or the repository
+        core.revision = "2"
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 3)
+        core.fam.generation += 1
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 4)
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 4)
+
+    def test_RenderConfiguration_failure(self):
+        metadata = FakeMetadata("foo.example.com")
+        core = self.get_building_core(metadata)
+        Bcfg2.Options.setup.config_cache = True
+
+        def bind_structures(structures, metadata, config):
+            lxml.etree.SubElement(config, "Path", name="/etc/motd",
+                                  type="file", failure="bind failed")
+
+        # configurations with entries that failed to bind are not
+        # cached
+        core.BindStructures.side_effect = bind_structures
+        core.RenderConfiguration("foo.example.com")
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # neither are metadata errors
+        core.build_metadata.side_effect = MetadataConsistencyError
+        rv = core.RenderConfiguration("foo.example.com")
+        self.assertEqual(lxml.etree.XML(rv).tag, "error")
+
+    def test_RenderConfiguration_unfingerprintable(self):
+        metadata = FakeMetadata("foo.example.com",
+                                TemplateHelper=dict(foo=object()))
+        core = self.get_building_core(metadata)
+        Bcfg2.Options.setup.config_cache = True
+
+        # clients with metadata that can't be fingerprinted are not
+        # cached
+        rv = core.RenderConfiguration("foo.example.com")
+        self.assertEqual(lxml.etree.XML(rv).tag, "Configuration")
+        self.assertEqual(core.RenderConfiguration("foo.example.com"), rv)
+        self.assertEqual(core.BindStructures.call_count, 2)
+        core.build_metadata.assert_has_calls([call("foo.example.com"),
+                                              call("foo.example.com")])
+
+    def test_RenderConfigurationIfModified(self):
+        metadata = FakeMetadata("foo.example.com")
+        core = self.get_building_core(metadata)
+        core.revision = "1"
+        rv = core.RenderConfiguration("foo.example.com")
+        digest = hashlib.sha256(rv.encode('UTF-8')).hexdigest()
+
+        # clients that don't send a digest get the configuration
+        self.assertEqual(core.RenderConfigurationIfModified("foo.example.com"),
+                         rv)
+
+        # as do clients whose configuration differs
+        self.assertEqual(
+            core.RenderConfigurationIfModified("foo.example.com",
+                                               "0" * 64, "1"),
+            rv)
+        self.assertEqual(
+            core.RenderConfigurationIfModified("foo.example.com",
+                                               digest, "2"),
+            rv)
+
+        # clients that already have it get the unmodified marker, but
+        # client run hooks are still called
+        core.client_run_hook.reset_mock()
+        self.assertEqual(
+            core.RenderConfigurationIfModified("foo.example.com",
+                                               digest, "1"),
+            core.unmodified_config)
+        self.assertItemsEqual(
+            core.client_run_hook.call_args_list,
+            [call("start_client_run", metadata),
+             call("end_client_run", metadata)])
+
+    def test__expire_hook(self):
+        core = self.get_obj()
+        core.metadata = Mock(clients=["foo.example.com"])
+        Bcfg2.Server.Cache.Cache("Packages", "sources")["foo"] = 1
+        Bcfg2.Server.Cache.Cache("Metadata")["foo.example.com"] = 1
+        Bcfg2.Server.Cache.Cache("Configuration", "foo.example.com")["x"] = 1
+        Bcfg2.Server.Cache.Cache("Binding")["x"] = 1
+        Bcfg2.Server.Cache.Cache("Test", "derived")["x"] = 1
+
+        # expiring per-client data or derived data doesn't change the
+        # generation
+        Bcfg2.Server.Cache.expire("Metadata", "foo.example.com")
+        Bcfg2.Server.Cache.expire("Configuration")
+        Bcfg2.Server.Cache.expire("Binding")
+        self.assertEqual(core.cache_generation, 0)
+
+        # derived data registered by a plugin
+        Bcfg2.Server.Cache.add_derived("Test", "derived")
+        try:
+            Bcfg2.Server.Cache.expire("Test", "derived")
+        finally:
+            Bcfg2.Server.Cache._derived.discard(frozenset(["Test",
+                                                           "derived"]))
+        self.assertEqual(core.cache_generation, 0)
+
+        # anything else does, even if nothing was cached under the
+        # tags
+        Bcfg2.Server.Cache.expire("Packages")
+        self.assertEqual(core.cache_generation, 1)
+        Bcfg2.Server.Cache.expire("Packages", "nothing")
+        self.assertEqual(core.cache_generation, 2)
+
+    def test_RenderConfiguration_generation(self):
+        metadata = FakeMetadata("foo.example.com")
+        core = self.get_building_core(metadata)
+        core.metadata = Mock(clients=["foo.example.com"])
+        Bcfg2.Options.setup.config_cache = True
+        core.RenderConfiguration("foo.example.com")
+
+        # expiring shared data invalidates cached configurations
+        Bcfg2.Server.Cache.Cache("Packages", "sources")["foo"] = 1
+        Bcfg2.Server.Cache.expire("Packages")
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # but the config cache expiring old configurations does not
+        core.RenderConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+    def test_bind_shared(self):
+        core = self.get_obj()
+        gen = FakeGenerator()
+        core.plugins = dict(FakeGenerator=gen)
+        Bcfg2.Options.setup.binding_cache = True
+        foo = FakeMetadata("foo.example.com", groups=["group1"])
+        bar = FakeMetadata("bar.example.com", groups=["group1"])
+        baz = FakeMetadata("baz.example.com", groups=["group2"])
+
+        def bind(metadata, **attrs):
+            entry = lxml.etree.Element("Path", name="/etc/foo", **attrs)
+            core.Bind(entry, metadata)
+            return entry
+
+        # clients with the same groups share the bound entry
+        entry = bind(foo)
+        self.assertEqual(entry.get("type"), "file")
+        self.assertEqual(entry.text, "groups: group1")
+        self.assertXMLEqual(bind(bar), entry)
+        self.assertEqual(gen.bound, [("/etc/foo", "foo.example.com")])
+
+        # clients with different groups do not
+        self.assertEqual(bind(baz).text, "groups: group2")
+        self.assertEqual(len(gen.bound), 2)
+
+        # the attributes of the unbound entry are part of the key,
+        # regardless of their order
+        entry = bind(foo, important="true", owner="root")
+        self.assertEqual(entry.get("important"), "true")
+        self.assertEqual(len(gen.bound), 3)
+        entry = lxml.etree.Element("Path", owner="root", important="true",
+                                   name="/etc/foo")
+        core.Bind(entry, bar)
+        self.assertEqual(entry.get("important"), "true")
+        self.assertEqual(len(gen.bound), 3)
+
+        # entries with children are never shared
+        entry = lxml.etree.Element("Path", name="/etc/foo")
+        lxml.etree.SubElement(entry, "ACL", type="access", scope="user",
+                              user="root", perms="rwx")
+        core.Bind(entry, bar)
+        self.assertEqual(len(gen.bound), 4)
+
+        # a change to the repository drops shared entries
+        core.fam.generation += 1
+        bind(bar)
+        self.assertEqual(len(gen.bound), 5)
+        bind(foo)
+        self.assertEqual(len(gen.bound), 5)
+
+    def test_bind_shared_host_dependent(self):
+        core = self.get_obj()
+        gen = FakeGenerator(host_independent=False)
+        core.plugins = dict(FakeGenerator=gen)
+        Bcfg2.Options.setup.binding_cache = True
+        for hostname in ["foo.example.com", "bar.example.com"]:
+            metadata = FakeMetadata(hostname, groups=["group1"])
+            core.Bind(lxml.etree.Element("Path", name="/etc/foo"), metadata)
+        self.assertEqual(len(gen.bound), 2)
+
+    def test_bind_shared_failure(self):
+        core = self.get_obj()
+        gen = FakeGenerator()
+        core.plugins = dict(FakeGenerator=gen)
+        Bcfg2.Options.setup.binding_cache = True
+
+        def bind_entry(entry, metadata):
+            gen.bound.append((entry.get("name"), metadata.hostname))
+            entry.set("failure", "bind failed")
+            return entry
+
+        gen.Entries["Path"]["/etc/foo"] = bind_entry
+        for hostname in ["foo.example.com", "bar.example.com"]:
+            metadata = FakeMetadata(hostname, groups=["group1"])
+            core.Bind(lxml.etree.Element("Path", name="/etc/foo"), metadata)
+        self.assertEqual(len(gen.bound), 2)
+
+    def get_binding_core(self):
+        """ get a core with a generator that binds ten paths, one of
+        which fails with a plugin error and one of which fails
+        unexpectedly """
+        core = self.get_obj()
+        gen = FakeGenerator(paths=["/etc/foo%d" % i for i in range(10)])
+
+        def plugin_error(entry, metadata):
+            raise PluginExecutionError("bad entry")
+
+        def unexpected_error(entry, metadata):
+            raise ValueError("bad entry")
+
+        gen.Entries["Path"]["/etc/foo3"] = plugin_error
+        gen.Entries["Path"]["/etc/foo7"] = unexpected_error
+        core.plugins = dict(FakeGenerator=gen)
+        return core
+
+    def get_structures(self):
+        """ get two bundles with entries for all paths bound by the
+        generator from :func:`get_binding_core`, an entry that no
+        generator handles, and an entry that is already bound """
+        structures = []
+        for name, paths in [("bundle1", range(5)), ("bundle2", range(5, 10))]:
+            bundle = lxml.etree.Element("Bundle", name=name)
+            for i in paths:
+                lxml.etree.SubElement(bundle, "Path", name="/etc/foo%d" % i)
+            structures.append(bundle)
+        lxml.etree.SubElement(structures[0], "Path", name="/etc/unknown")
+        lxml.etree.SubElement(structures[1], "BoundPath", name="/etc/bound",
+                              type="file")
+        return structures
+
+    def test_BindStructures_threaded(self):
+        metadata = FakeMetadata("foo.example.com", groups=["group1"])
+        core = self.get_binding_core()
+
+        expected = lxml.etree.Element("Configuration")
+        core.BindStructures(self.get_structures(), metadata, expected)
+        self.assertEqual(core._bind_workers, [])
+        failures = dict((e.get("name"), e.get("failure"))
+                        for e in expected.xpath("//*[@failure]"))
+        self.assertEqual(failures,
+                         {"/etc/foo3": "bind error: bad entry",
+                          "/etc/foo7": "bind error: bad entry",
+                          "/etc/unknown": "no matching generator"})
+        self.assertEqual(len(expected.xpath("//Path[@type='file']")), 9)
+
+        # binding with a pool of threads gives the same result as
+        # binding the entries one at a time, in the same order, and
+        # errors in individual entries are reported on those entries
+        Bcfg2.Options.setup.bind_threads = 4
+        config = lxml.etree.Element("Configuration")
+        core.BindStructures(self.get_structures(), metadata, config)
+        self.assertXMLEqual(config, expected)
+        self.assertEqual(len(core._bind_workers), 4)
+
+        # the workers are reused for the next client
+        workers = list(core._bind_workers)
+        config = lxml.etree.Element("Configuration")
+        core.BindStructures(self.get_structures(), metadata, config)
+        self.assertXMLEqual(config, expected)
+        self.assertEqual(core._bind_workers, workers)
+
+        # and stopped at shutdown
+        core._stop_bind_workers()
+        self.assertEqual(core._bind_workers, [])
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+
+        # workers that have exited, e.g., in a forked child, are
+        # started again when they are needed
+        config = lxml.etree.Element("Configuration")
+        core.BindStructures(self.get_structures(), metadata, config)
+        self.assertXMLEqual(config, expected)
+        self.assertEqual(len(core._bind_workers), 4)
+        core._stop_bind_workers()
+
+    def test__bind_worker(self):
+        core = self.get_obj()
+        Bcfg2.Options.setup.bind_threads = 2
+        core._start_bind_workers()
+        workers = list(core._bind_workers)
+
+        # an unexpected error in a task doesn't kill the worker
+        func = Mock(side_effect=[ValueError, None])
+        core._bind_queue.put((func, 0))
+        core._bind_queue.put((func, 1))
+        core._stop_bind_workers()
+        self.assertItemsEqual(func.call_args_list, [call(0), call(1)])
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+
+    def get_rules(self, core):
+        """ get a Rules plugin with a rule for /etc/rules, and a regex
+        rule for /etc/regex.* that only applies to group1 """
+        set_setup_default("repository", datastore)
+        set_setup_default("rules_regex", False)
+        set_setup_default("rules_replace_name", False)
+        set_setup_default("lax_decryption", True)
+        rules = Bcfg2.Server.Plugins.Rules.Rules(core)
+        xdata = lxml.etree.Element("Rules", priority="10")
+        lxml.etree.SubElement(xdata, "Path", name="/etc/rules", type="file",
+                              owner="root", group="root", mode="0644")
+        group = lxml.etree.SubElement(xdata, "Group", name="group1")
+        lxml.etree.SubElement(group, "Path", name="/etc/regex.*",
+                              type="directory", owner="root", group="root",
+                              mode="0755")
+        child = rules.__child__(os.path.join(datastore, rules.name,
+                                             "rules.xml"))
+        child.data = lxml.etree.tostring(xdata)
+        child.Index()
+        rules.entries = {"rules.xml": child}
+        return rules
+
+    def linear_bind(self, generators, entry, metadata):
+        """ bind an entry by scanning all generators, the way
+        Core.Bind did before it used an index """
+        glist = [gen for gen in generators
+                 if entry.get('name') in gen.Entries.get(entry.tag, {})]
+        if len(glist) == 1:
+            glist[0].Entries[entry.tag][entry.get('name')](entry, metadata)
+            return
+        g2list = [gen for gen in generators
+                  if gen.HandlesEntry(entry, metadata)]
+        if len(g2list) == 1:
+            g2list[0].HandleEntry(entry, metadata)
+        else:
+            entry.set('failure', 'no matching generator')
+
+    def assertBindsLinear(self, core, metadata, names):
+        """ assert that the core binds all of the given Path entries
+        like a linear scan of the generators would, twice, so that
+        the second time the index is used """
+        generators = core.plugins_by_type(Bcfg2.Server.Plugin.Generator)
+        for _ in range(2):
+            for name in names:
+                entry = lxml.etree.Element("Path", name=name)
+                expected = copy.deepcopy(entry)
+                try:
+                    core.Bind(entry, metadata)
+                except PluginExecutionError:
+                    pass
+                try:
+                    self.linear_bind(generators, expected, metadata)
+                except PluginExecutionError:
+                    pass
+                self.assertXMLEqual(entry, expected)
+
+    def test_Bind_generator_index(self):
+        core = self.get_obj()
+        gen = FakeGenerator(paths=["/etc/foo", "/etc/regex2"])
+        core.plugins = dict(FakeGenerator=gen, Rules=self.get_rules(core))
+        group1 = FakeMetadata("foo.example.com", groups=["group1"])
+        group2 = FakeMetadata("bar.example.com", groups=["group2"])
+        names = ["/etc/foo", "/etc/rules", "/etc/regex1", "/etc/regex2",
+                 "/etc/unknown"]
+
+        self.assertBindsLinear(core, group1, names)
+        self.assertBindsLinear(core, group2, names)
+
+        # with regexes, Rules handles entries depending on the groups
+        # of the client, so the results for one client must not be
+        # reused for another
+        Bcfg2.Options.setup.rules_regex = True
+        try:
+            self.assertBindsLinear(core, group1, names)
+            self.assertBindsLinear(core, group2, names)
+            self.assertBindsLinear(core, group1, names)
+            entry = lxml.etree.Element("Path", name="/etc/regex1")
+            core.Bind(entry, group1)
+            self.assertEqual(entry.get("type"), "directory")
+        finally:
+            Bcfg2.Options.setup.rules_regex = False
+
+        # a generator that starts serving an entry after a FAM event
+        # is used for it
+        gen.Entries["Path"]["/etc/rules"] = gen.bind_entry
+        core.fam.generation += 1
+        self.assertBindsLinear(core, group1, names)
+        entry = lxml.etree.Element("Path", name="/etc/rules")
+        core.Bind(entry, group1)
+        self.assertEqual(entry.text, "groups: group1")
+        del gen.Entries["Path"]["/etc/rules"]
+        core.fam.generation += 1
+
+        # so is a newly loaded generator
+        class NewGenerator(FakeGenerator):
+            name = "NewGenerator"
+            conflicts = []
+
+            def __init__(self, core):
+                FakeGenerator.__init__(self, name=self.name,
+                                       paths=["/etc/unknown"])
+
+        core.init_plugin(NewGenerator)
+        self.assertBindsLinear(core, group2, names)
+        entry = lxml.etree.Element("Path", name="/etc/unknown")
+        core.Bind(entry, group2)
+        self.assertEqual(entry.get("type"), "file")
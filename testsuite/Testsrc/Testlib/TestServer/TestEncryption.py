@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import shutil
+import tempfile
 from Bcfg2.Compat import b64decode, b64encode
 from mock import Mock, MagicMock, patch
 
@@ -16,6 +18,7 @@ while path != "/":
 from common import *
 
 try:
+    import Bcfg2.Server.Encryption
     from Bcfg2.Server.Encryption import *
     HAS_CRYPTO = True
 except ImportError:
@@ -35,6 +38,13 @@ baz
     @skipUnless(HAS_CRYPTO, "Encryption libraries not found")
     def setUp(self):
         Bcfg2.Options.setup.algorithm = "aes_256_cbc"
+        Bcfg2.Options.setup.encryption_hints = None
+        Bcfg2.Options.setup.encryption_cache = False
+        Bcfg2.Options.setup.encryption_cache_size = 1000
+
+    def tearDown(self):
+        Bcfg2.Server.Encryption.decrypted.expire()
+        Bcfg2.Server.Encryption._decrypted_keys.clear()
 
     def test_str_crypt(self):
         """ test str_encrypt/str_decrypt """
@@ -165,3 +175,109 @@ baz
         crypted = ssl_encrypt(self.plaintext, passwd, algorithm=self.algo)
         self.assertEqual(self.plaintext,
                          bruteforce_decrypt(crypted, algorithm=self.algo))
+
+    def test_ssl_decrypt_cache(self):
+        passwd = "a simple passphrase"
+        crypted = ssl_encrypt(self.plaintext, passwd)
+        Bcfg2.Options.setup.encryption_cache = True
+        self.assertEqual(self.plaintext, ssl_decrypt(crypted, passwd))
+
+        @patch("Bcfg2.Server.Encryption._ssl_decrypt")
+        def inner(mock_decrypt):
+            mock_decrypt.side_effect = EVPError
+            # cached data is returned without decrypting again
+            self.assertEqual(self.plaintext, ssl_decrypt(crypted, passwd))
+            self.assertFalse(mock_decrypt.called)
+
+            # but only for the same passphrase and algorithm
+            self.assertRaises(EVPError, ssl_decrypt, crypted, "bogus")
+            self.assertRaises(EVPError, ssl_decrypt, crypted, passwd,
+                              algorithm=self.algo)
+
+            # and not at all if the cache is disabled
+            Bcfg2.Options.setup.encryption_cache = False
+            self.assertRaises(EVPError, ssl_decrypt, crypted, passwd)
+
+        inner()
+
+    def test_ssl_decrypt_cache_size(self):
+        Bcfg2.Options.setup.encryption_cache = True
+        Bcfg2.Options.setup.encryption_cache_size = 2
+        passwd = "a simple passphrase"
+        crypted = [ssl_encrypt("%s %d" % (self.plaintext, i), passwd)
+                   for i in range(3)]
+        for data in crypted:
+            ssl_decrypt(data, passwd)
+
+        @patch("Bcfg2.Server.Encryption._ssl_decrypt")
+        def inner(mock_decrypt):
+            mock_decrypt.side_effect = EVPError
+            # only the most recently decrypted data is kept
+            self.assertRaises(EVPError, ssl_decrypt, crypted[0], passwd)
+            self.assertEqual(ssl_decrypt(crypted[1], passwd),
+                             "%s 1" % self.plaintext)
+            self.assertEqual(ssl_decrypt(crypted[2], passwd),
+                             "%s 2" % self.plaintext)
+
+        inner()
+        self.assertEqual(len(Bcfg2.Server.Encryption.decrypted), 2)
+
+    @patchIf(HAS_CRYPTO, "Bcfg2.Server.Encryption._ssl_decrypt")
+    def test_bruteforce_decrypt_hints(self, mock_decrypt):
+        passwd = "a simple passphrase"
+        crypted = b64encode("Salted__01234567crypted")
+
+        def decrypt(data, key, algorithm):
+            # a real decrypt with the wrong key can occasionally
+            # succeed, which would make this test unreliable
+            if key != passwd:
+                raise EVPError
+            return self.plaintext
+
+        mock_decrypt.side_effect = decrypt
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # the directory for the hints file is created if needed
+            Bcfg2.Options.setup.encryption_hints = \
+                os.path.join(tmpdir, "cache", "passphrase_hints")
+            Bcfg2.Options.setup.passphrases = dict(
+                [("bogus%d" % i, "bogus %d" % i) for i in range(20)] +
+                [("real", passwd)])
+            self.assertEqual(self.plaintext, bruteforce_decrypt(crypted))
+
+            # a new set of hints is loaded from the file written
+            # above, so the right passphrase is tried first
+            Bcfg2.Server.Encryption.passphrase_hints = PassphraseHints()
+            mock_decrypt.reset_mock()
+            self.assertEqual(self.plaintext, bruteforce_decrypt(crypted))
+            self.assertEqual(mock_decrypt.call_count, 1)
+            hints = Bcfg2.Server.Encryption.passphrase_hints
+            self.assertEqual((hints.hits, hints.misses), (1, 0))
+
+            # a stale hint falls back to trying every passphrase, and
+            # is replaced
+            Bcfg2.Options.setup.passphrases["real"] = "bogus"
+            Bcfg2.Options.setup.passphrases["new"] = passwd
+            self.assertEqual(self.plaintext, bruteforce_decrypt(crypted))
+            mock_decrypt.reset_mock()
+            self.assertEqual(self.plaintext, bruteforce_decrypt(crypted))
+            self.assertEqual(mock_decrypt.call_count, 1)
+            self.assertEqual((hints.hits, hints.misses), (2, 1))
+
+            hints = PassphraseHints()
+            self.assertEqual(
+                hints.get(Bcfg2.Server.Encryption._digest(crypted)), "new")
+
+            # the hints file is compacted when most of it is stale
+            hints = PassphraseHints()
+            hfile = open(Bcfg2.Options.setup.encryption_hints, 'a')
+            for i in range(10):
+                hfile.write("%s bogus%d\n" % ("0" * 64, i))
+            hfile.close()
+            self.assertEqual(hints.get("0" * 64), "bogus9")
+            self.assertEqual(
+                len(open(Bcfg2.Options.setup.encryption_hints).readlines()),
+                2)
+        finally:
+            Bcfg2.Server.Encryption.passphrase_hints = PassphraseHints()
+            shutil.rmtree(tmpdir)
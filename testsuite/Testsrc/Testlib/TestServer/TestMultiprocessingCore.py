@@ -0,0 +1,513 @@
+import os
+import sys
+import time
+import hashlib
+import threading
+import lxml.etree
+import multiprocessing
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+import Bcfg2.Server.Statistics
+from Bcfg2.Compat import u_str, xmlrpclib
+from Bcfg2.Server.MultiprocessingCore import RPCChannel, RPCQueue, \
+    MultiprocessingCore, ChildCore
+from TestCore import TestCore, FakeMetadata
+
+
+class TestRPCChannel(Bcfg2TestCase):
+    def get_pair(self, compress=False):
+        parent, child = multiprocessing.Pipe()
+        return RPCChannel(parent), RPCChannel(child, compress=compress)
+
+    def test_send_recv(self):
+        parent, child = self.get_pair()
+        parent.send(1, ("GetConfig", ["foo.example.com"], dict()))
+        self.assertTrue(child.poll(1))
+        self.assertEqual(child.recv(),
+                         (1, ("GetConfig", ["foo.example.com"], dict())))
+        self.assertFalse(child.poll())
+
+    def test_send_large(self):
+        for compress in [False, True]:
+            parent, child = self.get_pair(compress=compress)
+            data = u_str("<Configuration/>") * RPCChannel.raw_threshold
+            # send from another thread, since large messages block
+            # until they are read
+            sender = threading.Thread(target=child.send, args=[2, data])
+            sender.start()
+            rv = parent.recv()
+            sender.join()
+            self.assertEqual(rv, (2, data))
+            self.assertIsInstance(rv[1], type(data))
+
+            # results published with no request ID are always pickled
+            sender = threading.Thread(target=child.send, args=[None, data])
+            sender.start()
+            self.assertEqual(parent.recv(), (None, data))
+            sender.join()
+
+
+class TestRPCQueue(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default('debug', False)
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+
+    def get_obj(self, compress=False):
+        queue = RPCQueue(compress=compress)
+        queue.poll_wait = 0.1
+        self.queues.append(queue)
+        return queue
+
+    def start_child(self, channel, handler):
+        """ respond to RPC calls on the given channel in a thread,
+        answering each call in a new thread, like ChildCore does """
+        def respond(req_id, data):
+            rv = handler(*data)
+            if req_id is not None:
+                channel.send(req_id, rv)
+
+        threads = []
+
+        def serve():
+            while True:
+                try:
+                    if not channel.poll(0.1):
+                        continue
+                    req_id, data = channel.recv()
+                except (EOFError, IOError):
+                    break
+                if data[0] == "stop":
+                    break
+                if data[0] == "retire":
+                    # answer outstanding requests, then tell the
+                    # parent that we're done
+                    for thread in threads:
+                        thread.join()
+                    channel.send(None, None)
+                    break
+                thread = threading.Thread(target=respond, args=[req_id, data])
+                thread.start()
+                threads.append(thread)
+
+        child = threading.Thread(target=serve)
+        child.start()
+        return child
+
+    def test_rpc(self):
+        queue = self.get_obj()
+        channel = queue.add_subscriber("child")
+        self.start_child(channel,
+                         lambda method, args, kwargs: (method, args, kwargs))
+        self.assertEqual(queue.rpc("child", "GetConfig", args=["foo"]),
+                         ("GetConfig", ["foo"], dict()))
+        self.assertEqual(queue.rpc("child", "get_statistics",
+                                   kwargs=dict(bar=1)),
+                         ("get_statistics", [], dict(bar=1)))
+        queue.publish("stop")
+
+    def test_rpc_timeout(self):
+        """ a subscriber that doesn't respond in time fails the call
+        """
+        queue = self.get_obj()
+        queue.timeout = 0.2
+        channel = queue.add_subscriber("child")
+        stuck = threading.Event()
+
+        def handler(method, args, kwargs):
+            if method == "stuck":
+                stuck.wait(5)
+            return method
+
+        self.start_child(channel, handler)
+        self.assertRaises(xmlrpclib.Fault, queue.rpc, "child", "stuck")
+
+        # the late response is dropped, and later calls still work
+        stuck.set()
+        self.assertEqual(queue.rpc("child", "GetConfig"), "GetConfig")
+        self.assertEqual(queue._pending, dict())
+        queue.publish("stop")
+
+    def test_rpc_closed(self):
+        """ calls fail if the subscriber's channel is closed before
+        it responds, e.g., because the subscriber died """
+        queue = self.get_obj()
+        channel = queue.add_subscriber("child")
+
+        def die():
+            channel.recv()
+            channel.close()
+
+        child = threading.Thread(target=die)
+        child.start()
+        self.assertRaises(xmlrpclib.Fault, queue.rpc, "child", "GetConfig")
+        child.join()
+        self.assertEqual(queue._pending, dict())
+
+        # calls made after the channel is closed fail, too
+        self.assertRaises(xmlrpclib.Fault, queue.rpc, "child", "GetConfig")
+
+    def test_pipelining(self):
+        """ responses are matched to requests when several requests
+        are outstanding at once and answered out of order """
+        queue = self.get_obj()
+        channel = queue.add_subscriber("child")
+
+        def handler(method, args, kwargs):
+            time.sleep(args[0])
+            return args[0]
+
+        self.start_child(channel, handler)
+        results = dict()
+
+        def call(delay):
+            results[delay] = queue.rpc("child", "sleep", args=[delay])
+
+        threads = [threading.Thread(target=call, args=[d])
+                   for d in [0.3, 0.2, 0.1, 0.0]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {0.3: 0.3, 0.2: 0.2, 0.1: 0.1, 0.0: 0.0})
+        queue.publish("stop")
+
+    def test_replace_subscriber(self):
+        """ replacing a subscriber retires the old one, which still
+        answers the requests it was already given """
+        queue = self.get_obj()
+        old = queue.add_subscriber("child")
+
+        def handler(method, args, kwargs):
+            time.sleep(args[0])
+            return ("old", args[0])
+
+        old_child = self.start_child(old, handler)
+        results = dict()
+
+        def call(delay):
+            results[delay] = queue.rpc("child", "sleep", args=[delay])
+
+        slow = threading.Thread(target=call, args=[0.5])
+        slow.start()
+        time.sleep(0.1)
+
+        new = queue.add_subscriber("child")
+        self.start_child(new, lambda method, args, kwargs: ("new", args[0]))
+        call(0.0)
+        slow.join()
+        old_child.join()
+        self.assertEqual(results, {0.5: ("old", 0.5), 0.0: ("new", 0.0)})
+
+        # the reader for the retired subscriber is forgotten once it
+        # has stopped
+        old_reader = queue._readers[0]
+        old_reader.join()
+        other = queue.add_subscriber("other")
+        self.assertNotIn(old_reader, queue._readers)
+        self.assertEqual(len(queue._readers), 2)
+        queue.publish("stop")
+        other.close()
+
+    @benchmark
+    def test_benchmark(self):
+        """ round-trip overhead for a 5 MB configuration """
+        config = u_str("<Configuration>%s</Configuration>") % \
+            (u_str("<Path name='/etc/motd' type='file'>x</Path>") *
+             (5 * 1024 * 1024 // 44))
+        rounds = 5
+        for compress in [False, True]:
+            queue = self.get_obj(compress=compress)
+            channel = queue.add_subscriber("child")
+            self.start_child(channel, lambda method, args, kwargs: config)
+            start = time.time()
+            for _ in range(rounds):
+                self.assertEqual(len(queue.rpc("child", "GetConfig")),
+                                 len(config))
+            elapsed = (time.time() - start) / rounds
+            report_benchmark("RPC round trip for %.1f MB config "
+                             "(compress=%s): %.4fs" %
+                             (len(config) / 1024.0 / 1024, compress, elapsed))
+            queue.publish("stop")
+
+
+class TestMultiprocessingCore(TestCore):
+    test_obj = MultiprocessingCore
+
+    options = dict(TestCore.options,
+                   core_children=3,
+                   core_dispatch="least-loaded",
+                   core_affinity_max_outstanding=2,
+                   core_prefork=False,
+                   core_child_compression=False,
+                   core_child_timeout=300.0)
+
+    def setUp(self):
+        TestCore.setUp(self)
+        set_setup_default("ca", None)
+        set_setup_default("daemon", None)
+        set_setup_default("daemon_uid", 0)
+        set_setup_default("daemon_gid", 0)
+        set_setup_default("umask", "0077")
+
+    def tearDown(self):
+        TestCore.tearDown(self)
+        Bcfg2.Server.Statistics.stats.data.clear()
+
+    def get_obj(self):
+        core = TestCore.get_obj(self)
+        # set up the bookkeeping for the children, but don't start
+        # any processes
+        core._start_child = Mock()
+        core._start_children()
+        return core
+
+    def get_stats(self, core, name):
+        """ get the (min, max, mean, count) tuple for a statistic """
+        return Bcfg2.Server.Statistics.stats.display()[
+            "%s:%s" % (core.__class__.__name__, name)]
+
+    def test__start_children(self):
+        core = self.get_obj()
+        self.assertItemsEqual(core._start_child.call_args_list,
+                              [call("Child-0"), call("Child-1"),
+                               call("Child-2")])
+        self.assertEqual(core._all_children,
+                         ["Child-0", "Child-1", "Child-2"])
+        self.assertEqual(core.outstanding,
+                         {"Child-0": 0, "Child-1": 0, "Child-2": 0})
+        self.assertEqual(len(core._hash_ring), 3 * core.hash_ring_points)
+        self.assertEqual(core._hash_ring, sorted(core._hash_ring))
+
+    @patch("Bcfg2.Server.MultiprocessingCore.ChildCore")
+    @patch("multiprocessing.Process")
+    def test__start_child(self, mock_Process, mock_ChildCore):
+        core = self.get_obj()
+        core.rpc_q = Mock()
+        core.db_write_lock = Mock()
+        core._close_db_connections = Mock()
+        state = dict()
+
+        def start():
+            state["locked"] = not core.lock.acquire(False)
+            state["db_locked"] = core.db_write_lock.acquire.called
+            state["db_closed"] = core._close_db_connections.called
+
+        mock_Process.return_value.start.side_effect = start
+        MultiprocessingCore._start_child(core, "Child-0")
+        core.rpc_q.add_subscriber.assert_called_with("Child-0")
+        mock_ChildCore.assert_called_with(
+            "Child-0", core.rpc_q.add_subscriber.return_value,
+            core.terminate)
+        mock_Process.assert_called_with(
+            target=mock_ChildCore.return_value.run, name="Child-0")
+
+        # the child is forked with the locks held and without any open
+        # database connections
+        self.assertEqual(state, dict(locked=True, db_locked=True,
+                                     db_closed=True))
+        self.assertTrue(core.lock.acquire(False))
+        core.lock.release()
+        core.db_write_lock.release.assert_called_with()
+        core.rpc_q.add_subscriber.return_value.close.assert_called_with()
+
+    @patch("Bcfg2.Server.MultiprocessingCore.ChildCore")
+    @patch("multiprocessing.Process")
+    def test__start_child_prefork(self, mock_Process, mock_ChildCore):
+        """ preforked children are forked while the plugins hold
+        their locks """
+        core = self.get_obj()
+        core.rpc_q = Mock()
+        core._close_db_connections = Mock()
+        core.plugins = dict(Foo=Mock(), Bar=Mock())
+        calls = []
+
+        def start():
+            for name, plugin in core.plugins.items():
+                calls.append((name, plugin.before_fork.called,
+                              plugin.after_fork.called))
+
+        mock_Process.return_value.start.side_effect = start
+        Bcfg2.Options.setup.core_prefork = True
+        try:
+            MultiprocessingCore._start_child(core, "Child-0")
+        finally:
+            Bcfg2.Options.setup.core_prefork = False
+        mock_ChildCore.assert_called_with(
+            "Child-0", core.rpc_q.add_subscriber.return_value,
+            core.terminate, parent=core)
+        self.assertItemsEqual(calls, [("Foo", True, False),
+                                      ("Bar", True, False)])
+        for plugin in core.plugins.values():
+            plugin.before_fork.assert_called_once_with()
+            plugin.after_fork.assert_called_once_with(False)
+
+        # if a plugin fails to prepare, the ones that did are cleaned
+        # up, and the child isn't started
+        for plugin in core.plugins.values():
+            plugin.reset_mock()
+        mock_Process.return_value.start.reset_mock()
+        core.plugins["Foo"].before_fork.side_effect = RuntimeError
+        core.plugins["Bar"].before_fork.side_effect = RuntimeError
+        Bcfg2.Options.setup.core_prefork = True
+        try:
+            self.assertRaises(RuntimeError, MultiprocessingCore._start_child,
+                              core, "Child-0")
+        finally:
+            Bcfg2.Options.setup.core_prefork = False
+        self.assertFalse(mock_Process.return_value.start.called)
+        for plugin in core.plugins.values():
+            self.assertFalse(plugin.after_fork.called)
+        self.assertTrue(core.lock.acquire(False))
+        core.lock.release()
+
+    def test__checkout_child(self):
+        core = self.get_obj()
+
+        # idle children are used round-robin
+        self.assertEqual([core._checkout_child("foo.example.com")
+                          for _ in range(3)],
+                         ["Child-0", "Child-1", "Child-2"])
+        self.assertEqual(core.outstanding,
+                         {"Child-0": 1, "Child-1": 1, "Child-2": 1})
+
+        # the least loaded child is used, whichever is next
+        core._checkin_child("Child-1")
+        self.assertEqual(core.outstanding["Child-1"], 0)
+        self.assertEqual(core._checkout_child(), "Child-1")
+        core._checkin_child("Child-0")
+        core._checkin_child("Child-2")
+        self.assertEqual(core._checkout_child(), "Child-2")
+        self.assertEqual(core._checkout_child(), "Child-0")
+        self.assertEqual(core.outstanding,
+                         {"Child-0": 1, "Child-1": 1, "Child-2": 1})
+
+        # ties are broken starting after the last child used
+        self.assertEqual(core._checkout_child(), "Child-1")
+        self.assertEqual(core._checkout_child(), "Child-2")
+        self.assertEqual(core._checkout_child(), "Child-0")
+        for child in core._all_children:
+            core._checkin_child(child)
+            core._checkin_child(child)
+        self.assertEqual(core.outstanding,
+                         {"Child-0": 0, "Child-1": 0, "Child-2": 0})
+
+        # the total and per-child outstanding requests are recorded
+        # each time a child is checked out
+        depth = self.get_stats(core, "GetConfig:queue_depth")
+        self.assertEqual(depth[1], 6)
+        self.assertEqual(depth[3], 9)
+        self.assertEqual(self.get_stats(core, "Child-0:outstanding")[1], 2)
+
+    def test_GetConfig(self):
+        core = self.get_obj()
+        core.resolve_client = Mock(return_value=("foo.example.com", None))
+        core.rpc_q = Mock()
+        core.rpc_q.rpc.return_value = "<Configuration/>"
+        self.assertEqual(core.GetConfig(("127.0.0.1", 1234), "digest", "1"),
+                         "<Configuration/>")
+        core.rpc_q.rpc.assert_called_with("Child-0", "GetConfig",
+                                          args=["foo.example.com", "digest",
+                                                "1"])
+        self.assertEqual(core.GetConfig(("127.0.0.1", 1234)),
+                         "<Configuration/>")
+        core.rpc_q.rpc.assert_called_with("Child-1", "GetConfig",
+                                          args=["foo.example.com", None,
+                                                None])
+
+        # the child is checked back in if the call fails
+        core.rpc_q.rpc.side_effect = IOError
+        self.assertRaises(IOError, core.GetConfig, ("127.0.0.1", 1234))
+        self.assertEqual(core.outstanding,
+                         {"Child-0": 0, "Child-1": 0, "Child-2": 0})
+
+    def test_ChildCore_GetConfig(self):
+        parent = self.get_building_core(FakeMetadata("foo.example.com"))
+        parent.metadata = Mock()
+        daemon = Bcfg2.Options.setup.daemon
+        try:
+            child = ChildCore("Child-0", Mock(), Mock(), parent=parent)
+        finally:
+            Bcfg2.Options.setup.daemon = daemon
+        config = child.GetConfig("foo.example.com")
+        self.assertEqual(lxml.etree.XML(config).tag, "Configuration")
+        parent.metadata.update_client_list.assert_called_with()
+
+        # the child compares the digest itself
+        digest = hashlib.sha256(config.encode('UTF-8')).hexdigest()
+        self.assertEqual(child.GetConfig("foo.example.com", digest,
+                                         str(child.revision)),
+                         child.unmodified_config)
+        self.assertEqual(child.GetConfig("foo.example.com", "0" * 64,
+                                         str(child.revision)),
+                         config)
+
+    def test__affinity_child(self):
+        core = self.get_obj()
+        clients = ["client%d.example.com" % i for i in range(300)]
+        assigned = dict((c, core._affinity_child(c)) for c in clients)
+
+        # each client always goes to the same child, and every child
+        # gets a share of the clients
+        for client in clients:
+            self.assertEqual(core._affinity_child(client), assigned[client])
+        counts = dict()
+        for child in assigned.values():
+            counts[child] = counts.get(child, 0) + 1
+        self.assertItemsEqual(counts.keys(), core._all_children)
+        for count in counts.values():
+            self.assertGreater(count, 50)
+
+        # adding a child only moves clients onto the new child
+        Bcfg2.Options.setup.core_children = 4
+        bigger = self.get_obj()
+        moved = [c for c in clients
+                 if bigger._affinity_child(c) != assigned[c]]
+        for client in moved:
+            self.assertEqual(bigger._affinity_child(client), "Child-3")
+        self.assertLess(len(moved), len(clients) / 2)
+
+    def test__checkout_child_affinity(self):
+        Bcfg2.Options.setup.core_dispatch = "affinity"
+        core = self.get_obj()
+        client = "foo.example.com"
+        preferred = core._affinity_child(client)
+
+        # the client goes to its own child until that child has
+        # affinity_max_outstanding requests, even if other children
+        # are idle
+        self.assertEqual(core._checkout_child(client), preferred)
+        self.assertEqual(core._checkout_child(client), preferred)
+        self.assertEqual(core.outstanding[preferred], 2)
+
+        # then it falls back to the least loaded child
+        other = core._checkout_child(client)
+        self.assertNotEqual(other, preferred)
+        self.assertEqual(core.outstanding[other], 1)
+        core._checkin_child(preferred)
+        self.assertEqual(core._checkout_child(client), preferred)
+
+        # requests without a client are always sent to the least
+        # loaded child
+        self.assertNotEqual(core._checkout_child(), preferred)
+
+        # the fraction of requests that went to the preferred child is
+        # recorded
+        affinity = self.get_stats(core, "GetConfig:affinity")
+        self.assertEqual(affinity[3], 4)
+        self.assertAlmostEqual(affinity[2], 0.75)
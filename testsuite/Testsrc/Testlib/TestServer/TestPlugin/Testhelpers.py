@@ -33,6 +33,59 @@ def tostring(el):
     return lxml.etree.tostring(el, xml_declaration=False).decode('UTF-8')
 
 
+def get_nested_data(tag, entry, depth=6, breadth=3, entries=5):
+    """ build a StructFile document with ``depth`` levels of nested
+    (and sometimes negated) ``<Group>`` and ``<Client>`` tags, each
+    containing ``entries`` uniquely-named ``entry`` elements. """
+    xdata = lxml.etree.Element(tag, priority="10")
+    count = [0]
+
+    def fill(parent, level):
+        for _ in range(entries):
+            count[0] += 1
+            lxml.etree.SubElement(parent, entry, name="entry%d" % count[0],
+                                  attr="value%d" % count[0])
+        if level == depth:
+            return
+        for i in range(breadth):
+            if i == breadth - 1:
+                child = lxml.etree.SubElement(
+                    parent, "Client", name="foo.example.com",
+                    negate=str(level % 2 == 1).lower())
+            else:
+                child = lxml.etree.SubElement(
+                    parent, "Group", name="group%d" % i,
+                    negate=str((level + i) % 3 == 0).lower())
+            fill(child, level + 1)
+
+    fill(xdata, 0)
+    return xdata
+
+
+def compare_match(test, sf, metadata, *args):
+    """ check that the compiled data in a StructFile gives the same
+    Match() and XMLMatch() results as walking the document does, and
+    return the number of matching elements.  XMLMatch() does not
+    guarantee the order of its results, so they are compared
+    unordered. """
+    compiled = sf._compiled
+    test.assertIsNotNone(compiled)
+    match = [tostring(el) for el in sf._do_match(metadata, *args)]
+    xmlmatch = sf._do_xmlmatch(metadata, *args)
+    sf._compiled = None
+    try:
+        test.assertEqual(match, [tostring(el) for el in
+                                 sf._do_match(metadata, *args)])
+        expected = sf._do_xmlmatch(metadata, *args)
+    finally:
+        sf._compiled = compiled
+    test.assertEqual(dict(xmlmatch.attrib), dict(expected.attrib))
+    test.assertEqual(xmlmatch.text, expected.text)
+    test.assertItemsEqual([tostring(el) for el in xmlmatch],
+                          [tostring(el) for el in expected])
+    return len(match)
+
+
 class FakeElementTree(lxml.etree._ElementTree):
     xinclude = Mock()
     parse = Mock
@@ -629,6 +682,9 @@ class TestXMLFileBacked(TestFileBacked):
 class TestStructFile(TestXMLFileBacked):
     test_obj = StructFile
 
+    #: extra arguments to pass to Match() and XMLMatch()
+    match_args = []
+
     def setUp(self):
         TestXMLFileBacked.setUp(self)
         set_setup_default("lax_decryption", False)
@@ -743,6 +799,33 @@ class TestStructFile(TestXMLFileBacked):
         self.assertEqual(sf.template,
                          loader.load.return_value)
 
+    @patch("genshi.template.TemplateLoader")
+    def test_Index_host_independent(self, mock_TemplateLoader):
+        sf = self.get_obj()
+        sf.encryption = False
+        xdata = lxml.etree.Element("Test", name="test", priority="10")
+        lxml.etree.SubElement(lxml.etree.SubElement(xdata, "Group",
+                                                    name="group1"),
+                              "Path", name="/etc/foo.conf")
+        sf.data = lxml.etree.tostring(xdata)
+        sf.Index()
+        self.assertTrue(sf.host_independent)
+
+        client = lxml.etree.SubElement(xdata, "Client", name="client1")
+        lxml.etree.SubElement(client, "Path", name="/etc/bar.conf")
+        sf.data = lxml.etree.tostring(xdata)
+        sf.Index()
+        self.assertFalse(sf.host_independent)
+
+        xdata.remove(client)
+        template_xdata = \
+            lxml.etree.Element("Test", name="test", priority="10",
+                               nsmap=dict(py='http://genshi.edgewall.org/'))
+        template_xdata.extend(xdata.getchildren())
+        sf.data = lxml.etree.tostring(template_xdata)
+        sf.Index()
+        self.assertFalse(sf.host_independent)
+
     @skipUnless(HAS_CRYPTO, "No crypto libraries found, skipping")
     def test_Index_crypto(self):
         if not self.test_obj.encryption:
@@ -1011,9 +1094,36 @@ class TestStructFile(TestXMLFileBacked):
         # TODO: add tests to ensure that XMLMatch() returns elements
         # in document order
 
+    def test_compiled_match(self):
+        """ matching the compiled data gives the same results as
+        walking the document """
+        Bcfg2.Options.setup.lax_decryption = True
+        sf = self.get_obj()
+        xdata = self._get_test_data()[0]
+        lxml.etree.SubElement(xdata, "Group", name="group1").text = "text"
+        for data in [xdata, get_nested_data("Test", "Child", depth=3)]:
+            sf.data = lxml.etree.tostring(data)
+            sf.Index()
+            for groups, hostname in [([], "bogus.example.com"),
+                                     (["group1", "subgroup1"], "client3"),
+                                     (["group0", "group1"],
+                                      "foo.example.com")]:
+                metadata = Mock(groups=groups, hostname=hostname)
+                compare_match(self, sf, metadata, *self.match_args)
+
+        # templates are not compiled
+        @patch("genshi.template.TemplateLoader", Mock())
+        def inner():
+            sf.data = lxml.etree.tostring(self._get_template_test_data()[0])
+            sf.Index()
+            self.assertIsNone(sf._compiled)
+
+        inner()
+
 
 class TestInfoXML(TestStructFile):
     test_obj = InfoXML
+    match_args = [lxml.etree.Element("Path", name="path1")]
 
     def _get_test_data(self):
         (xdata, groups, subgroups, children, subchildren, standalone) = \
@@ -1231,6 +1341,17 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
 
         inner()
 
+    def test_is_host_independent(self):
+        pd = self.get_obj()
+        entry = lxml.etree.Element("Path", name="/etc/foo.conf")
+        metadata = Mock()
+        pd.entries = {"/test1.xml": Mock(host_independent=True),
+                      "/test2.xml": Mock(host_independent=True)}
+        self.assertTrue(pd.is_host_independent(entry, metadata))
+
+        pd.entries["/test2.xml"].host_independent = False
+        self.assertFalse(pd.is_host_independent(entry, metadata))
+
     def test__matches(self):
         pd = self.get_obj()
         entry = lxml.etree.Element("Test", name="/etc/foo.conf")
@@ -1290,14 +1411,15 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
         for src in pd.entries.values():
             src.XMLMatch.assert_called_with(metadata)
 
-        # test with multiple matches with different priorities, text
+        # test with multiple matches with different priorities, text.
+        # the matched documents are reused for the same client
         reset()
         entry = lxml.etree.Element("Path", name="/etc/bar.conf")
         pd.BindEntry(entry, metadata)
         self.assertXMLEqual(entry, path2)
         self.assertIsNot(entry, path2)
         for src in pd.entries.values():
-            src.XMLMatch.assert_called_with(metadata)
+            self.assertFalse(src.XMLMatch.called)
 
         # test with multiple matches with identical priorities
         reset()
@@ -1305,6 +1427,30 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
         self.assertRaises(PluginExecutionError,
                           pd.BindEntry, entry, metadata)
 
+        # files are matched again for new client metadata, and when
+        # they change
+        reset()
+        metadata2 = Mock(hostname=metadata.hostname)
+        entry = lxml.etree.Element("Path", name="/etc/foo.conf")
+        pd.BindEntry(entry, metadata2)
+        for src in pd.entries.values():
+            src.XMLMatch.assert_called_with(metadata2)
+
+        reset()
+        src = pd.entries[os.path.join(pd.data, 'test3.xml')]
+        src.xdata = lxml.etree.Element("Rules")
+        entry = lxml.etree.Element("Path", name="/etc/foo.conf")
+        pd.BindEntry(entry, metadata2)
+        src.XMLMatch.assert_called_with(metadata2)
+
+        # only the most recent client's matches are kept
+        reset()
+        entry = lxml.etree.Element("Path", name="/etc/foo.conf")
+        pd.BindEntry(entry, metadata)
+        for src in pd.entries.values():
+            src.XMLMatch.assert_called_with(metadata)
+        self.assertIs(pd._last_matches[0], metadata)
+
 
 class TestSpecificity(Bcfg2TestCase):
     test_obj = Specificity
@@ -67,6 +67,10 @@ class TestMetadata(Bcfg2TestCase):
         self.assertRaises(NotImplementedError,
                           m.merge_additional_groups, None, None)
 
+    def test_index_client(self):
+        m = self.get_obj()
+        self.assertIsNone(m.index_client(Mock()))
+
 
 class TestConnector(Bcfg2TestCase):
     """ placeholder """
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import lxml.etree
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.Bundler import *
@@ -17,6 +18,7 @@ while path != "/":
 from common import *
 from TestPlugin import TestStructFile, TestPlugin, TestStructure, \
     TestXMLDirectoryBacked
+from TestPlugin.Testhelpers import get_nested_data, compare_match
 
 
 class TestBundleFile(TestStructFile):
@@ -34,6 +36,30 @@ class TestBundleFile(TestStructFile):
             bf.name = fname
             self.assertEqual(bf.bundle_name, bname)
 
+    @benchmark
+    def test_benchmark(self):
+        """ XMLMatch() on a deeply nested bundle """
+        bf = self.get_obj()
+        bf.data = lxml.etree.tostring(get_nested_data("Bundle", "Path"))
+        bf.Index()
+        metadata = Mock(groups=["group0", "group1"],
+                        hostname="foo.example.com")
+        self.assertGreater(compare_match(self, bf, metadata), 0)
+
+        rounds = 10
+        compiled = bf._compiled
+        times = dict()
+        for data in [None, compiled]:
+            bf._compiled = data
+            start = time.time()
+            for _ in range(rounds):
+                bf.XMLMatch(metadata)
+            times[data is not None] = (time.time() - start) / rounds
+            report_benchmark("XMLMatch() on %d entries (compiled=%s): "
+                             "%.4fs" % (len(bf.xdata.xpath("//Path")),
+                                        data is not None,
+                                        times[data is not None]))
+
 
 class TestBundler(TestPlugin, TestStructure, TestXMLDirectoryBacked):
     test_obj = Bundler
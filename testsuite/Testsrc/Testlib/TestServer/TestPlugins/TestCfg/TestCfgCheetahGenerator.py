@@ -24,6 +24,7 @@ class TestCfgCheetahGenerator(TestCfgGenerator):
     def setUp(self):
         TestCfgGenerator.setUp(self)
         set_setup_default("repository", datastore)
+        set_setup_default("cfg_template_cache", False)
 
     @patch("Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator.Template")
     @patch("Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator.get_template_data")
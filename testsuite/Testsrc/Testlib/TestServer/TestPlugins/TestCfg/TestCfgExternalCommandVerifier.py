@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+import shutil
+import tempfile
 import lxml.etree
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.Cfg.CfgExternalCommandVerifier import *
@@ -21,6 +24,17 @@ from TestServer.TestPlugins.TestCfg.Test_init import TestCfgVerifier
 class TestCfgExternalCommandVerifier(TestCfgVerifier):
     test_obj = CfgExternalCommandVerifier
 
+    def setUp(self):
+        TestCfgVerifier.setUp(self)
+        set_setup_default("cfg_verifier_workers", 4)
+        set_setup_default("cfg_verifier_cache_size", 1000)
+        self.tmpdir = None
+
+    def tearDown(self):
+        Bcfg2.Server.Cache.expire("Cfg")
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+
     def test_verify_entry(self):
         entry = lxml.etree.Element("Path", name="/test.txt")
         metadata = Mock()
@@ -34,19 +48,152 @@ class TestCfgExternalCommandVerifier(TestCfgVerifier):
         ecv.verify_entry(entry, metadata, "data")
         ecv.exc.run.assert_called_with(ecv.cmd, inputdata="data")
 
+        # data that has already passed is not verified again
+        ecv.exc.reset_mock()
+        ecv.verify_entry(entry, metadata, "data")
+        self.assertFalse(ecv.exc.run.called)
+
         ecv.exc.reset_mock()
         ecv.exc.run.return_value.success = False
         self.assertRaises(CfgVerificationError,
-                          ecv.verify_entry, entry, metadata, "data")
-        ecv.exc.run.assert_called_with(ecv.cmd, inputdata="data")
+                          ecv.verify_entry, entry, metadata, "bogus")
+        ecv.exc.run.assert_called_with(ecv.cmd, inputdata="bogus")
 
+        # failures are not cached
         ecv.exc.reset_mock()
+        self.assertRaises(CfgVerificationError,
+                          ecv.verify_entry, entry, metadata, "bogus")
+        ecv.exc.run.assert_called_with(ecv.cmd, inputdata="bogus")
 
         ecv.exc.reset_mock()
         ecv.exc.run.side_effect = OSError
         self.assertRaises(CfgVerificationError,
-                          ecv.verify_entry, entry, metadata, "data")
-        ecv.exc.run.assert_called_with(ecv.cmd, inputdata="data")
+                          ecv.verify_entry, entry, metadata, "other")
+        ecv.exc.run.assert_called_with(ecv.cmd, inputdata="other")
+
+    def test_verify_entry_cache_size(self):
+        entry = lxml.etree.Element("Path", name="/test.txt")
+        Bcfg2.Options.setup.cfg_verifier_cache_size = 3
+        try:
+            ecv = self.get_obj()
+            ecv.exc = Mock()
+            ecv.exc.run.return_value.success = True
+            for i in range(5):
+                ecv.verify_entry(entry, Mock(), "data%d" % i)
+            self.assertEqual(len(ecv.results), 3)
+
+            ecv.exc.reset_mock()
+            ecv.verify_entry(entry, Mock(), "data4")
+            self.assertFalse(ecv.exc.run.called)
+            ecv.verify_entry(entry, Mock(), "data0")
+            ecv.exc.run.assert_called_with(ecv.cmd, inputdata="data0")
+        finally:
+            Bcfg2.Options.setup.cfg_verifier_cache_size = 1000
+
+    def write_script(self, persistent=False):
+        """ write a verifier script that rejects data containing
+        "bogus" """
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, ":test")
+        if persistent:
+            body = """\
+# bcfg2-verifier: persistent
+import os
+import sys
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    data = sys.stdin.read(int(line))
+    if "bogus" in data:
+        sys.stdout.write("bogus data from %s\\n" % os.getpid())
+    else:
+        sys.stdout.write("OK\\n")
+    sys.stdout.flush()
+"""
+        else:
+            body = """\
+import sys
+if "bogus" in sys.stdin.read():
+    sys.stderr.write("bogus data")
+    sys.exit(1)
+"""
+        open(path, "w").write("#!%s\n%s" % (sys.executable, body))
+        return path
+
+    def get_script_obj(self, persistent=False):
+        ecv = self.get_obj(name=self.write_script(persistent=persistent))
+        ecv.handle_event(Mock())
+        return ecv
+
+    def test_persistent(self):
+        entry = lxml.etree.Element("Path", name="/test.txt")
+        ecv = self.get_script_obj(persistent=True)
+        self.assertIsNotNone(ecv.pool)
+        try:
+            ecv.verify_entry(entry, Mock(), "good data\nmore data\n")
+            try:
+                ecv.verify_entry(entry, Mock(), "bogus data\n")
+                self.fail("Bogus data passed verification")
+            except CfgVerificationError:
+                err = str(sys.exc_info()[1])
+            self.assertTrue(err.startswith("bogus data from "))
+            ecv.verify_entry(entry, Mock(), "")
+
+            # the same worker was used each time
+            self.assertEqual(len(ecv.pool.workers), 1)
+            self.assertIn(str(ecv.pool.workers[0].pid), err)
+
+            # a worker that dies is replaced
+            ecv.pool.workers[0].kill()
+            ecv.pool.workers[0].wait()
+            self.assertRaises(CfgVerificationError,
+                              ecv.verify_entry, entry, Mock(), "data1")
+            ecv.verify_entry(entry, Mock(), "data2")
+            self.assertEqual(len(ecv.pool.workers), 1)
+
+            # changing the script stops the workers
+            pool = ecv.pool
+            proc = pool.workers[0]
+            ecv.handle_event(Mock())
+            self.assertEqual(pool.workers, [])
+            self.assertIsNotNone(proc.poll())
+        finally:
+            ecv.pool.close()
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare running a verifier for each file to a verifier
+        with the result cache and persistent workers """
+        entry = lxml.etree.Element("Path", name="/test.txt")
+        files = ["file %d\n" % (i % 10) for i in range(50)]
+
+        ecv = self.get_script_obj()
+        ecv.results = dict()
+        self.assertIsNone(ecv.pool)
+        start = time.time()
+        for data in files:
+            ecv.verify_entry(entry, Mock(), data)
+            ecv.results.clear()
+        uncached_time = time.time() - start
+        self.assertRaises(CfgVerificationError,
+                          ecv.verify_entry, entry, Mock(), "bogus")
+        shutil.rmtree(self.tmpdir)
+
+        ecv = self.get_script_obj(persistent=True)
+        try:
+            start = time.time()
+            for data in files:
+                ecv.verify_entry(entry, Mock(), data)
+            cached_time = time.time() - start
+            self.assertRaises(CfgVerificationError,
+                              ecv.verify_entry, entry, Mock(), "bogus")
+        finally:
+            ecv.pool.close()
+
+        report_benchmark("Verified %d files: %.4fs, with result cache "
+                         "and persistent workers %.4fs" %
+                         (len(files), uncached_time, cached_time))
 
     @patch("os.access")
     def test_handle_event(self, mock_access):
@@ -1,10 +1,12 @@
 import os
 import sys
+import time
 import lxml.etree
 from mock import Mock, MagicMock, patch
 import Bcfg2.Server.Plugins.Cfg.CfgGenshiGenerator
 from Bcfg2.Server.Plugins.Cfg.CfgGenshiGenerator import *
 from Bcfg2.Server.Plugin import PluginExecutionError
+from Bcfg2.Server.Plugins.Metadata import ClientMetadata
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -25,6 +27,7 @@ class TestCfgGenshiGenerator(TestCfgGenerator):
     def setUp(self):
         TestCfgGenerator.setUp(self)
         set_setup_default("repository", datastore)
+        set_setup_default("cfg_template_cache", False)
 
     def test__init(self):
         TestCfgGenerator.test__init(self)
@@ -118,6 +121,84 @@ class TestCfgGenshiGenerator(TestCfgGenerator):
                                          strip_whitespace=False)
         self.assertTrue(cgg._handle_genshi_exception.called)
 
+    def render_clients(self, func):
+        """ call ``func`` with a CfgGenshiGenerator object for a
+        template that only depends on the client profile and groups,
+        a list of 200 clients, and an entry to render """
+        template = """\
+{% if 'webserver' in metadata.groups %}\
+Listen 80
+{% end %}\
+{% for i in range(200) %}\
+option${i} = ${metadata.profile}-${i}
+{% end %}\
+"""
+        clients = []
+        for i in range(200):
+            groups = set(["profile%d" % (i % 4)])
+            if i % 2:
+                groups.add("webserver")
+            clients.append(ClientMetadata("client%d" % i, "profile%d" % (i % 4),
+                                          groups, set(), [], [], dict(),
+                                          None, None, None, Mock()))
+        entry = lxml.etree.Element("Path", name="/test.txt")
+
+        @patch("Bcfg2.Server.FileMonitor.get_fam", Mock())
+        @patch("Bcfg2.Server.Plugins.Cfg.CfgGenshiGenerator.get_template_data")
+        def inner(mock_get_template_data):
+            mock_get_template_data.side_effect = \
+                lambda e, m, n, default=None: dict(name=e.get("name"),
+                                                   metadata=m, path=n,
+                                                   source_path=n,
+                                                   repo=datastore)
+            cgg = self.get_obj()
+            cgg.template = NewTextTemplate(template)
+            cgg._render = Mock(side_effect=cgg._render)
+            try:
+                func(cgg, clients, entry)
+            finally:
+                Bcfg2.Options.setup.cfg_template_cache = False
+                Bcfg2.Server.Cache.expire("Cfg")
+
+        inner()
+
+    def test_render_cache(self):
+        """ rendering a template with the render cache gives the same
+        result as rendering it for each client """
+        def test(cgg, clients, entry):
+            Bcfg2.Options.setup.cfg_template_cache = False
+            expected = [cgg.get_data(entry, m) for m in clients]
+            self.assertEqual(cgg._render.call_count, len(clients))
+
+            cgg._render.reset_mock()
+            Bcfg2.Options.setup.cfg_template_cache = True
+            actual = [cgg.get_data(entry, m) for m in clients]
+            self.assertEqual(actual, expected)
+            self.assertIn("Listen 80", actual[1])
+            self.assertNotIn("Listen 80", actual[0])
+            # once for each profile
+            self.assertEqual(cgg._render.call_count, 4)
+
+        self.render_clients(test)
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare rendering a template for each client to rendering
+        it with the render cache """
+        def test(cgg, clients, entry):
+            times = dict()
+            for cache in [False, True]:
+                Bcfg2.Options.setup.cfg_template_cache = cache
+                start = time.time()
+                for metadata in clients:
+                    cgg.get_data(entry, metadata)
+                times[cache] = time.time() - start
+            report_benchmark("Genshi template for %d clients: uncached "
+                             "%.4fs, cached %.4fs" %
+                             (len(clients), times[False], times[True]))
+
+        self.render_clients(test)
+
     def test_handle_event(self):
         cgg = self.get_obj()
         cgg.loader = Mock()
@@ -24,6 +24,7 @@ class TestCfgJinja2Generator(TestCfgGenerator):
     def setUp(self):
         TestCfgGenerator.setUp(self)
         set_setup_default("repository", datastore)
+        set_setup_default("cfg_template_cache", False)
 
     def test__init(self):
         TestCfgGenerator.test__init(self)
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import errno
 import lxml.etree
 import Bcfg2.Options
@@ -7,6 +8,7 @@ from Bcfg2.Compat import walk_packages, ConfigParser
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.Cfg import *
 from Bcfg2.Server.Plugin import PluginExecutionError, Specificity
+from Bcfg2.Server.Plugins.Metadata import ClientMetadata
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -341,6 +343,168 @@ class TestCfgDefaultInfo(TestCfgInfo):
                               dict(owner="root", mode="0600", name="test"))
 
 
+class TestCfgTemplateCache(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        Bcfg2.Options.setup.cfg_template_cache = True
+        self.fam = Mock()
+        self.fam.generation = 1
+
+    def tearDown(self):
+        Bcfg2.Server.Cache.expire("Cfg")
+
+    def get_metadata(self, hostname, profile="profile1", groups=None,
+                     **kwargs):
+        if groups is None:
+            groups = set([profile])
+        metadata = ClientMetadata(hostname, profile, groups, set(), [], [],
+                                  dict(), None, None, None, Mock())
+        for key, val in kwargs.items():
+            setattr(metadata, key, val)
+        return metadata
+
+    def get_obj(self, func):
+        """ get a CfgTemplateCache, and a render function that
+        records each render, calls ``func`` with the metadata, and
+        returns the result """
+        cache = CfgTemplateCache("/test.txt.genshi")
+        rendered = []
+
+        def render(data):
+            rendered.append(data)
+            return func(data['metadata'])
+
+        return cache, render, rendered
+
+    def render(self, cache, render, metadata, **data):
+        data['metadata'] = metadata
+        data.setdefault('name', '/test.txt')
+        return cache.render(data, render)
+
+    def test_render(self):
+        @patch("Bcfg2.Server.FileMonitor.get_fam")
+        def inner(mock_get_fam):
+            mock_get_fam.return_value = self.fam
+            cache, render, rendered = self.get_obj(
+                lambda m: "profile: %s" % m.profile)
+            foo = self.get_metadata("foo.example.com")
+            bar = self.get_metadata("bar.example.com")
+            baz = self.get_metadata("baz.example.com", profile="profile2")
+
+            self.assertEqual(self.render(cache, render, foo),
+                             "profile: profile1")
+            self.assertEqual(self.render(cache, render, bar),
+                             "profile: profile1")
+            self.assertEqual(len(rendered), 1)
+            # the template gets a recorder, not the real metadata
+            self.assertIsInstance(rendered[0]['metadata'], MetadataRecorder)
+            self.assertEqual(self.render(cache, render, baz),
+                             "profile: profile2")
+            self.assertEqual(len(rendered), 2)
+
+            # other template variables are part of the key
+            self.assertEqual(self.render(cache, render, foo, name="/other"),
+                             "profile: profile1")
+            self.assertEqual(len(rendered), 3)
+
+            # anything in the repository changing drops the cache
+            self.fam.generation += 1
+            self.render(cache, render, foo)
+            self.assertEqual(len(rendered), 4)
+            self.render(cache, render, bar)
+            self.assertEqual(len(rendered), 4)
+
+            # caching can be turned off
+            Bcfg2.Options.setup.cfg_template_cache = False
+            self.render(cache, render, foo)
+            self.assertEqual(len(rendered), 5)
+            self.assertEqual(rendered[-1]['metadata'], foo)
+
+        inner()
+
+    def test_render_groups(self):
+        """ only the group memberships a template checks are recorded """
+        def template(metadata):
+            if "web" in metadata.groups:
+                return "web"
+            elif metadata.inGroup("db"):
+                return "db %s" % metadata.hostname
+            return "other"
+
+        @patch("Bcfg2.Server.FileMonitor.get_fam")
+        def inner(mock_get_fam):
+            mock_get_fam.return_value = self.fam
+            cache, render, rendered = self.get_obj(template)
+            clients = [
+                self.get_metadata("web1", groups=set(["web", "a"])),
+                self.get_metadata("web2", groups=set(["web", "db"])),
+                self.get_metadata("db1", groups=set(["db", "a"])),
+                self.get_metadata("db2", groups=set(["db", "b"])),
+                self.get_metadata("other1", groups=set(["a"])),
+                self.get_metadata("other2", groups=set(["b", "c"]))]
+            self.assertEqual([self.render(cache, render, m) for m in clients],
+                             ["web", "web", "db db1", "db db2", "other",
+                              "other"])
+            # db clients depend on the hostname, so each is rendered
+            self.assertEqual(len(rendered), 4)
+            self.assertEqual(
+                [self.render(cache, render, m) for m in clients[::-1]],
+                ["other", "other", "db db2", "db db1", "web", "web"])
+            self.assertEqual(len(rendered), 4)
+
+        inner()
+
+    def test_render_data(self):
+        """ connector data is recorded key by key """
+        def template(metadata):
+            return "%s %s" % (metadata.Probes.get("arch"),
+                              "foo.xml" in metadata.Properties)
+
+        @patch("Bcfg2.Server.FileMonitor.get_fam")
+        def inner(mock_get_fam):
+            mock_get_fam.return_value = self.fam
+            cache, render, rendered = self.get_obj(template)
+            foo = self.get_metadata("foo", Probes=dict(arch="x86_64",
+                                                       other="1"),
+                                    Properties=dict())
+            bar = self.get_metadata("bar", Probes=dict(arch="x86_64",
+                                                       other="2"),
+                                    Properties=dict())
+            baz = self.get_metadata("baz", Probes=dict(arch="x86_64"),
+                                    Properties={"foo.xml": Mock()})
+            self.assertEqual(self.render(cache, render, foo), "x86_64 False")
+            self.assertEqual(self.render(cache, render, bar), "x86_64 False")
+            self.assertEqual(len(rendered), 1)
+            self.assertEqual(self.render(cache, render, baz), "x86_64 True")
+            self.assertEqual(len(rendered), 2)
+
+        inner()
+
+    def test_render_uncacheable(self):
+        @patch("Bcfg2.Server.FileMonitor.get_fam")
+        def inner(mock_get_fam):
+            mock_get_fam.return_value = self.fam
+            foo = self.get_metadata("foo.example.com")
+
+            # templates that look at other clients are not cached
+            cache, render, rendered = self.get_obj(
+                lambda m: m.query.names_by_groups(["foo"]))
+            self.render(cache, render, foo)
+            self.render(cache, render, foo)
+            self.assertEqual(len(rendered), 2)
+
+            # nor are templates with variables that can't be hashed
+            class Unhashable(object):
+                __hash__ = None
+
+            cache, render, rendered = self.get_obj(lambda m: m.profile)
+            self.render(cache, render, foo, other=[Unhashable()])
+            self.render(cache, render, foo, other=[Unhashable()])
+            self.assertEqual(len(rendered), 2)
+
+        inner()
+
+
 class TestCfgEntrySet(TestEntrySet):
     test_obj = CfgEntrySet
 
@@ -598,62 +762,151 @@ class TestCfgEntrySet(TestEntrySet):
     def test_get_handlers(self):
         eset = self.get_obj()
         eset.entries['test1.txt'] = CfgInfo("test1.txt")
-        eset.entries['test2.txt'] = CfgGenerator("test2.txt", Mock())
-        eset.entries['test2.txt'].specific.matches.return_value = True
+        eset.entries['test2.txt'] = CfgGenerator("test2.txt",
+                                                 Specificity(all=True))
         eset.entries['test3.txt'] = CfgInfo("test3.txt")
-        eset.entries['test4.txt'] = CfgGenerator("test4.txt", Mock())
-        eset.entries['test4.txt'].specific.matches.return_value = False
-        eset.entries['test5.txt'] = CfgGenerator("test5.txt", Mock())
-        eset.entries['test5.txt'].specific.matches.return_value = True
-        eset.entries['test6.txt'] = CfgVerifier("test6.txt", Mock())
-        eset.entries['test6.txt'].specific.matches.return_value = True
-        eset.entries['test7.txt'] = CfgFilter("test7.txt", Mock())
-        eset.entries['test7.txt'].specific.matches.return_value = False
-
-        def reset():
-            for e in eset.entries.values():
-                if hasattr(e.specific, "reset_mock"):
-                    e.specific.reset_mock()
+        eset.entries['test4.txt'] = CfgGenerator(
+            "test4.txt", Specificity(hostname="bar.example.com"))
+        eset.entries['test5.txt'] = CfgGenerator(
+            "test5.txt", Specificity(group="group1", prio=10))
+        eset.entries['test6.txt'] = CfgVerifier("test6.txt",
+                                                Specificity(all=True))
+        eset.entries['test7.txt'] = CfgFilter(
+            "test7.txt", Specificity(group="group3", prio=10))
+        eset.entries['test8.txt'] = CfgGenerator(
+            "test8.txt", Specificity(group="group2", prio=20))
+        eset.entries['test9.txt'] = CfgGenerator(
+            "test9.txt", Specificity(hostname="foo.example.com"))
 
         metadata = Mock()
-        self.assertItemsEqual(eset.get_handlers(metadata, CfgGenerator),
-                              [eset.entries['test2.txt'],
-                               eset.entries['test5.txt']])
-        for ename in ['test2.txt', 'test4.txt', 'test5.txt']:
-            eset.entries[ename].specific.matches.assert_called_with(metadata)
-        for ename in ['test6.txt', 'test7.txt']:
-            self.assertFalse(eset.entries[ename].specific.matches.called)
-
-        reset()
+        metadata.hostname = "foo.example.com"
+        metadata.groups = set(["group1", "group2"])
+        # handlers are returned from most to least specific
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test9.txt'],
+                          eset.entries['test8.txt'],
+                          eset.entries['test5.txt'],
+                          eset.entries['test2.txt']])
         self.assertItemsEqual(eset.get_handlers(metadata, CfgInfo),
                               [eset.entries['test1.txt'],
                                eset.entries['test3.txt']])
-        for entry in eset.entries.values():
-            if hasattr(entry.specific.matches, "called"):
-                self.assertFalse(entry.specific.matches.called)
+        self.assertEqual(eset.get_handlers(metadata, CfgVerifier),
+                         [eset.entries['test6.txt']])
+        self.assertEqual(eset.get_handlers(metadata, CfgFilter), [])
+        self.assertEqual(eset.get_handlers(metadata, Mock), [])
+
+        metadata.hostname = "bar.example.com"
+        metadata.groups = set(["group3"])
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test4.txt'],
+                          eset.entries['test2.txt']])
+        self.assertEqual(eset.get_handlers(metadata, CfgFilter),
+                         [eset.entries['test7.txt']])
+
+        # the returned list can be modified without affecting the
+        # index
+        eset.get_handlers(metadata, CfgGenerator).pop()
+        self.assertEqual(len(eset.get_handlers(metadata, CfgGenerator)), 2)
+
+        # the index is rebuilt when a file is deleted
+        evt = Mock()
+        evt.code2str.return_value = "deleted"
+        evt.filename = "test4.txt"
+        eset.handle_event(evt)
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test2.txt']])
+
+    def get_handler_clients(self):
+        """ get an entry set with many group- and host-specific
+        handlers, a list of clients for it, and a function that finds
+        the handlers for a client by scanning all of them """
+        def scan(eset, metadata, handler_type):
+            rv = [ent for ent in eset.entries.values()
+                  if (isinstance(ent, handler_type) and
+                      (not ent.__specific__ or
+                       ent.specific.matches(metadata)))]
+            rv.sort(key=lambda h: h.specific)
+            return rv
 
-        reset()
-        self.assertItemsEqual(eset.get_handlers(metadata, CfgVerifier),
-                              [eset.entries['test6.txt']])
-        eset.entries['test6.txt'].specific.matches.assert_called_with(metadata)
-        for ename, entry in eset.entries.items():
-            if (ename != 'test6.txt' and
-                hasattr(entry.specific.matches, "called")):
-                self.assertFalse(entry.specific.matches.called)
+        eset = self.get_obj()
+        eset.entries['test.txt'] = CfgGenerator("test.txt",
+                                                Specificity(all=True))
+        for i in range(100):
+            name = "test.txt.G%02d_group%d" % (i % 100, i)
+            eset.entries[name] = CfgGenerator(
+                name, Specificity(group="group%d" % i, prio=i % 100))
+        for i in range(300):
+            name = "test.txt.H_host%d" % i
+            eset.entries[name] = CfgGenerator(
+                name, Specificity(hostname="host%d" % i))
+            name = "test.txt.H_host%d.genshi_include" % i
+            eset.entries[name] = CfgFilter(
+                name, Specificity(hostname="host%d" % i))
+
+        clients = []
+        for i in range(500):
+            metadata = Mock()
+            metadata.hostname = "host%d" % i
+            metadata.groups = set(["group%d" % g
+                                   for g in range(i % 100, 100, 7)])
+            clients.append(metadata)
+        return eset, clients, scan
+
+    def test_get_handlers_scan(self):
+        """ indexed handler lookup finds the same handlers as a scan
+        of all handlers """
+        eset, clients, scan = self.get_handler_clients()
+        for metadata in clients:
+            self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                             scan(eset, metadata, CfgGenerator))
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare indexed handler lookup to a scan of all handlers """
+        eset, clients, scan = self.get_handler_clients()
+        start = time.time()
+        for metadata in clients:
+            scan(eset, metadata, CfgGenerator)
+        scan_time = time.time() - start
+
+        start = time.time()
+        for metadata in clients:
+            eset.get_handlers(metadata, CfgGenerator)
+        index_time = time.time() - start
+
+        report_benchmark("Cfg handler lookup for %d clients: scan %.4fs, "
+                         "index %.4fs" % (len(clients), scan_time,
+                                          index_time))
+
+    def test_is_host_independent(self):
+        eset = self.get_obj()
+        eset.best_matching = Mock()
+        eset.get_handlers = Mock()
+        entry = lxml.etree.Element("Path", name="/test.txt")
+        metadata = Mock()
 
-        reset()
-        self.assertItemsEqual(eset.get_handlers(metadata, CfgFilter), [])
-        eset.entries['test7.txt'].specific.matches.assert_called_with(metadata)
-        for ename, entry in eset.entries.items():
-            if (ename != 'test7.txt' and
-                hasattr(entry.specific.matches, "called")):
-                self.assertFalse(entry.specific.matches.called)
+        def handler(host_independent=True, hostname=None):
+            return Mock(host_independent=host_independent,
+                        specific=Mock(hostname=hostname))
 
-        reset()
-        self.assertItemsEqual(eset.get_handlers(metadata, Mock), [])
-        for ename, entry in eset.entries.items():
-            if hasattr(entry.specific.matches, "called"):
-                self.assertFalse(entry.specific.matches.called)
+        generator = handler()
+        eset.best_matching.return_value = generator
+        handlers = dict([(CfgGenerator, [generator]),
+                         (CfgInfo, [handler()]),
+                         (CfgFilter, []),
+                         (CfgVerifier, [handler()])])
+        eset.get_handlers.side_effect = lambda m, t: handlers[t]
+        self.assertTrue(eset.is_host_independent(entry, metadata))
+
+        handlers[CfgVerifier][0].host_independent = False
+        self.assertFalse(eset.is_host_independent(entry, metadata))
+
+        handlers[CfgVerifier] = []
+        generator.specific.hostname = "foo.example.com"
+        self.assertFalse(eset.is_host_independent(entry, metadata))
+
+        eset.best_matching.side_effect = PluginExecutionError
+        self.assertFalse(eset.is_host_independent(entry, metadata))
 
     @patch("Bcfg2.Server.Plugins.Cfg.CfgDefaultInfo")
     def test_bind_info_to_entry(self, mock_DefaultInfo):
@@ -5,6 +5,7 @@ import time
 import socket
 import lxml.etree
 import Bcfg2.Server
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
 from mock import Mock, MagicMock, patch
 
@@ -1076,6 +1077,174 @@ class TestMetadata(_TestMetadata, TestClientRunHooks, TestDatabaseBacked):
                               [c.get("name")
                                for c in get_clients_test_tree().findall("//Client[@profile='group2']")])
 
+    def test_index_client(self):
+        metadata = self.get_obj()
+        metadata.index_client(Mock(hostname="foo.example.com",
+                                   groups=set(["group1", "group2"]),
+                                   profile="group1", bundles=set()))
+        metadata.index_client(Mock(hostname="bar.example.com",
+                                   groups=set(["group1"]),
+                                   profile="group1", bundles=set(["b1"])))
+        self.assertEqual(metadata._index,
+                         dict(groups=dict(group1=set(["foo.example.com",
+                                                      "bar.example.com"]),
+                                          group2=set(["foo.example.com"])),
+                              profile=dict(group1=set(["foo.example.com",
+                                                       "bar.example.com"])),
+                              bundles=dict(b1=set(["bar.example.com"]))))
+
+        # indexing a client again replaces its old values
+        metadata.index_client(Mock(hostname="foo.example.com",
+                                   groups=set(["group2"]),
+                                   profile="group2", bundles=set()))
+        self.assertEqual(metadata._index,
+                         dict(groups=dict(group1=set(["bar.example.com"]),
+                                          group2=set(["foo.example.com"])),
+                              profile=dict(group1=set(["bar.example.com"]),
+                                           group2=set(["foo.example.com"])),
+                              bundles=dict(b1=set(["bar.example.com"]))))
+        metadata.shutdown()
+
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_get_client_names_index(self):
+        metadata = self.load_clients_data(metadata=self.load_groups_data())
+        # emulate the core in cautious/aggressive caching mode, which
+        # indexes each metadata object it caches
+        def build_metadata(client):
+            imd = metadata.get_initial_metadata(client)
+            metadata.index_client(imd)
+            return imd
+        metadata.core.build_metadata = Mock()
+        metadata.core.build_metadata.side_effect = build_metadata
+        clients = metadata.list_clients()
+        expected = [c.get("name")
+                    for c in get_clients_test_tree().findall(
+                        "//Client[@profile='group2']")]
+
+        # the first query builds metadata for (and indexes) every
+        # client
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(clients))
+
+        # later queries are answered from the index
+        metadata.core.build_metadata.reset_mock()
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        self.assertItemsEqual(
+            metadata.get_client_names_by_profiles(["group2"]), expected)
+        imd = metadata.get_initial_metadata("client1")
+        self.assertItemsEqual(
+            metadata.get_client_names_by_bundles(list(imd.bundles)),
+            [c for c in clients
+             if metadata.get_initial_metadata(c).bundles.issuperset(
+                 imd.bundles)])
+        self.assertItemsEqual(metadata.get_client_names_by_groups([]),
+                              clients)
+        self.assertItemsEqual(
+            metadata.get_client_names_by_groups(["group2", "nonexistent"]),
+            [])
+        self.assertFalse(metadata.core.build_metadata.called)
+
+        # expiring a client's metadata removes it from the index, so
+        # its metadata is built again
+        Bcfg2.Server.Cache.expire("Metadata", expected[0])
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        metadata.core.build_metadata.assert_called_once_with(expected[0])
+
+        # expiring other data about a client doesn't affect the index
+        metadata.core.build_metadata.reset_mock()
+        Bcfg2.Server.Cache.expire("Probes", "probegroups", expected[0])
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        self.assertFalse(metadata.core.build_metadata.called)
+
+        # nor does evicting a client's metadata from the cache, but
+        # expiring it afterwards still removes it from the index
+        cache = Bcfg2.Server.Cache.Cache("Metadata")
+        cache[expected[0]] = metadata.get_initial_metadata(expected[0])
+        Bcfg2.Server.Cache.set_policy("Metadata", max_entries=1)
+        try:
+            cache[expected[1]] = metadata.get_initial_metadata(expected[1])
+            self.assertNotIn(expected[0], cache)
+            self.assertItemsEqual(
+                metadata.get_client_names_by_groups(["group2"]), expected)
+            self.assertFalse(metadata.core.build_metadata.called)
+            cache.expire(expected[0])
+            self.assertItemsEqual(
+                metadata.get_client_names_by_groups(["group2"]), expected)
+            metadata.core.build_metadata.assert_called_once_with(expected[0])
+        finally:
+            Bcfg2.Server.Cache.set_policy("Metadata")
+
+        # expiring all metadata clears the index
+        metadata.core.build_metadata.reset_mock()
+        Bcfg2.Server.Cache.expire("Metadata")
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(clients))
+
+        # so does forking a child, which may have been forked while
+        # the index was being changed
+        metadata.core.build_metadata.reset_mock()
+        lock = metadata._index_lock
+        metadata.after_fork(False)
+        self.assertIs(metadata._index_lock, lock)
+        metadata.get_client_names_by_groups(["group2"])
+        self.assertFalse(metadata.core.build_metadata.called)
+        metadata._index_lock.acquire()
+        metadata.after_fork(True)
+        self.assertIsNot(metadata._index_lock, lock)
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected)
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(clients))
+        metadata.shutdown()
+
+    @benchmark
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_get_client_names_benchmark(self):
+        """ querying clients by group with and without the index """
+        metadata = self.get_obj()
+        count = 5000
+        cached = dict()
+        for i in range(count):
+            hostname = "client%d.example.com" % i
+            cached[hostname] = Mock(hostname=hostname,
+                                    profile="profile%d" % (i % 10),
+                                    groups=set(["group%d" % (i % 10),
+                                                "group%d" % (i % 7),
+                                                "all"]),
+                                    bundles=set(["bundle%d" % (i % 3)]))
+        metadata.list_clients = Mock(return_value=list(cached.keys()))
+        # build_metadata returns cached objects, as in aggressive
+        # caching mode, so this only measures the query itself
+        metadata.core.build_metadata = Mock()
+        metadata.core.build_metadata.side_effect = lambda c: cached[c]
+
+        times = dict()
+        results = dict()
+        for indexed in [False, True]:
+            if indexed:
+                for imd in cached.values():
+                    metadata.index_client(imd)
+            start = time.time()
+            results[indexed] = \
+                sorted(metadata.get_client_names_by_groups(["group1",
+                                                            "group3"]))
+            times[indexed] = time.time() - start
+            report_benchmark("Querying %d clients by group (indexed=%s): "
+                             "%.4fs" % (count, indexed, times[indexed]))
+        self.assertEqual(results[True], results[False])
+        self.assertItemsEqual(
+            results[True],
+            [c for c, imd in cached.items()
+             if imd.groups.issuperset(["group1", "group3"])])
+        metadata.shutdown()
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_merge_additional_groups(self):
         metadata = self.load_clients_data(metadata=self.load_groups_data())
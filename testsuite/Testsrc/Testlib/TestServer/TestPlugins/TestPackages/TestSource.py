@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import lxml.etree
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.Source import *
+
+
+class RepoHandler(BaseHTTPRequestHandler):
+    """ serve the files in ``server.files``, honoring conditional
+    requests, and record each request in ``server.requests`` """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        content, etag, modified = self.server.files[self.path]
+        time.sleep(self.server.delay)
+        if ((etag and self.headers.get("If-None-Match") == etag) or
+                (modified and
+                 self.headers.get("If-Modified-Since") == modified)):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        if modified:
+            self.send_header("Last-Modified", modified)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class RepoServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestSource(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        set_setup_default("packages_download_threads", 4)
+        self.basepath = tempfile.mkdtemp()
+        self.server = RepoServer(("127.0.0.1", 0), RepoHandler)
+        self.server.files = dict()
+        self.server.requests = []
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.baseurl = "http://127.0.0.1:%s" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.basepath)
+
+    def get_obj(self, urls):
+        xsource = lxml.etree.Element("Source", rawurl=self.baseurl)
+        lxml.etree.SubElement(xsource, "Arch").text = "x86_64"
+        src = Source(self.basepath, xsource)
+        # Source.urls is a property that returns nothing in the base
+        # class, so replace it on a throwaway subclass
+        src.__class__ = type("TestSource", (Source, ), dict(urls=urls))
+        return src
+
+    def add_file(self, name, content, etag=None, modified=None):
+        self.server.files[name] = (content, etag, modified)
+        return self.baseurl + name
+
+    def test_update(self):
+        urls = [self.add_file("/primary.xml.gz", b"primary", etag='"p1"'),
+                self.add_file("/filelists.xml.gz", b"filelists",
+                              modified="Mon, 01 Jan 2024 00:00:00 GMT"),
+                self.add_file("/comps.xml", b"comps")]
+        src = self.get_obj(urls)
+        src.update()
+        for url in urls:
+            name = "/" + url.rsplit("/", 1)[1]
+            self.assertEqual(open(src.escape_url(url), 'rb').read(),
+                             self.server.files[name][0])
+
+        # files with an ETag or Last-Modified header are requested
+        # conditionally the second time
+        self.server.requests = []
+        src.update()
+        headers = dict(self.server.requests)
+        self.assertEqual(headers["/primary.xml.gz"].get("if-none-match"),
+                         '"p1"')
+        self.assertEqual(
+            headers["/filelists.xml.gz"].get("if-modified-since"),
+            "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertNotIn("if-none-match", headers["/comps.xml"])
+        self.assertNotIn("if-modified-since", headers["/comps.xml"])
+
+        # a changed file is downloaded again
+        self.add_file("/primary.xml.gz", b"new primary", etag='"p2"')
+        src.update()
+        self.assertEqual(open(src.escape_url(urls[0]), 'rb').read(),
+                         b"new primary")
+
+        # a missing local file is always downloaded unconditionally
+        self.server.requests = []
+        os.unlink(src.escape_url(urls[0]))
+        src.update()
+        headers = dict(self.server.requests)
+        self.assertNotIn("if-none-match", headers["/primary.xml.gz"])
+        self.assertEqual(open(src.escape_url(urls[0]), 'rb').read(),
+                         b"new primary")
+
+    def test_update_checksums(self):
+        content = b"primary data"
+        url = self.add_file("/primary.xml.gz", content)
+        src = self.get_obj([url])
+        fname = src.escape_url(url)
+        src.checksums[fname] = ("sha256",
+                                hashlib.sha256(content).hexdigest())
+        src.update()
+        self.assertEqual(open(fname, 'rb').read(), content)
+
+        # the local copy matches the checksum, so it isn't requested
+        self.server.requests = []
+        src.update()
+        self.assertEqual(self.server.requests, [])
+
+        # downloaded data that doesn't match is rejected, and the
+        # local copy is left alone
+        self.add_file("/primary.xml.gz", b"corrupt")
+        src.checksums[fname] = ("sha256", hashlib.sha256(b"new").hexdigest())
+        self.assertRaises(SourceChecksumError, src.update)
+        self.assertEqual(open(fname, 'rb').read(), content)
+
+    def test_update_checksums_validators(self):
+        url = self.add_file("/primary.xml.gz", b"old", etag='"p1"')
+        src = self.get_obj([url])
+        fname = src.escape_url(url)
+        vfile = fname + ".validators"
+        src.update()
+        self.assertTrue(os.path.exists(vfile))
+
+        # a local copy that doesn't match the checksum is downloaded
+        # unconditionally, even if the server would say that it
+        # hasn't changed
+        self.server.requests = []
+        self.add_file("/primary.xml.gz", b"new", etag='"p1"')
+        src.checksums[fname] = ("sha256", hashlib.sha256(b"new").hexdigest())
+        src.update()
+        self.assertNotIn("if-none-match", dict(self.server.requests)[
+            "/primary.xml.gz"])
+        self.assertEqual(open(fname, 'rb').read(), b"new")
+        self.assertTrue(os.path.exists(vfile))
+
+        # downloaded data that doesn't match its checksum drops the
+        # validators, so the next update is unconditional, too
+        self.add_file("/primary.xml.gz", b"corrupt", etag='"p2"')
+        src.checksums[fname] = ("sha256",
+                                hashlib.sha256(b"newer").hexdigest())
+        self.assertRaises(SourceChecksumError, src.update)
+        self.assertFalse(os.path.exists(vfile))
+        self.assertEqual(open(fname, 'rb').read(), b"new")
+
+    def test_update_errors(self):
+        urls = [self.add_file("/primary.xml.gz", b"primary"),
+                self.baseurl + "/missing.xml.gz"]
+        src = self.get_obj(urls)
+        self.assertRaises(HTTPError, src.update)
+        # other files are still downloaded
+        self.assertEqual(open(src.escape_url(urls[0]), 'rb').read(),
+                         b"primary")
+
+    def test_update_concurrent(self):
+        """ files are downloaded concurrently """
+        self.server.delay = 0.2
+        urls = [self.add_file("/file%d" % i, b"data") for i in range(8)]
+        src = self.get_obj(urls)
+        start = time.time()
+        src.update()
+        elapsed = time.time() - start
+        self.assertLess(elapsed, 0.2 * len(urls) / 2)
+        for url in urls:
+            self.assertTrue(os.path.exists(src.escape_url(url)))
+
+
+class TestThreadedMap(Bcfg2TestCase):
+    def test_threaded_map(self):
+        items = list(range(20))
+        for threads in [1, 4]:
+            self.assertEqual(threaded_map(lambda i: i * 2, items, threads),
+                             [i * 2 for i in items])
+
+        def fail(item):
+            if item % 5 == 4:
+                raise ValueError(item)
+            return item
+
+        try:
+            threaded_map(fail, items, 4)
+            self.fail("threaded_map did not raise")
+        except ValueError:
+            self.assertEqual(sys.exc_info()[1].args, (4, ))
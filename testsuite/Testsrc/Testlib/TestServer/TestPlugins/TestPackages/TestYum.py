@@ -0,0 +1,172 @@
+import os
+import sys
+import gzip
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+import lxml.etree
+from mock import patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.Yum import *
+
+
+PRIMARY = """<package type="rpm">
+  <name>pkg%(i)d</name>
+  <arch>x86_64</arch>
+  <version epoch="0" ver="1.%(i)d" rel="1"/>
+  <summary>Package %(i)d</summary>
+  <description>A package that does things, number %(i)d</description>
+  <format>
+    <rpm:provides>
+      <rpm:entry name="pkg%(i)d"/>
+      <rpm:entry name="libpkg%(i)d.so.1()(64bit)"/>
+    </rpm:provides>
+    <rpm:requires>
+      <rpm:entry name="pkg%(dep)d"/>
+      <rpm:entry name="%(file)s"/>
+    </rpm:requires>
+  </format>
+</package>
+"""
+
+FILELIST = """<package pkgid="%(i)d" name="pkg%(i)d" arch="x86_64">
+  <version epoch="0" ver="1.%(i)d" rel="1"/>
+  <file>/usr/bin/pkg%(i)d</file>
+  <file>/usr/lib64/libpkg%(i)d.so.1</file>
+  <file>/usr/share/doc/pkg%(i)d/README</file>
+  <file type="dir">/usr/share/doc/pkg%(i)d</file>
+</package>
+"""
+
+
+def write_repodata(basepath, count):
+    """ write synthetic primary.xml.gz and filelists.xml.gz files
+    describing ``count`` packages.  every package requires the binary
+    of one of the first ten packages """
+    primary = os.path.join(basepath, "primary.xml.gz")
+    fdata = gzip.open(primary, "wb")
+    fdata.write(('<metadata xmlns="%s" xmlns:rpm="%s" packages="%d">\n' %
+                 (XP[1:-1], RP[1:-1], count)).encode())
+    for i in range(count):
+        fdata.write((PRIMARY % dict(i=i, dep=(i + 1) % count,
+                                    file="/usr/bin/pkg%d" % (i % 10))
+                     ).encode())
+    fdata.write(b"</metadata>\n")
+    fdata.close()
+
+    filelists = os.path.join(basepath, "filelists.xml.gz")
+    fdata = gzip.open(filelists, "wb")
+    fdata.write(('<filelists xmlns="%s" packages="%d">\n' %
+                 (FL[1:-1], count)).encode())
+    for i in range(count):
+        fdata.write((FILELIST % dict(i=i)).encode())
+    fdata.write(b"</filelists>\n")
+    fdata.close()
+    return primary, filelists
+
+
+class TestYumSource(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        self.basepath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basepath)
+
+    def get_obj(self, files=None):
+        xsource = lxml.etree.Element("Source", type="yum",
+                                     url="http://example.com/repo")
+        lxml.etree.SubElement(xsource, "Arch").text = "x86_64"
+        src = YumSource(self.basepath, xsource)
+        if files is not None:
+            src.__class__ = type("TestYumSource", (YumSource, ),
+                                 dict(files=files))
+            for fname in files:
+                src.file_to_arch[fname] = "x86_64"
+        return src
+
+    def test_iterparse(self):
+        primary, filelists = write_repodata(self.basepath, 5)
+        names = [pkg.findtext(XP + "name")
+                 for pkg in iterparse(primary, XP + "package")]
+        self.assertEqual(names, ["pkg%d" % i for i in range(5)])
+
+        # uncompressed files can be parsed, too
+        plain = os.path.join(self.basepath, "filelists.xml")
+        open(plain, "wb").write(gzip.open(filelists).read())
+        names = [pkg.get("name")
+                 for pkg in iterparse(plain, FL + "package")]
+        self.assertEqual(names, ["pkg%d" % i for i in range(5)])
+
+    def test_read_files(self):
+        files = list(write_repodata(self.basepath, 20))
+        src = self.get_obj(files)
+        src.read_files()
+        self.assertItemsEqual(src.packages["global"],
+                              ["pkg%d" % i for i in range(20)])
+        self.assertItemsEqual(src.deps["x86_64"]["pkg3"],
+                              ["pkg4", "/usr/bin/pkg3"])
+        self.assertItemsEqual(src.provides["x86_64"]["libpkg5.so.1()(64bit)"],
+                              ["pkg5"])
+        # only paths that are required by some package are kept
+        self.assertItemsEqual(src.filemap["x86_64"].keys(),
+                              ["/usr/bin/pkg%d" % i for i in range(10)])
+        self.assertItemsEqual(src.filemap["x86_64"]["/usr/bin/pkg7"],
+                              ["pkg7"])
+
+    def _parse(self, files, stream, results):
+        """ parse the given files in a child process, and report the
+        parse time, the growth in peak RSS, and a summary of the
+        parsed data """
+        src = self.get_obj(files)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        if stream:
+            src.read_files()
+        else:
+            # parse each file into a complete tree, as read_files()
+            # used to
+            @patch("Bcfg2.Server.Plugins.Packages.Yum.iterparse",
+                   lambda fname, tag: lxml.etree.parse(fname).getroot())
+            def inner():
+                src.read_files()
+
+            inner()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put((elapsed, after - before,
+                     len(src.packages["global"]),
+                     sorted(src.filemap["x86_64"].keys())))
+
+    @benchmark
+    def test_benchmark(self):
+        """ parse time and peak memory for 50k packages """
+        files = list(write_repodata(self.basepath, 50000))
+        rv = dict()
+        for stream in [False, True]:
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(target=self._parse,
+                                            args=[files, stream, results])
+            child.start()
+            rv[stream] = results.get()
+            child.join()
+            report_benchmark("Yum metadata parse for 50k packages "
+                             "(stream=%s): %.2fs, peak RSS +%d KB" %
+                             (stream, rv[stream][0], rv[stream][1]))
+        self.assertEqual(rv[True][2:], rv[False][2:])
+        self.assertEqual(rv[True][2], 50000)
+        self.assertLess(rv[True][1], rv[False][1])
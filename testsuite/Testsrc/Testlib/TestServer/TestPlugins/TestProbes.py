@@ -1,8 +1,10 @@
 import os
 import re
 import sys
+import time
 import shutil
 import tempfile
+import threading
 import lxml.etree
 import Bcfg2.version
 import Bcfg2.Server
@@ -92,7 +94,8 @@ class TestProbeData(Bcfg2TestCase):
 class TestProbeSet(TestEntrySet):
     test_obj = ProbeSet
     basenames = ["test", "_test", "test-test"]
-    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml"]
+    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml",
+              "probed.journal"]
     bogus_names = ["test.py"]
 
     def get_obj(self, path=datastore, encoding=None,
@@ -176,7 +179,7 @@ group-specific"""
 
         ps.get_matching.return_value = matching
 
-        metadata = Mock()
+        metadata = Mock(hostname="foo.example.com", groups=["foogroup"])
         metadata.version_info = \
             Bcfg2.version.Bcfg2VersionInfo(Bcfg2.version.__version__)
         pdata = ps.get_probe_data(metadata)
@@ -200,6 +203,324 @@ group-specific"""
             else:
                 assert False, "Strange probe found in get_probe_data() return"
 
+    def get_probe_entries(self, ps):
+        ps.entries = dict()
+        for name, spec in [
+                ("fooprobe", dict(all=True)),
+                ("fooprobe.G10_group1", dict(group="group1", prio=10)),
+                ("barprobe", dict(all=True)),
+                ("barprobe.H_foo.example.com",
+                 dict(hostname="foo.example.com")),
+                ("bazprobe.G20_group2", dict(group="group2", prio=20))]:
+            entry = Mock()
+            entry.name = os.path.join(datastore, name)
+            entry.data = "#!/bin/sh\necho %s" % name
+            entry.specific = Bcfg2.Server.Plugin.Specificity(**spec)
+            ps.entries[name] = entry
+
+    def get_probe_metadata(self, hostname, groups):
+        return Mock(hostname=hostname, groups=groups,
+                    version_info=Bcfg2.version.Bcfg2VersionInfo(
+                        Bcfg2.version.__version__))
+
+    def test_get_probe_data_cache(self):
+        ps = self.get_obj()
+        self.get_probe_entries(ps)
+        ps.get_matching = Mock(wraps=ps.get_matching)
+
+        def get_probes(hostname, groups):
+            return dict((p.get("name"), p.text)
+                        for p in ps.get_probe_data(
+                            self.get_probe_metadata(hostname, groups)))
+
+        expected = dict(fooprobe="#!/bin/sh\necho fooprobe.G10_group1",
+                        barprobe="#!/bin/sh\necho barprobe")
+        self.assertEqual(get_probes("bar.example.com", ["group1", "other"]),
+                         expected)
+        # groups that no probes are specific to don't matter
+        self.assertEqual(get_probes("baz.example.com", ["group1"]),
+                         expected)
+        self.assertEqual(ps.get_matching.call_count, 1)
+
+        # but hostnames that probes are specific to do
+        self.assertEqual(
+            get_probes("foo.example.com", ["group1"]),
+            dict(fooprobe="#!/bin/sh\necho fooprobe.G10_group1",
+                 barprobe="#!/bin/sh\necho barprobe.H_foo.example.com"))
+        self.assertEqual(ps.get_matching.call_count, 2)
+
+        # as do old clients that can't handle unicode probes
+        metadata = self.get_probe_metadata("bar.example.com", ["group1"])
+        metadata.version_info = Bcfg2.version.Bcfg2VersionInfo("1.2.0")
+        ps.get_probe_data(metadata)
+        self.assertEqual(ps.get_matching.call_count, 3)
+
+        # each caller gets its own copy of the probes
+        metadata = self.get_probe_metadata("bar.example.com", [])
+        probes = ps.get_probe_data(metadata)
+        lxml.etree.Element("probes").extend(probes)
+        self.assertIsNone(ps.get_probe_data(metadata)[0].getparent())
+
+        # events on the probes invalidate the cache
+        ps.get_matching.reset_mock()
+        evt = Mock()
+        evt.filename = "bazprobe.G20_group2"
+        evt.code2str.return_value = "deleted"
+        ps.HandleEvent(evt)
+        self.assertEqual(get_probes("bar.example.com", ["group2"]),
+                         dict(fooprobe="#!/bin/sh\necho fooprobe",
+                              barprobe="#!/bin/sh\necho barprobe"))
+        self.assertEqual(ps.get_matching.call_count, 1)
+
+        # probes rendered while the probes change are not cached
+        ps.get_matching.reset_mock()
+        render_probes = ps._render_probes
+
+        def render_and_change(metadata):
+            rv = render_probes(metadata)
+            ps.HandleEvent(evt)
+            return rv
+
+        ps._render_probes = Mock(side_effect=render_and_change)
+        get_probes("bar.example.com", ["group1"])
+        self.assertEqual(ps._probe_cache, dict())
+        ps._render_probes = render_probes
+        get_probes("bar.example.com", ["group1"])
+        self.assertEqual(ps.get_matching.call_count, 2)
+
+    def get_benchmark_clients(self, ps):
+        """ set up 100 probes, half of them group-specific, and
+        return metadata for 500 clients in five groups """
+        ps.entries = dict()
+        for i in range(50):
+            for name, spec in [("probe%d" % i, dict(all=True)),
+                               ("probe%d.G10_group%d" % (i, i % 5),
+                                dict(group="group%d" % (i % 5), prio=10))]:
+                entry = Mock()
+                entry.name = os.path.join(datastore, name)
+                entry.data = "#!/bin/sh\necho %s\n" % name + "x" * 1000
+                entry.specific = Bcfg2.Server.Plugin.Specificity(**spec)
+                ps.entries[name] = entry
+        return [self.get_probe_metadata("host%d.example.com" % i,
+                                        ["group%d" % (i % 5), "other"])
+                for i in range(500)]
+
+    def test_get_probe_data_rendered(self):
+        """ cached probes are the same as freshly rendered ones """
+        ps = self.get_obj()
+        for metadata in self.get_benchmark_clients(ps):
+            self.assertItemsEqual(
+                [lxml.etree.tostring(p) for p in ps.get_probe_data(metadata)],
+                [lxml.etree.tostring(p)
+                 for p in ps._render_probes(metadata)])
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare rendering probes for each client to caching them """
+        ps = self.get_obj()
+        clients = self.get_benchmark_clients(ps)
+
+        start = time.time()
+        for metadata in clients:
+            ps._render_probes(metadata)
+        render_time = time.time() - start
+
+        start = time.time()
+        for metadata in clients:
+            actual = ps.get_probe_data(metadata)
+        cache_time = time.time() - start
+
+        report_benchmark("Getting %d probes for %d clients: "
+                         "render=%.4fs, cache=%.4fs" %
+                         (len(actual), len(clients), render_time, cache_time))
+
+
+class TestXMLProbeStore(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        self.datadir = tempfile.mkdtemp()
+        self.stores = []
+        Bcfg2.Server.Cache.expire("Probes")
+
+    def tearDown(self):
+        for store in self.stores:
+            store.shutdown()
+        Bcfg2.Server.Cache.expire("Probes")
+        shutil.rmtree(self.datadir)
+
+    def get_obj(self):
+        # imitate a server restart
+        Bcfg2.Server.Cache.expire("Probes")
+        store = XMLProbeStore(Mock(), self.datadir)
+        self.stores.append(store)
+        return store
+
+    def set_client(self, store, hostname, value):
+        store.set_groups(hostname, ["group-%s" % value])
+        store.set_data(hostname, dict(probe=ProbeData(value)))
+        store.commit(hostname)
+
+    def journal_lines(self):
+        try:
+            return open(os.path.join(self.datadir,
+                                     "probed.journal")).readlines()
+        except IOError:
+            return []
+
+    def test_journal(self):
+        store = self.get_obj()
+        hosts = ["host%d.example.com" % i for i in range(50)]
+        for host in hosts:
+            self.set_client(store, host, "value\nwith newline")
+        self.assertEqual(len(self.journal_lines()), len(hosts))
+        self.set_client(store, hosts[0], "new value")
+        self.assertEqual(len(self.journal_lines()), len(hosts) + 1)
+
+        # the journal is replayed on top of probed.xml, and a
+        # partly-written record is ignored
+        open(os.path.join(self.datadir, "probed.journal"),
+             "a").write('<Client name="%s" times' % hosts[1])
+        store = self.get_obj()
+        self.assertEqual(store.get_data(hosts[0])['probe'], "new value")
+        self.assertEqual(store.get_groups(hosts[0]), ["group-new value"])
+        self.assertEqual(store.get_data(hosts[1])['probe'],
+                         "value\nwith newline")
+
+        # shutting down folds the journal into probed.xml
+        store.shutdown()
+        self.assertFalse(os.path.exists(os.path.join(self.datadir,
+                                                     "probed.journal")))
+        store = self.get_obj()
+        self.assertEqual(store.get_data(hosts[0])['probe'], "new value")
+        self.assertItemsEqual(
+            [c.get("name")
+             for c in lxml.etree.parse(
+                 os.path.join(self.datadir, "probed.xml")).getroot()],
+            hosts)
+
+    def test_commit_expire(self):
+        """ a client's cached data is expired only once it has been
+        written, and the store keeps its own copy """
+        store = self.get_obj()
+        host = "foo.example.com"
+        journal = []
+
+        def expire_hook(tags, exact, count):
+            if "Probes" in tags:
+                journal.append(len(self.journal_lines()))
+
+        Bcfg2.Server.Cache.add_expire_hook(expire_hook)
+        try:
+            store.set_groups(host, ["group1"])
+            store.set_data(host, dict(probe=ProbeData("value")))
+            self.assertEqual(journal, [])
+            store.commit(host)
+        finally:
+            Bcfg2.Server.Cache.remove_expire_hook(expire_hook)
+        self.assertEqual(journal, [1, 1])
+        store.core.metadata_cache.expire.assert_called_with(host)
+        self.assertIn(host, store._datacache)
+        self.assertEqual(store.get_groups(host), ["group1"])
+
+    def test_compact(self):
+        store = self.get_obj()
+        store.min_journal_records = 0
+        hosts = ["host%d.example.com" % i for i in range(10)]
+        for host in hosts:
+            self.set_client(store, host, "value")
+        self.assertEqual(len(self.journal_lines()), len(hosts))
+
+        # once the journal has more records than there are clients,
+        # it is compacted
+        self.set_client(store, hosts[0], "new value")
+        self.assertEqual(len(self.journal_lines()), 0)
+        store = self.get_obj()
+        self.assertEqual(store.get_data(hosts[0])['probe'], "new value")
+        self.assertEqual(store.get_data(hosts[1])['probe'], "value")
+
+    def test_load_data_during_commit(self):
+        """ reloading the data while a client is being written to the
+        journal waits for it to be written """
+        store = self.get_obj()
+        host = "foo.example.com"
+        self.set_client(store, host, "old")
+        store.commit()
+        store.set_data(host, dict(probe=ProbeData("new")))
+
+        started = threading.Event()
+        proceed = threading.Event()
+        get_client_element = store._get_client_element
+
+        def slow_get_client_element(hostname):
+            started.set()
+            proceed.wait()
+            return get_client_element(hostname)
+
+        store._get_client_element = slow_get_client_element
+        commit = threading.Thread(target=store.commit, args=[host])
+        commit.start()
+        started.wait()
+        load = threading.Thread(target=store._load_data)
+        load.start()
+        load.join(0.2)
+        self.assertTrue(load.is_alive())
+        proceed.set()
+        commit.join()
+        load.join()
+        self.assertEqual(store.get_data(host)['probe'], "new")
+        self.assertEqual(len(self.journal_lines()), 1)
+
+    def test_fork(self):
+        """ the write lock is held while forking, so that a child
+        isn't forked while a client is being written """
+        store = self.get_obj()
+        host = "foo.example.com"
+        store.before_fork()
+        commit = threading.Thread(target=self.set_client,
+                                  args=[store, host, "value"])
+        commit.start()
+        commit.join(0.2)
+        self.assertTrue(commit.is_alive())
+        self.assertEqual(self.journal_lines(), [])
+        store.after_fork(False)
+        commit.join()
+        self.assertEqual(len(self.journal_lines()), 1)
+
+        # in the child, the lock is recreated, since the thread
+        # that holds it doesn't exist there
+        store.before_fork()
+        lock = store._write_lock
+        store.after_fork(True)
+        self.assertIsNot(store._write_lock, lock)
+        self.set_client(store, host, "new value")
+        self.assertEqual(len(self.journal_lines()), 2)
+
+    @benchmark
+    def test_benchmark(self):
+        """ compare writing all of probed.xml to journaling """
+        store = self.get_obj()
+        hosts = ["host%d.example.com" % i for i in range(500)]
+        for host in hosts:
+            store.set_data(host, dict(("probe%d" % i, ProbeData("x" * 100))
+                                      for i in range(10)))
+            store.set_groups(host, ["group1", "group2"])
+        store.commit()
+
+        clients = hosts[:20]
+        start = time.time()
+        for host in clients:
+            store.commit()
+        full_time = time.time() - start
+
+        start = time.time()
+        for host in clients:
+            store.commit(host)
+        journal_time = time.time() - start
+        report_benchmark("Committing probe data for %d of %d clients: "
+                         "full=%.4fs, journal=%.4fs" %
+                         (len(clients), len(hosts), full_time, journal_time))
+
 
 class TestProbes(TestDatabaseBacked):
     test_obj = Probes
@@ -274,6 +595,25 @@ group:      group:with:colons
         Bcfg2.Options.setup.probes_db = False
         self._perform_tests()
 
+    def test_probes_xml_other_process(self):
+        """ Probe data is written as soon as it is received, so that
+        another server process sees it """
+        Bcfg2.Options.setup.probes_db = False
+        probes = self.get_obj()
+        client = Mock(hostname="foo.example.com")
+        pdata = lxml.etree.Element("Probe", name="text")
+        pdata.text = "group:group1\nfreeform text"
+        probes.ReceiveData(client, [pdata])
+
+        # imitate a child process that reloads the data once it is
+        # told that it has been expired
+        Bcfg2.Server.Cache.expire("Probes")
+        other = XMLProbeStore(Mock(), probes.data)
+        self.assertEqual(other.get_data(client.hostname)["text"],
+                         "freeform text")
+        self.assertEqual(other.get_groups(client.hostname), ["group1"])
+        probes.shutdown()
+
     @skipUnless(HAS_DJANGO, "Django not found")
     def test_probes_db(self):
         """ Set and retrieve probe data with database enabled """
@@ -281,6 +621,116 @@ group:      group:with:colons
         self.syncdb(TestProbesDB)
         self._perform_tests()
 
+    @skipUnless(HAS_DJANGO, "Django not found")
+    def test_probes_db_changes(self):
+        """ Only changed probe data is written to the database """
+        Bcfg2.Options.setup.probes_db = True
+        self.syncdb(TestProbesDB)
+        store = self.get_obj().probestore
+        hostname = "foo.example.com"
+        store.set_data(hostname, dict(a=ProbeData("a"), b=ProbeData("b")))
+        store.set_groups(hostname, ["group1", "group2"])
+        # add a duplicate row, as get_or_create() could leave
+        ProbesDataModel.objects.create(hostname=hostname, probe="a",
+                                       data="a")
+        ProbesGroupsModel.objects.create(hostname=hostname, group="group1")
+
+        store.core.metadata_cache.expire.reset_mock()
+        store.set_data(hostname, dict(a=ProbeData("a"), b=ProbeData("b")))
+        store.set_groups(hostname, ["group1", "group2"])
+        self.assertItemsEqual(
+            [(r.probe, r.data)
+             for r in ProbesDataModel.objects.filter(hostname=hostname)],
+            [("a", "a"), ("b", "b")])
+        self.assertItemsEqual(
+            [r.group
+             for r in ProbesGroupsModel.objects.filter(hostname=hostname)],
+            ["group1", "group2"])
+
+        store.core.metadata_cache.expire.reset_mock()
+        store.set_data(hostname, dict(a=ProbeData("a"), b=ProbeData("b")))
+        self.assertFalse(store.core.metadata_cache.expire.called)
+
+        store.set_data(hostname, dict(a=ProbeData("new"), c=ProbeData("c")))
+        store.set_groups(hostname, ["group2", "group3"])
+        store.core.metadata_cache.expire.assert_called_with(hostname)
+        self.assertItemsEqual(
+            [(r.probe, r.data)
+             for r in ProbesDataModel.objects.filter(hostname=hostname)],
+            [("a", "new"), ("c", "c")])
+        self.assertItemsEqual(
+            [r.group
+             for r in ProbesGroupsModel.objects.filter(hostname=hostname)],
+            ["group2", "group3"])
+
+    def test__bulk_create(self):
+        """ records are created one at a time without bulk_create """
+        model = Mock()
+        records = [Mock(), Mock()]
+        DBProbeStore._bulk_create(model, records)
+        model.objects.bulk_create.assert_called_with(records)
+        for record in records:
+            self.assertFalse(record.save.called)
+
+        model.objects = Mock(spec=["filter"])
+        DBProbeStore._bulk_create(model, records)
+        for record in records:
+            record.save.assert_called_with()
+
+    @skipUnless(HAS_DJANGO, "Django not found")
+    @benchmark
+    def test_probes_db_benchmark(self):
+        """ compare probe ingestion with a query per probe to bulk
+        upserts for 1000 clients """
+        Bcfg2.Options.setup.probes_db = True
+        self.syncdb(TestProbesDB)
+        store = self.get_obj().probestore
+
+        def set_data_per_probe(hostname, data):
+            """ the way set_data() used to store probe data """
+            for probe, pdata in data.items():
+                record = ProbesDataModel.objects.get_or_create(
+                    hostname=hostname, probe=probe)[0]
+                if record.data != pdata:
+                    record.data = pdata
+                    record.save()
+            ProbesDataModel.objects.filter(
+                hostname=hostname).exclude(probe__in=data.keys()).delete()
+
+        def set_groups_per_group(hostname, groups):
+            """ the way set_groups() used to store probe groups """
+            for group in groups:
+                ProbesGroupsModel.objects.get_or_create(hostname=hostname,
+                                                        group=group)
+            ProbesGroupsModel.objects.filter(
+                hostname=hostname).exclude(group__in=groups).delete()
+
+        clients = ["host%d.example.com" % i for i in range(1000)]
+        probes = ["probe%d" % i for i in range(20)]
+        groups = ["group%d" % i for i in range(5)]
+
+        def ingest(set_data, set_groups, hosts, value):
+            start = time.time()
+            for host in hosts:
+                set_data(host, dict((probe, ProbeData("%s %s" % (probe,
+                                                                value)))
+                                    for probe in probes))
+                set_groups(host, groups)
+            return len(hosts) / (time.time() - start)
+
+        # the old way is too slow to run for all 1000 clients, so
+        # compare clients per second instead
+        old_rate = ingest(set_data_per_probe, set_groups_per_group,
+                          clients[:50], "old")
+        new_rate = ingest(store.set_data, store.set_groups, clients, "new")
+        self.assertEqual(
+            ProbesDataModel.objects.count(), len(clients) * len(probes))
+        self.assertEqual(
+            ProbesGroupsModel.objects.count(), len(clients) * len(groups))
+        report_benchmark("Ingesting probe data for %d clients: "
+                         "%.1f clients/s per probe, %.1f clients/s bulk" %
+                         (len(clients), old_rate, new_rate))
+
     def test_allowed_cgroups(self):
         """ Test option to only allow probes to set certain groups """
         probes = self.get_obj()
@@ -356,8 +806,9 @@ text""")
         self.assertItemsEqual(p.get_additional_groups(bar_md), ['other_group'])
         self.additionalDataEqual(p.get_additional_data(bar_md), bar_addl_data)
 
-        # instantiate a new Probes object and clear Probes caches to
-        # imitate a server restart
+        # shut down, then instantiate a new Probes object and clear
+        # Probes caches to imitate a server restart
+        p.shutdown()
         p = self.get_obj()
         Bcfg2.Server.Cache.expire("Probes")
 
@@ -381,8 +832,9 @@ text""")
         self.assertItemsEqual(p.get_additional_groups(bar_md), ['other_group'])
         self.additionalDataEqual(p.get_additional_data(bar_md), bar_addl_data)
 
-        # instantiate a new Probes object and clear Probes caches to
-        # imitate a server restart
+        # shut down, then instantiate a new Probes object and clear
+        # Probes caches to imitate a server restart
+        p.shutdown()
         p = self.get_obj()
         Bcfg2.Server.Cache.expire("Probes")
 
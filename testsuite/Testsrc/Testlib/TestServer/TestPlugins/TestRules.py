@@ -1,6 +1,7 @@
 import os
 import sys
 import copy
+import time
 import lxml.etree
 import Bcfg2.Options
 from mock import Mock, MagicMock, patch
@@ -17,7 +18,7 @@ while path != "/":
         break
     path = os.path.dirname(path)
 from common import *
-from TestPlugin.Testhelpers import TestPrioDir
+from TestPlugin.Testhelpers import TestPrioDir, get_nested_data
 
 
 class TestRules(TestPrioDir):
@@ -191,3 +192,63 @@ class TestRules(TestPrioDir):
         """ Test that Rules handles trailing slashes on Path entries """
         self._do_test('slash')
         self._do_test('no_slash')
+
+    @benchmark
+    def test_benchmark(self):
+        """ matching deeply nested Rules files for each client """
+        r = TestPrioDir.get_obj(self)
+        r.entries = dict()
+        for prio in [10, 20, 30]:
+            name = "nested%d.xml" % prio
+            src = self.test_obj.__child__(os.path.join(datastore,
+                                                       self.test_obj.name,
+                                                       name))
+            src.data = lxml.etree.tostring(get_nested_data("Rules",
+                                                           "Service"))
+            src.data = src.data.replace(b'priority="10"',
+                                        ('priority="%d"' % prio).encode())
+            src.Index()
+            r.entries[name] = src
+
+        metadata = Mock(groups=["group0", "group1"],
+                        hostname="foo.example.com")
+        names = [el.get("name")
+                 for el in r.entries["nested10.xml"].Match(metadata)][:20]
+        self.assertGreater(len(names), 0)
+
+        rounds = 5
+        compiled = dict((n, s._compiled) for n, s in r.entries.items())
+        times = dict()
+        results = dict()
+        for use_compiled in [False, True]:
+            for name, src in r.entries.items():
+                if use_compiled:
+                    src._compiled = compiled[name]
+                else:
+                    src._compiled = None
+            # take the fastest round, so that a stray GC pause or
+            # busy machine doesn't skew the comparison
+            best = None
+            for _ in range(rounds):
+                # new metadata for each round, so the files are
+                # matched again, as they would be for each client
+                metadata = Mock(groups=["group0", "group1"],
+                                hostname="foo.example.com")
+                start = time.time()
+                r._get_matches(metadata)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            times[use_compiled] = best
+            report_benchmark("Matching %d Rules files with %d entries "
+                             "(compiled=%s): %.4fs" %
+                             (len(r.entries),
+                              len(src.xdata.xpath("//Service")),
+                              use_compiled, times[use_compiled]))
+
+            results[use_compiled] = []
+            for name in names:
+                entry = lxml.etree.Element("Service", name=name)
+                r.BindEntry(entry, metadata)
+                results[use_compiled].append(lxml.etree.tostring(entry))
+        self.assertEqual(results[True], results[False])
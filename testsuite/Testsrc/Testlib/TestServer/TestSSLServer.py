@@ -0,0 +1,436 @@
+import os
+import ssl
+import sys
+import time
+import errno
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import lxml.etree
+from mock import patch
+from Bcfg2.Compat import httplib, xmlrpclib, SocketServer
+from Bcfg2.Utils import HAS_ZSTD, get_compressor
+from Bcfg2.Client.Proxy import XMLRPCTransport, ProxyError
+from Bcfg2.Server.SSLServer import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class FakeCore(object):
+    """ just enough of a server core to dispatch GetConfig and
+    RecvStats calls """
+
+    def __init__(self):
+        self.config = ""
+        self.stats = None
+        self.stats_calls = 0
+        self.delay = 0
+
+    def check_acls(self, address, method):
+        return True
+
+    def _dispatch(self, method, params, funcs):
+        return getattr(self, method)(*params)
+
+    def GetConfig(self, address):
+        return self.config
+
+    def RecvStats(self, address, stats):
+        self.stats_calls += 1
+        time.sleep(self.delay)
+        self.stats = stats
+        return True
+
+
+class CountingRequestHandler(XMLRPCRequestHandler):
+    """ a request handler for plain HTTP that counts connections and
+    authentications, and records the size and content coding of each
+    request and response body as it was sent over the wire """
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        self.server.connections += 1
+        XMLRPCRequestHandler.setup(self)
+
+    def authenticate(self):
+        self.server.authentications += 1
+        return True
+
+    def do_POST(self):
+        self.server.requests.append(
+            (int(self.headers["content-length"]),
+             self.headers.get("content-encoding")))
+        self.server.responses.append([0, None])
+        if self.server.bad_response:
+            # act on the request, but reply with a malformed status
+            # line
+            self.rfile.read(int(self.headers["content-length"]))
+            self.server.instance.stats_calls += 1
+            self.wfile.write("HTTP/1.1 bad OK\r\n\r\n".encode('ascii'))
+            self.close_connection = 1
+            return
+        XMLRPCRequestHandler.do_POST(self)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "content-encoding":
+            self.server.responses[-1][1] = value
+        XMLRPCRequestHandler.send_header(self, keyword, value)
+
+    def _write(self, data):
+        self.server.responses[-1][0] += len(data)
+        XMLRPCRequestHandler._write(self, data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_counting(server):
+    """ set up a server that uses :class:`CountingRequestHandler` to
+    answer calls with a :class:`FakeCore` """
+    server.register_instance(FakeCore())
+    server.request_timeout = 5
+    server.connections = 0
+    server.authentications = 0
+    server.requests = []
+    server.responses = []
+    server.bad_response = False
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer,
+                 XMLRPCDispatcher):
+    daemon_threads = True
+    allow_reuse_address = True
+    logRequests = False
+
+    def __init__(self):
+        XMLRPCDispatcher.__init__(self, True, None)
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0),
+                                        CountingRequestHandler)
+        start_counting(self)
+
+
+class TLSServer(SocketServer.ThreadingMixIn, SSLServer, XMLRPCDispatcher):
+    daemon_threads = True
+    logRequests = False
+
+    def __init__(self, keyfile, certfile):
+        XMLRPCDispatcher.__init__(self, True, None)
+        SSLServer.__init__(self, False, ("127.0.0.1", 0),
+                           CountingRequestHandler, keyfile=keyfile,
+                           certfile=certfile, protocol='xmlrpc/ssl')
+        start_counting(self)
+
+
+class HTTPTransport(XMLRPCTransport):
+    """ XMLRPCTransport over plain HTTP """
+
+    def new_connection(self, host):
+        host, self._extra_headers = self.get_host_info(host)[0:2]
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+
+# try to find openssl, to create a certificate for the TLS tests
+OPENSSL = None
+for dirname in os.environ.get("PATH", "").split(os.pathsep):
+    if os.path.exists(os.path.join(dirname, "openssl")):
+        OPENSSL = os.path.join(dirname, "openssl")
+        break
+
+
+def get_config(entries):
+    """ get a serialized configuration with the given number of
+    entries """
+    config = lxml.etree.Element("Configuration", version="2.0",
+                                revision="1")
+    for i in range(entries):
+        if i % 100 == 0:
+            bundle = lxml.etree.SubElement(config, "Bundle",
+                                           name="bundle%d" % (i / 100))
+        path = lxml.etree.SubElement(bundle, "Path",
+                                     name="/etc/bcfg2/file%d.conf" % i,
+                                     type="file", owner="root",
+                                     group="root", mode="0644")
+        path.text = "# managed by bcfg2\noption%d = %d\n" % (i % 17, i)
+    return lxml.etree.tostring(config).decode('utf-8')
+
+
+class TestXMLRPCRequestHandler(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        self.server = HTTPServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get_proxy(self, encodings=None, timeout=90):
+        transport = HTTPTransport(timeout=timeout)
+        if encodings is not None:
+            transport.content_encodings = encodings
+        self.transports.append(transport)
+        return xmlrpclib.ServerProxy(self.url, allow_none=True,
+                                     transport=transport)
+
+    def test_compression(self):
+        config = get_config(1000)
+        self.server.instance.config = config
+
+        # requests are not compressed until the server has said that
+        # it accepts compressed requests
+        proxy = self.get_proxy(encodings=["gzip"])
+        self.assertTrue(proxy.RecvStats(config))
+        self.assertEqual(self.server.requests[-1][1], None)
+
+        # responses are compressed if the client accepts it
+        proxy = self.get_proxy(encodings=["gzip"])
+        self.assertEqual(proxy.GetConfig(), config)
+        size, encoding = self.server.responses[-1]
+        self.assertEqual(encoding, "gzip")
+        self.assertLess(size, len(config) / 4)
+
+        # requests are compressed once the server has said that it
+        # accepts compressed requests
+        self.assertTrue(proxy.RecvStats(config))
+        self.assertEqual(self.server.instance.stats, config)
+        size, encoding = self.server.requests[-1]
+        self.assertEqual(encoding, "gzip")
+        self.assertLess(size, len(config) / 4)
+
+        # small responses and requests are not compressed
+        self.assertTrue(proxy.RecvStats("stats"))
+        self.assertEqual(self.server.requests[-1][1], None)
+        self.assertEqual(self.server.instance.stats, "stats")
+        self.server.instance.config = "config"
+        self.assertEqual(proxy.GetConfig(), "config")
+        self.assertEqual(self.server.responses[-1][1], None)
+
+        # clients that do not accept compressed responses get
+        # uncompressed responses and send uncompressed requests
+        self.server.instance.config = config
+        proxy = self.get_proxy(encodings=[])
+        self.assertEqual(proxy.GetConfig(), config)
+        self.assertEqual(self.server.responses[-1][1], None)
+        self.assertTrue(proxy.RecvStats(config))
+        self.assertEqual(self.server.requests[-1][1], None)
+
+        if HAS_ZSTD:
+            proxy = self.get_proxy(encodings=["zstd"])
+            self.assertEqual(proxy.GetConfig(), config)
+            self.assertEqual(self.server.responses[-1][1], "zstd")
+
+    def test_keepalive(self):
+        config = get_config(1000)
+        self.server.instance.config = config
+        proxy = self.get_proxy()
+
+        # all calls are made over one connection, which is only
+        # authenticated once, whether or not responses are compressed
+        for _ in range(3):
+            self.assertEqual(proxy.GetConfig(), config)
+            self.assertTrue(proxy.RecvStats("stats"))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.authentications, 1)
+
+        # the client reconnects if the server closes an idle
+        # connection
+        self.server.request_timeout = 0.1
+        self.transports[-1].close()
+        self.assertTrue(proxy.RecvStats("stats"))
+        self.assertEqual(self.server.connections, 2)
+        time.sleep(0.5)
+        self.assertEqual(proxy.GetConfig(), config)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.authentications, 3)
+
+    @patch("Bcfg2.Client.Proxy.RetryMethod.max_retries", 1)
+    def test_keepalive_timeout(self):
+        proxy = self.get_proxy(timeout=0.5)
+        self.assertTrue(proxy.RecvStats("stats"))
+
+        # a request that times out on a reused connection is not sent
+        # again, since the server may have acted on it
+        self.server.instance.delay = 1
+        self.assertRaises(ProxyError, proxy.RecvStats, "stats")
+        self.assertEqual(self.server.instance.stats_calls, 2)
+        self.server.instance.delay = 0
+        self.assertTrue(proxy.RecvStats("stats"))
+        self.assertEqual(self.server.instance.stats_calls, 3)
+
+    @patch("Bcfg2.Client.Proxy.RetryMethod.max_retries", 1)
+    def test_keepalive_bad_response(self):
+        proxy = self.get_proxy()
+        self.assertTrue(proxy.RecvStats("stats"))
+
+        # a malformed response on a reused connection means that the
+        # server read the request, so it is not sent again
+        self.server.bad_response = True
+        self.assertRaises(ProxyError, proxy.RecvStats, "stats")
+        self.assertEqual(self.server.instance.stats_calls, 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_closed(self):
+        closed = XMLRPCTransport._connection_closed
+        self.assertTrue(closed(httplib.BadStatusLine("")))
+        self.assertFalse(closed(httplib.BadStatusLine("HTTP/1.1 bad OK")))
+        if hasattr(httplib, "RemoteDisconnected"):
+            self.assertTrue(closed(httplib.RemoteDisconnected(
+                "Remote end closed connection without response")))
+        self.assertTrue(closed(socket.error(errno.ECONNRESET,
+                                            "Connection reset by peer")))
+        self.assertTrue(closed(socket.error(errno.EPIPE, "Broken pipe")))
+        self.assertFalse(closed(socket.timeout("timed out")))
+        self.assertFalse(closed(socket.error(errno.ECONNREFUSED,
+                                             "Connection refused")))
+
+    @patch("Bcfg2.Server.SSLServer.XMLRPCRequestHandler.auth_cache_ttl", 0)
+    def test_keepalive_auth_expired(self):
+        proxy = self.get_proxy()
+        for _ in range(3):
+            self.assertTrue(proxy.RecvStats("stats"))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.authentications, 3)
+
+    def test_unsupported_encoding(self):
+        conn = httplib.HTTPConnection("127.0.0.1",
+                                      self.server.server_address[1])
+        conn.request("POST", "/RPC2", "garbage",
+                     {"Content-Encoding": "unsupported",
+                      "Content-Type": "text/xml"})
+        self.assertEqual(conn.getresponse().status, 415)
+        conn.close()
+
+    @patch("Bcfg2.Server.SSLServer.XMLRPCRequestHandler.max_chunk_size",
+           1024)
+    @patch("Bcfg2.Server.SSLServer.XMLRPCRequestHandler."
+           "max_decompressed_size", 1024 * 1024)
+    def test_decompression_limit(self):
+        def post(body):
+            compressor = get_compressor("gzip")
+            data = compressor.compress(body) + compressor.flush()
+            conn = httplib.HTTPConnection("127.0.0.1",
+                                          self.server.server_address[1])
+            conn.request("POST", "/RPC2", data,
+                         {"Content-Encoding": "gzip",
+                          "Content-Type": "text/xml"})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            return response.status
+
+        # requests that decompress to less than the limit are
+        # handled, but larger ones are refused
+        stats = xmlrpclib.dumps(("x" * 1000, ), "RecvStats").encode('utf-8')
+        self.assertEqual(post(stats), 200)
+        self.assertEqual(self.server.instance.stats, "x" * 1000)
+        stats = xmlrpclib.dumps(("x" * 2 * 1024 * 1024, ),
+                                "RecvStats").encode('utf-8')
+        self.assertEqual(post(stats), 413)
+        self.assertEqual(self.server.instance.stats_calls, 1)
+
+    @benchmark
+    def test_benchmark(self):
+        """ bytes on the wire and CPU time per GetConfig request for a
+        10k-entry configuration """
+        config = get_config(10000)
+        self.server.instance.config = config
+        rounds = 3
+        sizes = dict()
+        encodings = [[], ["gzip"]]
+        if HAS_ZSTD:
+            encodings.append(["zstd"])
+        for encoding in encodings:
+            proxy = self.get_proxy(encodings=encoding)
+            name = encoding and encoding[0] or "identity"
+            start = os.times()
+            wallstart = time.time()
+            for _ in range(rounds):
+                self.assertEqual(proxy.GetConfig(), config)
+            end = os.times()
+            cpu = (end[0] + end[1] - start[0] - start[1]) / rounds
+            sizes[name] = self.server.responses[-1][0]
+            report_benchmark("GetConfig with %d bytes of configuration "
+                             "(%s): %d bytes on the wire, %.4fs CPU, "
+                             "%.4fs total per request" %
+                             (len(config), name, sizes[name], cpu,
+                              (time.time() - wallstart) / rounds))
+        self.assertLess(sizes["gzip"], sizes["identity"] / 4)
+
+
+@skipUnless(OPENSSL, "openssl not found, skipping TLS tests")
+class TestTLS(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.key = os.path.join(self.tmpdir, "bcfg2.key")
+        self.cert = os.path.join(self.tmpdir, "bcfg2.crt")
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.check_call(
+                [OPENSSL, "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                 "-days", "1", "-subj", "/CN=127.0.0.1",
+                 "-keyout", self.key, "-out", self.cert],
+                stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+        self.server = TLSServer(self.key, self.cert)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.transport = XMLRPCTransport(ca=self.cert, timeout=5,
+                                         protocol='xmlrpc/ssl')
+        self.proxy = xmlrpclib.ServerProxy(
+            "https://127.0.0.1:%s" % self.server.server_address[1],
+            allow_none=True, transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_keepalive(self):
+        has_context = hasattr(ssl, "SSLContext")
+        self.assertEqual(self.server.ssl_context is not None, has_context)
+
+        # all calls are made over one connection
+        for _ in range(3):
+            self.assertTrue(self.proxy.RecvStats("stats"))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.authentications, 1)
+        conn = self.transport._connection[1]
+        context = conn.ssl_context
+        self.assertEqual(context is not None, has_context)
+
+        # the connection is reopened with the same SSL context after
+        # the client closes it, and after the server closes it when
+        # it is idle, resuming the TLS session where Python supports
+        # it
+        self.server.request_timeout = 0.1
+        self.transport.close()
+        self.assertTrue(self.proxy.RecvStats("stats"))
+        time.sleep(0.5)
+        self.assertTrue(self.proxy.RecvStats("stats"))
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.instance.stats_calls, 5)
+        self.assertIs(self.transport._connection[1], conn)
+        self.assertIs(conn.ssl_context, context)
+        if hasattr(conn.sock, "session_reused"):
+            self.assertTrue(conn.sock.session_reused)
@@ -42,3 +42,14 @@ class TestStatistics(Bcfg2TestCase):
         stats.add_value("test1", 10)
         self.assertEqual(stats.display(), dict(test1=(1.0, 10.0, 5.5, 2),
                                                test2=(1.23, 1.23, 1.23, 1)))
+
+    def test_histogram(self):
+        stats = Statistics()
+        stats.add_histogram_value("test", 0.5, buckets=[1, 10])
+        stats.add_histogram_value("test", 1, buckets=[1, 10])
+        stats.add_histogram_value("test", 5, buckets=[1, 10])
+        stats.add_histogram_value("test", 50, buckets=[1, 10])
+        self.assertEqual(stats.display(),
+                         {"test:<=1": (0.5, 1.0, 0.75, 2),
+                          "test:<=10": (5.0, 5.0, 5.0, 1),
+                          "test:>10": (50.0, 50.0, 50.0, 1)})
@@ -57,3 +57,58 @@ class TestIsString(Bcfg2TestCase):
         if not inPy3k:
             self.assertFalse(is_string("foo" + chr(128) + "bar", 'ascii'))
             self.assertFalse(is_string(ustr, 'ascii'))
+
+
+class TestSelectContentEncoding(Bcfg2TestCase):
+    def test_select_content_encoding(self):
+        supported = ["zstd", "gzip"]
+        # tuples of (Accept-Encoding header, expected coding)
+        tests = [("gzip", "gzip"),
+                 ("gzip, zstd", "zstd"),
+                 ("GZIP;q=0.5", "gzip"),
+                 ("identity", None),
+                 ("gzip;q=0", None),
+                 ("zstd;q=0, gzip", "gzip"),
+                 ("*", "zstd"),
+                 ("*;q=0", None),
+                 ("*, zstd;q=0", "gzip"),
+                 ("gzip;q=0, *", "zstd"),
+                 ("zstd;q=0, gzip;q=0, *", None)]
+        for accept, expected in tests:
+            self.assertEqual(select_content_encoding(accept, supported),
+                             expected)
+
+
+class TestGetDecompressor(Bcfg2TestCase):
+    def _test_max_length(self, encoding):
+        data = b"x" * 100000
+        compressor = get_compressor(encoding)
+        compressed = compressor.compress(data) + compressor.flush()
+
+        # data up to the limit is decompressed, whether it's given
+        # all at once or in pieces
+        for size in [len(compressed), 10]:
+            decompressor = get_decompressor(encoding, max_length=len(data))
+            rv = [decompressor.decompress(compressed[i:i + size])
+                  for i in range(0, len(compressed), size)]
+            rv.append(decompressor.flush())
+            self.assertEqual(b''.join(rv), data)
+
+        # anything longer is refused, without decompressing much more
+        # than the limit
+        decompressor = get_decompressor(encoding, max_length=1000)
+        self.assertRaises(DecompressedSizeError,
+                          decompressor.decompress, compressed)
+        self.assertLessEqual(1000 - decompressor.remaining, 256 * 1024)
+
+    def test_max_length_gzip(self):
+        self._test_max_length("gzip")
+
+    @skipUnless(HAS_ZSTD, "zstandard not found")
+    def test_max_length_zstd(self):
+        self._test_max_length("zstd")
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, get_decompressor, "unsupported")
+        self.assertRaises(ValueError, get_decompressor, "unsupported",
+                          max_length=1000)
@@ -37,6 +37,27 @@ if sys.hexversion >= 0x03000000:
     inPy3k = True
 
 
+#: Whether or not to run benchmarks.  Benchmarks are slow, and their
+#: results depend on the machine they run on, so they are skipped
+#: unless the ``BCFG2_BENCHMARK`` environment variable is set.
+run_benchmarks = bool(os.environ.get("BCFG2_BENCHMARK"))
+
+
+def benchmark(func):
+    """ Decorator for a test that benchmarks some code.  The test is
+    skipped unless :attr:`run_benchmarks` is set.  Benchmarks should
+    report their timings with :func:`report_benchmark` and must not
+    assert anything about them. """
+    return skipUnless(run_benchmarks,
+                      "BCFG2_BENCHMARK not set, skipping benchmark")(func)
+
+
+def report_benchmark(msg):
+    """ Report the results of a benchmark.  This is written to the
+    real stderr, so that it is shown even if stdout is captured. """
+    sys.__stderr__.write("\n%s " % msg)
+
+
 #: A function to set a default config option if it's not already set
 def set_setup_default(option, value=None):
     if not hasattr(Bcfg2.Options.setup, option):